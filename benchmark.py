@@ -0,0 +1,274 @@
+"""
+Benchmark de la capa de base de datos de App Soporte
+
+Siembra una BD con volúmenes realistas y mide las funciones públicas de
+database.py. La salida es JSON estable para comparar entre versiones.
+
+Uso:
+    python benchmark.py                          # SQLite en bench.db, volúmenes completos
+    python benchmark.py --visitas 50000 --salida base.json
+    python benchmark.py --reusar --comparar base.json
+    DATABASE_URL=postgresql://localhost/bench python benchmark.py   # PostgreSQL local
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import date, timedelta
+
+TRABAJOS = [
+    "Se reparó la impresora del área de contabilidad",
+    "Instalación y configuración de antivirus en estaciones",
+    "Respaldo de base de datos del sistema contable",
+    "Cambio de disco duro y reinstalación de Windows",
+    "Configuración de correo en Outlook para usuario nuevo",
+    "Revisión de red: cable dañado en recepción",
+    "Actualización del sistema de facturación electrónica",
+    "Limpieza de equipo y cambio de pasta térmica",
+    "Configuración de VPN para teletrabajo",
+    "Soporte remoto por lentitud en el servidor",
+]
+PENDIENTES = [
+    "Traer tóner para la impresora",
+    "Cotizar disco SSD",
+    "Volver para terminar respaldo",
+    "Esperar licencia del proveedor",
+]
+PERSONAS = ["Ana", "Luis", "María", "Carlos", "Sofía", "Jorge", "Lucía", "Pedro"]
+
+LOTE = 10000
+
+# persona_atendida de las visitas que inserta el caso guardar_visita (se borran al final)
+PERSONA_BENCHMARK = 'Benchmark'
+
+def sembrar(db, clientes, soportistas, visitas, tareas, anios, semilla):
+    """Inserta datos sintéticos en lotes (reproducibles con la semilla)"""
+    rng = random.Random(semilla)
+    hoy = date.today()
+    inicio = hoy - timedelta(days=365 * anios)
+    dias = (hoy - inicio).days
+
+    conn = db.get_connection()
+    cursor = conn.cursor()
+
+    def insertar(sql, filas):
+        if not filas:
+            return
+        if db.USE_POSTGRES:
+            from psycopg2.extras import execute_values
+            execute_values(cursor, sql.replace('VALUES ({})', 'VALUES %s'), filas, page_size=1000)
+        else:
+            columnas = sql[sql.index('(') + 1:sql.index(')')].count(',') + 1
+            cursor.executemany(sql.format(', '.join(['?'] * columnas)), filas)
+
+    try:
+        print(f"🌱 Sembrando {soportistas} soportistas, {clientes} clientes...")
+        insertar('INSERT INTO soportistas (nombre, correo) VALUES ({})',
+                 [(f"Técnico {i + 1}", f"tecnico{i + 1}@ejemplo.com") for i in range(soportistas)])
+        conn.commit()
+        ids_soportistas = [f[0] for f in _filas(cursor, 'SELECT id FROM soportistas ORDER BY id')]
+
+        insertar('INSERT INTO clientes (nombre, correo, telefono, soportista_id, activo) VALUES ({})',
+                 [(f"Cliente {i + 1:04d}", f"cliente{i + 1}@ejemplo.com", f"2222-{i:04d}",
+                   rng.choice(ids_soportistas), 0 if rng.random() < 0.05 else 1) for i in range(clientes)])
+        conn.commit()
+        filas_clientes = _filas(cursor, 'SELECT id, soportista_id FROM clientes ORDER BY id')
+        # Pocos clientes concentran muchas visitas (distribución de Pareto)
+        pesos = [rng.paretovariate(1.2) for _ in filas_clientes]
+
+        print(f"🌱 Sembrando {visitas} visitas...")
+        for desde in range(0, visitas, LOTE):
+            cantidad = min(LOTE, visitas - desde)
+            lote = []
+            for cliente_id, soportista_cliente in rng.choices(filas_clientes, weights=pesos, k=cantidad):
+                soportista_id = soportista_cliente if rng.random() < 0.8 else rng.choice(ids_soportistas)
+                tiene_pendiente = 1 if rng.random() < 0.05 else 0
+                lote.append((
+                    cliente_id, soportista_id, rng.choice(PERSONAS),
+                    (inicio + timedelta(days=rng.randrange(dias))).strftime('%Y-%m-%d'),
+                    f"{rng.randrange(7, 19):02d}:{rng.choice(['00', '15', '30', '45'])}",
+                    rng.choice([15, 30, 45, 60, 90, 120]),
+                    f"{rng.choice(TRABAJOS)}. {rng.choice(TRABAJOS).lower()}",
+                    tiene_pendiente,
+                    rng.choice(PENDIENTES) if tiene_pendiente else None,
+                    1 if tiene_pendiente and rng.random() < 0.8 else 0,
+                ))
+            insertar('''INSERT INTO visitas (cliente_id, soportista_id, persona_atendida, fecha, hora_inicio,
+                        duracion_minutos, trabajo_realizado, tiene_pendiente, descripcion_pendiente,
+                        pendiente_resuelto) VALUES ({})''', lote)
+            conn.commit()
+            print(f"   {desde + cantidad}/{visitas}", end='\r')
+        print()
+
+        print(f"🌱 Sembrando {tareas} tareas...")
+        for desde in range(0, tareas, LOTE):
+            cantidad = min(LOTE, tareas - desde)
+            insertar('INSERT INTO tareas (soportista_id, cliente_id, descripcion, fecha_limite, completada) VALUES ({})',
+                     [(rng.choice(ids_soportistas), rng.choice(filas_clientes)[0], rng.choice(PENDIENTES),
+                       (inicio + timedelta(days=rng.randrange(dias + 30))).strftime('%Y-%m-%d'),
+                       1 if rng.random() < 0.9 else 0) for _ in range(cantidad)])
+            conn.commit()
+
+        cursor.execute('ANALYZE')
+        conn.commit()
+    finally:
+        cursor.close()
+        db.liberar_conexion(conn)
+
+    # El resumen diario se mantiene en guardar_visita; la siembra masiva lo salta
+    db.recalcular_resumen_diario()
+
+def limpiar(db):
+    """Borra las visitas que insertaron los casos guardar_visita, para que con
+    --reusar cada corrida mida la misma BD"""
+    borradas = db.execute_query('DELETE FROM visitas WHERE persona_atendida = ?', (PERSONA_BENCHMARK,), fetch=False)
+    if borradas:
+        db.recalcular_resumen_diario()
+
+def _filas(cursor, sql):
+    cursor.execute(sql)
+    return [tuple(f) for f in cursor.fetchall()]
+
+def medir(funcion, repeticiones, preparar=None):
+    """Ejecuta una vez para calentar y luego mide cada repetición (ms)"""
+    if preparar:
+        preparar()
+    funcion()
+    tiempos = []
+    for _ in range(repeticiones):
+        if preparar:
+            preparar()
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    tiempos.sort()
+    return {
+        'repeticiones': repeticiones,
+        'min_ms': round(tiempos[0], 3),
+        'mediana_ms': round(statistics.median(tiempos), 3),
+        'p95_ms': round(tiempos[min(len(tiempos) - 1, int(len(tiempos) * 0.95))], 3),
+        'promedio_ms': round(statistics.fmean(tiempos), 3),
+    }
+
+def casos(db):
+    """Casos de medición: nombre -> (función, preparación opcional)"""
+    hoy = date.today()
+    inicio_mes = hoy.replace(day=1).strftime('%Y-%m-%d')
+    hace_un_anio = (hoy - timedelta(days=365)).strftime('%Y-%m-%d')
+    hoy_txt = hoy.strftime('%Y-%m-%d')
+
+    # Cliente con más visitas (peor caso de consulta) y uno cualquiera
+    fila = db.execute_query('SELECT cliente_id, SUM(cantidad) as n FROM visitas_diarias GROUP BY cliente_id ORDER BY n DESC LIMIT 1')
+    cliente_grande = fila[0]['cliente_id'] if fila else 1
+    soportista = db.obtener_soportistas()[0]['id']
+
+    return {
+        'obtener_visitas_cliente.mes': (lambda: db.obtener_visitas_cliente(cliente_grande, inicio_mes, hoy_txt), None),
+        'obtener_visitas_cliente.anio': (lambda: db.obtener_visitas_cliente(cliente_grande, hace_un_anio, hoy_txt), None),
+        'listar_visitas_cliente.anio': (lambda: db.listar_visitas_cliente(cliente_grande, hace_un_anio, hoy_txt), None),
+        'listar_visitas_cliente.pagina': (lambda: db.listar_visitas_cliente(cliente_grande, hace_un_anio, hoy_txt, limite=50), None),
+        'obtener_totales_visitas_cliente.anio': (lambda: db.obtener_totales_visitas_cliente(cliente_grande, hace_un_anio, hoy_txt), None),
+        'obtener_estadisticas_clientes.mes': (lambda: db.obtener_estadisticas_clientes(None, inicio_mes, hoy_txt), None),
+        'obtener_estadisticas_clientes.anio': (lambda: db.obtener_estadisticas_clientes(None, hace_un_anio, hoy_txt), None),
+        'obtener_estadisticas_clientes.soportista_anio': (lambda: db.obtener_estadisticas_clientes(soportista, hace_un_anio, hoy_txt), None),
+        'obtener_clientes_sin_boletas.mes': (lambda: db.obtener_clientes_sin_boletas(None, inicio_mes, hoy_txt), None),
+        'obtener_pendientes': (lambda: db.obtener_pendientes(), None),
+        'listar_pendientes': (lambda: db.listar_pendientes(), None),
+        'contar_pendientes_total.sql': (db.contar_pendientes_total, db._invalidar_contador_pendientes),
+        'contar_pendientes_total.memoria': (db.contar_pendientes_total, None),
+        'obtener_tareas': (lambda: db.obtener_tareas(solo_pendientes=True), None),
+        'buscar_texto': (lambda: db.buscar_texto('impresora contabilidad'), None),
+        'obtener_clientes.sql': (db.obtener_clientes, db.invalidar_catalogos),
+        'guardar_visita': (lambda: db.guardar_visita(cliente_grande, soportista, PERSONA_BENCHMARK, hoy_txt, '10:00', 30,
+                                                     'Visita de benchmark'), None),
+        'guardar_visita.con_fila': (lambda: db.guardar_visita(cliente_grande, soportista, PERSONA_BENCHMARK, hoy_txt, '10:00', 30,
+                                                              'Visita de benchmark', devolver_fila=True), None),
+    }
+
+def comparar(resultados, base, tolerancia):
+    """Imprime diferencias de mediana contra una corrida anterior; devuelve las regresiones"""
+    regresiones = []
+    for nombre, actual in sorted(resultados.items()):
+        anterior = base.get(nombre)
+        if not anterior:
+            continue
+        cambio = (actual['mediana_ms'] - anterior['mediana_ms']) / max(anterior['mediana_ms'], 0.001)
+        marca = '🔴' if cambio > tolerancia else '🟢'
+        print(f"{marca} {nombre}: {anterior['mediana_ms']} ms -> {actual['mediana_ms']} ms ({cambio:+.0%})", file=sys.stderr)
+        if cambio > tolerancia:
+            regresiones.append(nombre)
+    return regresiones
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de database.py")
+    parser.add_argument('--db', default='bench.db', help="Archivo SQLite (ignorado si hay DATABASE_URL)")
+    parser.add_argument('--clientes', type=int, default=500)
+    parser.add_argument('--soportistas', type=int, default=30)
+    parser.add_argument('--visitas', type=int, default=1000000)
+    parser.add_argument('--tareas', type=int, default=50000)
+    parser.add_argument('--anios', type=int, default=3, help="Años de historia")
+    parser.add_argument('--semilla', type=int, default=42)
+    parser.add_argument('--repeticiones', type=int, default=20)
+    parser.add_argument('--reusar', action='store_true', help="No resembrar si la BD ya tiene datos")
+    parser.add_argument('--salida', help="Archivo JSON de salida (por defecto stdout)")
+    parser.add_argument('--comparar', help="JSON de una corrida anterior")
+    parser.add_argument('--tolerancia', type=float, default=0.25, help="Regresión aceptada en la mediana")
+    args = parser.parse_args()
+
+    # Configurar antes de importar database (lee el entorno al importarse)
+    if not os.environ.get('DATABASE_URL'):
+        if not args.reusar and os.path.exists(args.db):
+            os.remove(args.db)
+        os.environ['SQLITE_PATH'] = args.db
+    os.environ.setdefault('DB_LENTA_MS', 'inf')
+
+    # Los mensajes de progreso van a stderr: stdout queda solo para el JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        import database as db
+
+        if not (args.reusar and db.execute_query('SELECT COUNT(*) as n FROM visitas')[0]['n']):
+            inicio = time.perf_counter()
+            sembrar(db, args.clientes, args.soportistas, args.visitas, args.tareas, args.anios, args.semilla)
+            print(f"🌱 Siembra lista en {time.perf_counter() - inicio:.1f} s")
+
+        # Restos de una corrida anterior que se cortó antes de limpiar
+        limpiar(db)
+        resultados = {}
+        try:
+            for nombre, (funcion, preparar) in casos(db).items():
+                resultados[nombre] = medir(funcion, args.repeticiones, preparar)
+                print(f"⏱️ {nombre}: mediana {resultados[nombre]['mediana_ms']} ms")
+        finally:
+            limpiar(db)
+
+    conteo = db.execute_query('''
+        SELECT (SELECT COUNT(*) FROM clientes) as clientes, (SELECT COUNT(*) FROM soportistas) as soportistas,
+               (SELECT COUNT(*) FROM visitas) as visitas, (SELECT COUNT(*) FROM tareas) as tareas
+    ''')[0]
+    salida = {
+        'motor': 'postgresql' if db.USE_POSTGRES else 'sqlite',
+        # dict(): una Fila no se serializa sola
+        'volumen': dict(conteo),
+        'semilla': args.semilla,
+        'resultados': resultados,
+    }
+    texto = json.dumps(salida, indent=2, sort_keys=True, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as f:
+            f.write(texto + '\n')
+        print(f"💾 Resultados en {args.salida}", file=sys.stderr)
+    else:
+        print(texto)
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            base = json.load(f)['resultados']
+        if comparar(resultados, base, args.tolerancia):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,105 +1,311 @@
 """
 Módulo de envío de correos para App Soporte
 """
+import os
+import re
 import smtplib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from html import escape
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from database import obtener_config, formatear_duracion
+from database import (obtener_configuracion, formatear_duracion, encolar_correo_saliente,
+                      tomar_correos_salientes, marcar_correo_enviado, reprogramar_correo,
+                      reintentar_correos_con_error, obtener_clientes_con_visitas,
+                      iterar_visitas_cliente, obtener_totales_visitas_cliente, obtener_visita,
+                      version_datos_cliente, version_datos)
 
-def enviar_correo(destinatario, asunto, cuerpo_html):
-    """Envía un correo electrónico"""
-    try:
-        print("CORREO: Iniciando enviar_correo()")
-        
-        # Obtener configuración SMTP
-        smtp_host = obtener_config('smtp_host', '')
-        smtp_port = int(obtener_config('smtp_port', '587'))
-        smtp_user = obtener_config('smtp_user', '')
-        smtp_pass = obtener_config('smtp_pass', '')
-        smtp_from = obtener_config('smtp_from', smtp_user)
-        
-        print(f"CORREO: Config - host={smtp_host}, port={smtp_port}, user={smtp_user}")
-        
-        if not all([smtp_host, smtp_user, smtp_pass]):
-            print("CORREO: Configuración incompleta")
-            return False, "Configuración de correo incompleta"
-        
-        # Crear mensaje
+# Tope de mensajes por conexión antes de reconectar (Gmail/Office365 cortan ~100)
+SMTP_MENSAJES_POR_SESION = int(os.environ.get('CORREO_POR_SESION', '100'))
+
+class SesionSMTP:
+    """Conexión SMTP autenticada que se reutiliza para varios envíos (un solo
+    connect + TLS + login). Uso: with SesionSMTP() as smtp: smtp.enviar(...)"""
+    
+    def __init__(self, config=None, mensajes_por_sesion=None):
+        # Configuración SMTP (cacheada, una sola consulta como máximo)
+        config = config or obtener_configuracion()
+        self.host = config.get('smtp_host', '')
+        self.port = int(config.get('smtp_port', '587'))
+        self.user = config.get('smtp_user', '')
+        self.password = config.get('smtp_pass', '')
+        self.remitente = config.get('smtp_from', self.user)
+        self.mensajes_por_sesion = mensajes_por_sesion or SMTP_MENSAJES_POR_SESION
+        self.server = None
+        self.enviados = 0
+    
+    @property
+    def completa(self):
+        # Sin usuario se envía sin login (relay interno o servidor SMTP local de pruebas)
+        return bool(self.host and self.remitente and (not self.user or self.password))
+    
+    def conectar(self):
+        if not self.completa:
+            raise ValueError("Configuración de correo incompleta")
+        print(f"CORREO: Conectando a {self.host}:{self.port} (user={self.user})...")
+        # Usar SSL para puerto 465, TLS para 587; timeout de 30 segundos
+        if self.port == 465:
+            server = smtplib.SMTP_SSL(self.host, self.port, timeout=30)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=30)
+        try:
+            if self.port != 465:
+                server.ehlo()
+                # Con login, TLS obligatorio: si el servidor no ofrece STARTTLS
+                # (o alguien lo quitó de la respuesta) starttls() falla con
+                # SMTPNotSupportedError y la contraseña no sale en claro.
+                # Sin usuario (relay local) se usa TLS solo si lo ofrece
+                if self.user or server.has_extn('starttls'):
+                    server.starttls()
+                    server.ehlo()
+            if self.user:
+                server.login(self.user, self.password)
+        except Exception:
+            server.close()
+            raise
+        print("CORREO: Sesión SMTP lista")
+        self.server = server
+        self.enviados = 0
+    
+    def enviar(self, destinatario, asunto, cuerpo_html):
+        """Envía un mensaje por la sesión abierta (conecta si hace falta)"""
         msg = MIMEMultipart('alternative')
         msg['Subject'] = asunto
-        msg['From'] = smtp_from
+        msg['From'] = self.remitente
         msg['To'] = destinatario
+        msg.attach(MIMEText(cuerpo_html, 'html', 'utf-8'))
         
-        # Adjuntar HTML
-        parte_html = MIMEText(cuerpo_html, 'html', 'utf-8')
-        msg.attach(parte_html)
-        
-        print(f"CORREO: Conectando a {smtp_host}:{smtp_port}...")
-        
-        # Enviar con timeout de 30 segundos
-        # Usar SSL para puerto 465, TLS para 587
-        if smtp_port == 465:
-            print("CORREO: Usando SMTP_SSL (puerto 465)...")
-            with smtplib.SMTP_SSL(smtp_host, smtp_port, timeout=30) as server:
-                print("CORREO: Conexión SSL OK, haciendo login...")
-                server.login(smtp_user, smtp_pass)
-                print("CORREO: Login OK, enviando mensaje...")
-                server.send_message(msg)
-                print("CORREO: Mensaje enviado!")
+        # Muchos servidores cortan la sesión tras N mensajes: renovarla antes
+        if self.server is not None and self.enviados >= self.mensajes_por_sesion:
+            self.cerrar()
+        if self.server is None:
+            self.conectar()
+        try:
+            self.server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # El servidor cerró la sesión inactiva: reconectar una vez
+            self.cerrar()
+            self.conectar()
+            self.server.send_message(msg)
+        self.enviados += 1
+        print(f"CORREO: Mensaje enviado a {destinatario}")
+    
+    def cerrar(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                self.server.close()
+            self.server = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.cerrar()
+
+def mensaje_error_correo(e):
+    """Texto para el usuario a partir de una excepción de envío"""
+    if isinstance(e, smtplib.SMTPAuthenticationError):
+        return "Error de autenticación. Verifique usuario/contraseña."
+    if isinstance(e, smtplib.SMTPNotSupportedError):
+        return "El servidor no ofrece TLS (STARTTLS): no se envía la contraseña sin cifrar."
+    if isinstance(e, ValueError):
+        return str(e)
+    if isinstance(e, smtplib.SMTPException):
+        return f"Error SMTP: {str(e)}"
+    return f"Error al enviar: {str(e)}"
+
+def enviar_correo(destinatario, asunto, cuerpo_html, sesion=None):
+    """Envía un correo electrónico. Con sesion reutiliza esa conexión SMTP
+    en vez de abrir (y cerrar) una nueva"""
+    try:
+        if sesion is not None:
+            sesion.enviar(destinatario, asunto, cuerpo_html)
         else:
-            print("CORREO: Usando SMTP con TLS...")
-            with smtplib.SMTP(smtp_host, smtp_port, timeout=30) as server:
-                print("CORREO: Conexión OK, iniciando TLS...")
-                server.starttls()
-                print("CORREO: TLS OK, haciendo login...")
-                server.login(smtp_user, smtp_pass)
-                print("CORREO: Login OK, enviando mensaje...")
-                server.send_message(msg)
-                print("CORREO: Mensaje enviado!")
-        
+            with SesionSMTP() as smtp:
+                smtp.enviar(destinatario, asunto, cuerpo_html)
         return True, "Correo enviado exitosamente"
-    
-    except smtplib.SMTPAuthenticationError as e:
-        print(f"CORREO ERROR Auth: {e}")
-        return False, "Error de autenticación. Verifique usuario/contraseña."
-    except smtplib.SMTPException as e:
-        print(f"CORREO ERROR SMTP: {e}")
-        return False, f"Error SMTP: {str(e)}"
     except Exception as e:
-        print(f"CORREO ERROR General: {e}")
-        return False, f"Error al enviar: {str(e)}"
+        print(f"CORREO ERROR: {e}")
+        if sesion is not None:
+            # Sesión en estado dudoso: el próximo envío reconecta
+            sesion.cerrar()
+        return False, mensaje_error_correo(e)
 
-def generar_html_boleta(visita):
-    """Genera HTML de una boleta de visita"""
-    pendiente_html = ""
-    if visita['tiene_pendiente']:
-        estado = "✅ Resuelto" if visita.get('pendiente_resuelto') else "⚠️ Pendiente"
-        pendiente_html = f"""
-        <tr>
-            <td style="padding: 10px; background: #fff3cd; border-bottom: 1px solid #ddd;">
-                <strong>Pendiente:</strong> {estado}<br>
-                {visita.get('descripcion_pendiente', '')}
-            </td>
-        </tr>
-        """
+# ============== COLA DE ENVÍO ==============
+
+# encolar_correo guarda el mensaje en la tabla correos_salientes y vuelve de
+# inmediato; un hilo en segundo plano los envía con enviar_correo. Si falla se
+# reintenta con espera exponencial (CORREO_ESPERA_BASE, 2x, 4x... hasta
+# CORREO_ESPERA_MAX) y tras CORREO_REINTENTOS intentos queda en estado 'error'.
+COLA_REINTENTOS = int(os.environ.get('CORREO_REINTENTOS', '6'))
+COLA_ESPERA_BASE = float(os.environ.get('CORREO_ESPERA_BASE', '30'))
+COLA_ESPERA_MAX = float(os.environ.get('CORREO_ESPERA_MAX', '3600'))
+COLA_REVISAR_SEGUNDOS = 30  # cada cuánto buscar reintentos vencidos sin aviso
+COLA_LOTE = 10
+
+_despertar = threading.Event()
+_hilo_cola = None
+_hilo_cola_lock = threading.Lock()
+
+def encolar_correo(destinatario, asunto, cuerpo_html):
+    """Deja un correo en la cola de envío sin esperar al servidor SMTP. Devuelve su id"""
+    id = encolar_correo_saliente(destinatario, asunto, cuerpo_html)
+    iniciar_cola_correos()
+    _despertar.set()
+    return id
+
+def espera_reintento(intentos):
+    """Segundos hasta el próximo intento después de fallar el intento número intentos"""
+    return min(COLA_ESPERA_BASE * 2 ** (intentos - 1), COLA_ESPERA_MAX)
+
+def procesar_cola_correos(limite=COLA_LOTE):
+    """Envía los correos de la cola que ya vencieron. Devuelve cuántos tomó"""
+    correos = tomar_correos_salientes(limite)
+    if not correos:
+        return 0
+    # Una sola conexión SMTP para todo el lote
+    with SesionSMTP() as smtp:
+        for c in correos:
+            ok, msg = enviar_correo(c['destinatario'], c['asunto'], c['cuerpo_html'], sesion=smtp)
+            if ok:
+                marcar_correo_enviado(c['id'])
+            elif c['intentos'] >= COLA_REINTENTOS:
+                print(f"CORREO: #{c['id']} descartado tras {c['intentos']} intentos: {msg}")
+                reprogramar_correo(c['id'], msg)
+            else:
+                reprogramar_correo(c['id'], msg, time.time() + espera_reintento(c['intentos']))
+    return len(correos)
+
+def _trabajar_cola():
+    while True:
+        _despertar.clear()
+        try:
+            # Lote completo: puede haber más esperando, seguir sin pausa
+            if procesar_cola_correos() >= COLA_LOTE:
+                continue
+        except Exception as e:
+            print(f"CORREO ERROR Cola: {e}")
+        _despertar.wait(COLA_REVISAR_SEGUNDOS)
+
+def reintentar_correos_fallidos():
+    """Vuelve a encolar los correos en estado 'error'. Devuelve cuántos"""
+    cantidad = reintentar_correos_con_error()
+    iniciar_cola_correos()
+    _despertar.set()
+    return cantidad
+
+def iniciar_cola_correos():
+    """Arranca (una sola vez por proceso) el hilo que envía la cola"""
+    global _hilo_cola
+    with _hilo_cola_lock:
+        if _hilo_cola is None or not _hilo_cola.is_alive():
+            _hilo_cola = threading.Thread(target=_trabajar_cola, name='cola-correos', daemon=True)
+            _hilo_cola.start()
+
+# ============== ENVÍO MASIVO DE REPORTES ==============
+
+# Pausa entre mensajes del envío masivo para no disparar los límites de
+# frecuencia del servidor SMTP (CORREO_PAUSA_MASIVO segundos)
+MASIVO_PAUSA = float(os.environ.get('CORREO_PAUSA_MASIVO', '1'))
+
+def enviar_reportes_periodo(fecha_desde, fecha_hasta, soportista_id=None, pausa=MASIVO_PAUSA, al_avanzar=None):
+    """Envía el reporte de visitas del período a cada cliente activo con visitas
+    (opcionalmente solo los de un soportista) por una única sesión SMTP.
+    Los que fallan pasan a la cola de envío. al_avanzar(hechos, total) informa
+    el progreso. Devuelve (éxito, mensaje)"""
+    clientes = obtener_clientes_con_visitas(soportista_id, fecha_desde, fecha_hasta)
+    asunto = f"Reporte de Visitas {fecha_desde} al {fecha_hasta}"
+    enviados = sin_correo = en_cola = 0
+    
+    with SesionSMTP() as smtp:
+        # Conectar antes de empezar: con credenciales malas no tiene sentido
+        # generar (ni encolar) 400 reportes
+        try:
+            smtp.conectar()
+        except Exception as e:
+            print(f"CORREO ERROR Masivo: {e}")
+            return False, mensaje_error_correo(e)
+        
+        for i, cliente in enumerate(clientes, 1):
+            if not cliente['correo']:
+                sin_correo += 1
+            else:
+                html = ''.join(reporte_cliente(cliente, fecha_desde, fecha_hasta))
+                ok, msg = enviar_correo(cliente['correo'], asunto, html, sesion=smtp)
+                if ok:
+                    enviados += 1
+                else:
+                    encolar_correo(cliente['correo'], asunto, html)
+                    en_cola += 1
+                if pausa and i < len(clientes):
+                    time.sleep(pausa)
+            if al_avanzar:
+                al_avanzar(i, len(clientes))
+    
+    mensaje = f"{enviados} reportes enviados"
+    if sin_correo:
+        mensaje += f", {sin_correo} clientes sin correo"
+    if en_cola:
+        mensaje += f", {en_cola} en cola de reintento"
+    print(f"CORREO: Envío masivo {fecha_desde} al {fecha_hasta}: {mensaje}")
+    return True, mensaje
+
+# ============== PLANTILLAS HTML ==============
+
+# Las plantillas se parten una sola vez al importar en trozos fijos y nombres
+# de campo ($campo); generar un documento solo concatena trozos y valores
+# escapados, sin volver a formatear el CSS ni el esqueleto. Los reportes se
+# arman con una lista de trozos y un único join (lineal en la cantidad de visitas)
+
+class Html(str):
+    """Texto que ya es HTML: se inserta en una plantilla sin escapar"""
+
+class Plantilla:
+    """HTML con marcadores $campo; los valores se escapan al insertarlos
+    salvo que sean Html"""
+    _MARCADOR = re.compile(r'\$(\w+)')
+    
+    def __init__(self, texto):
+        trozos = self._MARCADOR.split(texto)
+        self.fijos = trozos[0::2]
+        self.campos = trozos[1::2]
+    
+    def agregar(self, salida, valores):
+        """Agrega los trozos del documento a la lista salida"""
+        salida.append(self.fijos[0])
+        for campo, fijo in zip(self.campos, self.fijos[1:]):
+            valor = valores[campo]
+            if not isinstance(valor, Html):
+                valor = escape('' if valor is None else str(valor))
+            salida.append(valor)
+            salida.append(fijo)
     
-    return f"""
+    def render(self, **valores):
+        salida = []
+        self.agregar(salida, valores)
+        return Html(''.join(salida))
+
+BOLETA = Plantilla("""
     <!DOCTYPE html>
     <html>
     <head>
         <meta charset="UTF-8">
         <style>
-            body {{ font-family: Arial, sans-serif; margin: 0; padding: 20px; background: #f5f5f5; }}
-            .boleta {{ max-width: 600px; margin: 0 auto; background: white; border-radius: 10px; overflow: hidden; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
-            .header {{ background: #2196f3; color: white; padding: 20px; text-align: center; }}
-            .header h1 {{ margin: 0; font-size: 24px; }}
-            .content {{ padding: 0; }}
-            table {{ width: 100%; border-collapse: collapse; }}
-            td {{ padding: 15px; border-bottom: 1px solid #eee; }}
-            .label {{ color: #666; font-size: 12px; text-transform: uppercase; }}
-            .value {{ font-size: 16px; color: #333; margin-top: 5px; }}
-            .trabajo {{ background: #f9f9f9; }}
-            .footer {{ text-align: center; padding: 15px; color: #999; font-size: 12px; }}
+            body { font-family: Arial, sans-serif; margin: 0; padding: 20px; background: #f5f5f5; }
+            .boleta { max-width: 600px; margin: 0 auto; background: white; border-radius: 10px; overflow: hidden; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }
+            .header { background: #2196f3; color: white; padding: 20px; text-align: center; }
+            .header h1 { margin: 0; font-size: 24px; }
+            .content { padding: 0; }
+            table { width: 100%; border-collapse: collapse; }
+            td { padding: 15px; border-bottom: 1px solid #eee; }
+            .label { color: #666; font-size: 12px; text-transform: uppercase; }
+            .value { font-size: 16px; color: #333; margin-top: 5px; }
+            .trabajo { background: #f9f9f9; }
+            .footer { text-align: center; padding: 15px; color: #999; font-size: 12px; }
         </style>
     </head>
     <body>
@@ -112,36 +318,31 @@ def generar_html_boleta(visita):
                     <tr>
                         <td style="width: 50%;">
                             <div class="label">Cliente</div>
-                            <div class="value">{visita['cliente_nombre']}</div>
+                            <div class="value">$cliente_nombre</div>
                         </td>
                         <td>
                             <div class="label">Fecha</div>
-                            <div class="value">{visita['fecha']}</div>
+                            <div class="value">$fecha</div>
                         </td>
                     </tr>
                     <tr>
                         <td>
                             <div class="label">Técnico</div>
-                            <div class="value">{visita['soportista_nombre']}</div>
+                            <div class="value">$soportista_nombre</div>
                         </td>
                         <td>
                             <div class="label">Hora / Duración</div>
-                            <div class="value">{visita['hora_inicio']} - {formatear_duracion(visita['duracion_minutos'])}</div>
+                            <div class="value">$hora_inicio - $duracion</div>
                         </td>
                     </tr>
-                    {f'''<tr>
-                        <td colspan="2">
-                            <div class="label">Persona Atendida</div>
-                            <div class="value">{visita['persona_atendida']}</div>
-                        </td>
-                    </tr>''' if visita.get('persona_atendida') else ''}
+                    $persona_html
                     <tr class="trabajo">
                         <td colspan="2">
                             <div class="label">Trabajo Realizado</div>
-                            <div class="value">{visita['trabajo_realizado']}</div>
+                            <div class="value">$trabajo_realizado</div>
                         </td>
                     </tr>
-                    {pendiente_html}
+                    $pendiente_html
                 </table>
             </div>
             <div class="footer">
@@ -150,57 +351,58 @@ def generar_html_boleta(visita):
         </div>
     </body>
     </html>
-    """
+    """)
 
-def generar_html_reporte(cliente, visitas, fecha_desde, fecha_hasta, tiempo_total):
-    """Genera HTML de reporte de visitas"""
-    filas_html = ""
-    for v in visitas:
-        pendiente = "⚠️" if v['tiene_pendiente'] and not v.get('pendiente_resuelto') else ""
-        filas_html += f"""
+BOLETA_PERSONA = Plantilla("""<tr>
+                        <td colspan="2">
+                            <div class="label">Persona Atendida</div>
+                            <div class="value">$persona_atendida</div>
+                        </td>
+                    </tr>""")
+
+BOLETA_PENDIENTE = Plantilla("""
         <tr>
-            <td style="padding: 10px; border-bottom: 1px solid #eee;">{v['fecha']}</td>
-            <td style="padding: 10px; border-bottom: 1px solid #eee;">{v['hora_inicio']}</td>
-            <td style="padding: 10px; border-bottom: 1px solid #eee;">{formatear_duracion(v['duracion_minutos'])}</td>
-            <td style="padding: 10px; border-bottom: 1px solid #eee;">{v['soportista_nombre']}</td>
-            <td style="padding: 10px; border-bottom: 1px solid #eee;">{v['trabajo_realizado'][:50]}... {pendiente}</td>
+            <td style="padding: 10px; background: #fff3cd; border-bottom: 1px solid #ddd;">
+                <strong>Pendiente:</strong> $estado<br>
+                $descripcion
+            </td>
         </tr>
-        """
-    
-    return f"""
+        """)
+
+REPORTE_INICIO = Plantilla("""
     <!DOCTYPE html>
     <html>
     <head>
         <meta charset="UTF-8">
         <style>
-            body {{ font-family: Arial, sans-serif; margin: 0; padding: 20px; background: #f5f5f5; }}
-            .reporte {{ max-width: 800px; margin: 0 auto; background: white; border-radius: 10px; overflow: hidden; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }}
-            .header {{ background: #2196f3; color: white; padding: 20px; }}
-            .header h1 {{ margin: 0 0 10px 0; font-size: 24px; }}
-            .header p {{ margin: 0; opacity: 0.9; }}
-            .summary {{ background: #e3f2fd; padding: 15px 20px; display: flex; justify-content: space-between; }}
-            .summary-item {{ text-align: center; }}
-            .summary-value {{ font-size: 24px; font-weight: bold; color: #1976d2; }}
-            .summary-label {{ font-size: 12px; color: #666; }}
-            table {{ width: 100%; border-collapse: collapse; }}
-            th {{ background: #f5f5f5; padding: 12px; text-align: left; font-size: 12px; text-transform: uppercase; color: #666; }}
-            .footer {{ text-align: center; padding: 15px; color: #999; font-size: 12px; }}
+            body { font-family: Arial, sans-serif; margin: 0; padding: 20px; background: #f5f5f5; }
+            .reporte { max-width: 800px; margin: 0 auto; background: white; border-radius: 10px; overflow: hidden; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }
+            .header { background: #2196f3; color: white; padding: 20px; }
+            .header h1 { margin: 0 0 10px 0; font-size: 24px; }
+            .header p { margin: 0; opacity: 0.9; }
+            .summary { background: #e3f2fd; padding: 15px 20px; display: flex; justify-content: space-between; }
+            .summary-item { text-align: center; }
+            .summary-value { font-size: 24px; font-weight: bold; color: #1976d2; }
+            .summary-label { font-size: 12px; color: #666; }
+            table { width: 100%; border-collapse: collapse; }
+            th { background: #f5f5f5; padding: 12px; text-align: left; font-size: 12px; text-transform: uppercase; color: #666; }
+            .footer { text-align: center; padding: 15px; color: #999; font-size: 12px; }
         </style>
     </head>
     <body>
         <div class="reporte">
             <div class="header">
                 <h1>📊 Reporte de Visitas</h1>
-                <p><strong>{cliente['nombre']}</strong></p>
-                <p>Período: {fecha_desde} al {fecha_hasta}</p>
+                <p><strong>$cliente_nombre</strong></p>
+                <p>Período: $periodo</p>
             </div>
             <div class="summary">
                 <div class="summary-item">
-                    <div class="summary-value">{len(visitas)}</div>
+                    <div class="summary-value">$cantidad</div>
                     <div class="summary-label">Visitas</div>
                 </div>
                 <div class="summary-item">
-                    <div class="summary-value">{formatear_duracion(tiempo_total)}</div>
+                    <div class="summary-value">$tiempo_total</div>
                     <div class="summary-label">Tiempo Total</div>
                 </div>
             </div>
@@ -215,7 +417,19 @@ def generar_html_reporte(cliente, visitas, fecha_desde, fecha_hasta, tiempo_tota
                     </tr>
                 </thead>
                 <tbody>
-                    {filas_html}
+                    """)
+
+REPORTE_FILA = Plantilla("""
+        <tr>
+            <td style="padding: 10px; border-bottom: 1px solid #eee;">$fecha</td>
+            <td style="padding: 10px; border-bottom: 1px solid #eee;">$hora_inicio</td>
+            <td style="padding: 10px; border-bottom: 1px solid #eee;">$duracion</td>
+            <td style="padding: 10px; border-bottom: 1px solid #eee;">$soportista_nombre</td>
+            <td style="padding: 10px; border-bottom: 1px solid #eee;">$trabajo... $pendiente</td>
+        </tr>
+        """)
+
+REPORTE_FIN = Plantilla("""
                 </tbody>
             </table>
             <div class="footer">
@@ -224,65 +438,32 @@ def generar_html_reporte(cliente, visitas, fecha_desde, fecha_hasta, tiempo_tota
         </div>
     </body>
     </html>
-    """
+    """)
 
-def generar_html_reporte_imprimible(cliente, visitas, fecha_desde, fecha_hasta, tiempo_total):
-    """Genera HTML de reporte optimizado para imprimir/PDF"""
-    filas_html = ""
-    for i, v in enumerate(visitas):
-        pendiente_html = ""
-        if v['tiene_pendiente'] and not v.get('pendiente_resuelto'):
-            pendiente_html = f'<div style="background:#fff3cd;padding:8px 12px;border-radius:5px;margin-top:8px;font-size:12px;border-left:4px solid #ff9800;">⚠️ PENDIENTE: {v.get("descripcion_pendiente", "")}</div>'
-        
-        persona_atendida = v.get('persona_atendida', '').strip() if v.get('persona_atendida') else ""
-        persona_html = f'<span style="margin-right:20px;">👤 Atendido: {persona_atendida}</span>' if persona_atendida else ""
-        
-        bg_color = "#f9f9f9" if i % 2 == 0 else "#ffffff"
-        
-        filas_html += f"""
-        <div style="background:{bg_color};padding:15px;margin-bottom:10px;border-radius:8px;border:1px solid #eee;">
-            <div style="display:flex;justify-content:space-between;align-items:center;margin-bottom:10px;">
-                <div>
-                    <span style="background:#2196f3;color:white;padding:4px 10px;border-radius:5px;font-weight:bold;font-size:14px;">Boleta #{v['id']}</span>
-                    <span style="font-weight:bold;color:#333;font-size:16px;margin-left:10px;">{v['fecha']}</span>
-                </div>
-                <span style="color:#666;">🕐 {v['hora_inicio']} | ⏱️ {formatear_duracion(v['duracion_minutos'])}</span>
-            </div>
-            <div style="color:#666;font-size:13px;margin-bottom:10px;">
-                {persona_html}👷 Técnico: {v['soportista_nombre']}
-            </div>
-            <div style="background:#f5f5f5;padding:12px;border-radius:5px;font-size:14px;line-height:1.5;">{v['trabajo_realizado']}</div>
-            {pendiente_html}
-        </div>
-        """
-    
-    from datetime import datetime
-    fecha_generacion = datetime.now().strftime('%Y-%m-%d %H:%M')
-    
-    return f"""<!DOCTYPE html>
+IMPRIMIBLE_INICIO = Plantilla("""<!DOCTYPE html>
 <html>
 <head>
     <meta charset="UTF-8">
-    <title>Reporte - {cliente['nombre']}</title>
+    <title>Reporte - $cliente_nombre</title>
     <style>
-        * {{ margin: 0; padding: 0; box-sizing: border-box; }}
-        body {{ font-family: Arial, sans-serif; padding: 20px; background: white; }}
-        @media print {{
-            body {{ padding: 0; }}
-            .no-print {{ display: none; }}
-        }}
-        .header {{ background: linear-gradient(135deg, #2196f3, #1976d2); color: white; padding: 25px; border-radius: 10px; margin-bottom: 20px; }}
-        .header h1 {{ font-size: 24px; margin-bottom: 10px; }}
-        .header p {{ opacity: 0.9; }}
-        .summary {{ display: flex; justify-content: space-around; background: #e3f2fd; padding: 20px; border-radius: 10px; margin-bottom: 20px; }}
-        .summary-item {{ text-align: center; }}
-        .summary-value {{ font-size: 32px; font-weight: bold; color: #1976d2; }}
-        .summary-label {{ font-size: 14px; color: #666; }}
-        .visitas {{ margin-bottom: 20px; }}
-        .footer {{ text-align: center; color: #999; font-size: 12px; padding: 15px; border-top: 1px solid #eee; }}
-        .btn-print {{ background: #4caf50; color: white; border: none; padding: 12px 25px; border-radius: 5px; cursor: pointer; font-size: 16px; margin-right: 10px; }}
-        .btn-print:hover {{ background: #43a047; }}
-        .actions {{ text-align: center; margin-bottom: 20px; }}
+        * { margin: 0; padding: 0; box-sizing: border-box; }
+        body { font-family: Arial, sans-serif; padding: 20px; background: white; }
+        @media print {
+            body { padding: 0; }
+            .no-print { display: none; }
+        }
+        .header { background: linear-gradient(135deg, #2196f3, #1976d2); color: white; padding: 25px; border-radius: 10px; margin-bottom: 20px; }
+        .header h1 { font-size: 24px; margin-bottom: 10px; }
+        .header p { opacity: 0.9; }
+        .summary { display: flex; justify-content: space-around; background: #e3f2fd; padding: 20px; border-radius: 10px; margin-bottom: 20px; }
+        .summary-item { text-align: center; }
+        .summary-value { font-size: 32px; font-weight: bold; color: #1976d2; }
+        .summary-label { font-size: 14px; color: #666; }
+        .visitas { margin-bottom: 20px; }
+        .footer { text-align: center; color: #999; font-size: 12px; padding: 15px; border-top: 1px solid #eee; }
+        .btn-print { background: #4caf50; color: white; border: none; padding: 12px 25px; border-radius: 5px; cursor: pointer; font-size: 16px; margin-right: 10px; }
+        .btn-print:hover { background: #43a047; }
+        .actions { text-align: center; margin-bottom: 20px; }
     </style>
 </head>
 <body>
@@ -294,28 +475,286 @@ def generar_html_reporte_imprimible(cliente, visitas, fecha_desde, fecha_hasta,
     <div class="header">
         <h1>📋 PcGraf-Soporte</h1>
         <h2>Reporte de Visitas</h2>
-        <p><strong>Cliente:</strong> {cliente['nombre']}</p>
-        <p><strong>Período:</strong> {fecha_desde} al {fecha_hasta}</p>
+        <p><strong>Cliente:</strong> $cliente_nombre</p>
+        <p><strong>Período:</strong> $periodo</p>
     </div>
     
     <div class="summary">
         <div class="summary-item">
-            <div class="summary-value">{len(visitas)}</div>
+            <div class="summary-value">$cantidad</div>
             <div class="summary-label">Total Visitas</div>
         </div>
         <div class="summary-item">
-            <div class="summary-value">{formatear_duracion(tiempo_total)}</div>
+            <div class="summary-value">$tiempo_total</div>
             <div class="summary-label">Tiempo Total</div>
         </div>
     </div>
     
     <div class="visitas">
-        {filas_html}
+        """)
+
+IMPRIMIBLE_FILA = Plantilla("""
+        <div style="background:$fondo;padding:15px;margin-bottom:10px;border-radius:8px;border:1px solid #eee;">
+            <div style="display:flex;justify-content:space-between;align-items:center;margin-bottom:10px;">
+                <div>
+                    <span style="background:#2196f3;color:white;padding:4px 10px;border-radius:5px;font-weight:bold;font-size:14px;">Boleta #$id</span>
+                    <span style="font-weight:bold;color:#333;font-size:16px;margin-left:10px;">$fecha</span>
+                </div>
+                <span style="color:#666;">🕐 $hora_inicio | ⏱️ $duracion</span>
+            </div>
+            <div style="color:#666;font-size:13px;margin-bottom:10px;">
+                $persona_html👷 Técnico: $soportista_nombre
+            </div>
+            <div style="background:#f5f5f5;padding:12px;border-radius:5px;font-size:14px;line-height:1.5;">$trabajo_realizado</div>
+            $pendiente_html
+        </div>
+        """)
+
+IMPRIMIBLE_PERSONA = Plantilla('<span style="margin-right:20px;">👤 Atendido: $persona</span>')
+
+IMPRIMIBLE_PENDIENTE = Plantilla('<div style="background:#fff3cd;padding:8px 12px;border-radius:5px;margin-top:8px;font-size:12px;border-left:4px solid #ff9800;">⚠️ PENDIENTE: $descripcion</div>')
+
+IMPRIMIBLE_FIN = Plantilla("""
     </div>
     
     <div class="footer">
-        Reporte generado el {fecha_generacion} - PcGraf-Soporte
+        Reporte generado el $fecha_generacion - PcGraf-Soporte
     </div>
 </body>
-</html>"""
+</html>""")
+
+_VACIO = Html('')
+
+def generar_html_boleta(visita):
+    """Genera HTML de una boleta de visita"""
+    pendiente_html = _VACIO
+    if visita['tiene_pendiente']:
+        pendiente_html = BOLETA_PENDIENTE.render(
+            estado="✅ Resuelto" if visita.get('pendiente_resuelto') else "⚠️ Pendiente",
+            descripcion=visita.get('descripcion_pendiente'))
+    persona_html = _VACIO
+    if visita.get('persona_atendida'):
+        persona_html = BOLETA_PERSONA.render(persona_atendida=visita['persona_atendida'])
+    
+    return BOLETA.render(
+        cliente_nombre=visita['cliente_nombre'],
+        fecha=visita['fecha'],
+        soportista_nombre=visita['soportista_nombre'],
+        hora_inicio=visita['hora_inicio'],
+        duracion=formatear_duracion(visita['duracion_minutos']),
+        persona_html=persona_html,
+        trabajo_realizado=visita['trabajo_realizado'],
+        pendiente_html=pendiente_html,
+    )
+
+# Los reportes se generan en trozos (partes_*): cada uno junta hasta LOTE_FILAS
+# visitas, así se pueden ir escribiendo a un archivo, una respuesta HTTP o el
+# cuerpo de un correo mientras se leen las visitas con iterar_visitas_cliente,
+# sin tener el período completo en memoria. generar_* los une en un texto.
+LOTE_FILAS = 200
+
+def texto_periodo(fecha_desde, fecha_hasta):
+    """Período del encabezado; sin fechas el reporte abarca todo el historial"""
+    if fecha_desde and fecha_hasta:
+        return f"{fecha_desde} al {fecha_hasta}"
+    if fecha_desde:
+        return f"desde {fecha_desde}"
+    if fecha_hasta:
+        return f"hasta {fecha_hasta}"
+    return "todo el historial"
+
+def reporte_cliente(cliente, fecha_desde, fecha_hasta, formato='html'):
+    """Trozos del reporte de un cliente (dict con id y nombre) leyendo las visitas
+    de a lote desde la base. formato: 'html' (correo), 'imprimible' o 'texto'"""
+    totales = obtener_totales_visitas_cliente(cliente['id'], fecha_desde, fecha_hasta)
+    visitas = iterar_visitas_cliente(cliente['id'], fecha_desde, fecha_hasta)
+    partes = {'html': partes_html_reporte, 'imprimible': partes_html_reporte_imprimible,
+              'texto': partes_texto_reporte}[formato]
+    return partes(cliente, visitas, fecha_desde, fecha_hasta, totales['visitas'], totales['minutos'])
+
+def generar_html_reporte(cliente, visitas, fecha_desde, fecha_hasta, tiempo_total):
+    """Genera HTML de reporte de visitas"""
+    return Html(''.join(partes_html_reporte(cliente, visitas, fecha_desde, fecha_hasta, len(visitas), tiempo_total)))
+
+def partes_html_reporte(cliente, visitas, fecha_desde, fecha_hasta, cantidad, tiempo_total):
+    """HTML del reporte en trozos; visitas puede ser cualquier iterable"""
+    salida = []
+    REPORTE_INICIO.agregar(salida, {
+        'cliente_nombre': cliente['nombre'], 'periodo': texto_periodo(fecha_desde, fecha_hasta),
+        'cantidad': cantidad, 'tiempo_total': formatear_duracion(tiempo_total),
+    })
+    for i, v in enumerate(visitas, 1):
+        REPORTE_FILA.agregar(salida, {
+            'fecha': v['fecha'],
+            'hora_inicio': v['hora_inicio'],
+            'duracion': formatear_duracion(v['duracion_minutos']),
+            'soportista_nombre': v['soportista_nombre'],
+            'trabajo': v['trabajo_realizado'][:50],
+            'pendiente': "⚠️" if v['tiene_pendiente'] and not v.get('pendiente_resuelto') else "",
+        })
+        if i % LOTE_FILAS == 0:
+            yield ''.join(salida)
+            salida.clear()
+    REPORTE_FIN.agregar(salida, {})
+    yield ''.join(salida)
+
+def generar_html_reporte_imprimible(cliente, visitas, fecha_desde, fecha_hasta, tiempo_total):
+    """Genera HTML de reporte optimizado para imprimir/PDF"""
+    return Html(''.join(partes_html_reporte_imprimible(cliente, visitas, fecha_desde, fecha_hasta, len(visitas), tiempo_total)))
+
+def partes_html_reporte_imprimible(cliente, visitas, fecha_desde, fecha_hasta, cantidad, tiempo_total):
+    """HTML imprimible del reporte en trozos; visitas puede ser cualquier iterable"""
+    salida = []
+    IMPRIMIBLE_INICIO.agregar(salida, {
+        'cliente_nombre': cliente['nombre'], 'periodo': texto_periodo(fecha_desde, fecha_hasta),
+        'cantidad': cantidad, 'tiempo_total': formatear_duracion(tiempo_total),
+    })
+    for i, v in enumerate(visitas):
+        pendiente_html = _VACIO
+        if v['tiene_pendiente'] and not v.get('pendiente_resuelto'):
+            pendiente_html = IMPRIMIBLE_PENDIENTE.render(descripcion=v.get('descripcion_pendiente'))
+        persona_atendida = (v.get('persona_atendida') or '').strip()
+        persona_html = IMPRIMIBLE_PERSONA.render(persona=persona_atendida) if persona_atendida else _VACIO
+        
+        IMPRIMIBLE_FILA.agregar(salida, {
+            'fondo': "#f9f9f9" if i % 2 == 0 else "#ffffff",
+            'id': v['id'],
+            'fecha': v['fecha'],
+            'hora_inicio': v['hora_inicio'],
+            'duracion': formatear_duracion(v['duracion_minutos']),
+            'persona_html': persona_html,
+            'soportista_nombre': v['soportista_nombre'],
+            'trabajo_realizado': v['trabajo_realizado'],
+            'pendiente_html': pendiente_html,
+        })
+        if (i + 1) % LOTE_FILAS == 0:
+            yield ''.join(salida)
+            salida.clear()
+    IMPRIMIBLE_FIN.agregar(salida, {'fecha_generacion': datetime.now().strftime('%Y-%m-%d %H:%M')})
+    yield ''.join(salida)
+
+def partes_texto_reporte(cliente, visitas, fecha_desde, fecha_hasta, cantidad, tiempo_total):
+    """Reporte en texto plano (con el trabajo completo de cada boleta) en trozos"""
+    lineas = [
+        "REPORTE DE VISITAS",
+        f"Cliente: {cliente['nombre']}",
+        f"Período: {texto_periodo(fecha_desde, fecha_hasta)}",
+        f"Total: {cantidad} visitas | {formatear_duracion(tiempo_total)}",
+        "",
+    ]
+    for i, v in enumerate(visitas, 1):
+        lineas.append("---")
+        lineas.append(f"Boleta #{v.get('id')} | {v.get('fecha')} {v.get('hora_inicio')}")
+        lineas.append(f"Duración: {formatear_duracion(v.get('duracion_minutos', 0))}")
+        lineas.append(f"Técnico: {v.get('soportista_nombre', '')}")
+        lineas.append(f"Trabajo: {v.get('trabajo_realizado', '')}")
+        if i % LOTE_FILAS == 0:
+            yield "\n".join(lineas) + "\n"
+            lineas.clear()
+    yield "\n".join(lineas)
+
+# ============== CACHÉ DE REPORTES ==============
+
+# En la revisión de fin de mes se abren una y otra vez las mismas boletas y
+# reportes. Se guardan ya generados en memoria (LRU acotada por cantidad y por
+# tamaño) junto con la versión de datos del cliente; si se guardó una visita o
+# se resolvió un pendiente de ese cliente, la versión cambia y se regeneran.
+# La versión solo ve lo que se guarda en este proceso: una visita cargada desde
+# otra instancia de la app tarda como máximo CACHE_REPORTES_TTL en aparecer.
+CACHE_REPORTES_MAX = int(os.environ.get('CACHE_REPORTES_MAX', '64'))
+CACHE_REPORTES_MB = float(os.environ.get('CACHE_REPORTES_MB', '32'))
+CACHE_REPORTES_TTL = float(os.environ.get('CACHE_REPORTES_TTL', '300'))
+
+_reportes = OrderedDict()  # clave -> (cliente_id, versión, time.monotonic(), texto)
+_reportes_tamano = 0  # caracteres guardados
+_reportes_lock = threading.Lock()
+_reportes_contadores = {'aciertos': 0, 'fallos': 0}
+
+def _leer_reporte(clave):
+    """Texto guardado para la clave si sigue vigente (None si no)"""
+    with _reportes_lock:
+        entrada = _reportes.get(clave)
+        if (entrada and entrada[1] == version_datos_cliente(entrada[0])
+                and time.monotonic() - entrada[2] < CACHE_REPORTES_TTL):
+            _reportes.move_to_end(clave)
+            _reportes_contadores['aciertos'] += 1
+            return entrada[3]
+        _reportes_contadores['fallos'] += 1
+        return None
+
+def _guardar_reporte(clave, cliente_id, version_antes, texto):
+    global _reportes_tamano
+    with _reportes_lock:
+        # Si cambió algún dato mientras se generaba, no guardar algo que puede estar viejo
+        if version_datos() != version_antes or len(texto) > CACHE_REPORTES_MB * 1024 * 1024:
+            return
+        anterior = _reportes.pop(clave, None)
+        if anterior:
+            _reportes_tamano -= len(anterior[3])
+        _reportes[clave] = (cliente_id, version_datos_cliente(cliente_id), time.monotonic(), texto)
+        _reportes_tamano += len(texto)
+        while len(_reportes) > CACHE_REPORTES_MAX or _reportes_tamano > CACHE_REPORTES_MB * 1024 * 1024:
+            _, descartada = _reportes.popitem(last=False)
+            _reportes_tamano -= len(descartada[3])
+
+def _reporte_cacheado(clave, generar):
+    """Devuelve el texto de la caché o lo arma con generar() -> (cliente_id, texto)"""
+    texto = _leer_reporte(clave)
+    if texto is not None:
+        return texto
+    version_antes = version_datos()
+    cliente_id, texto = generar()
+    if texto is not None:
+        _guardar_reporte(clave, cliente_id, version_antes, texto)
+    return texto
+
+def _clave_reporte(cliente, fecha_desde, fecha_hasta, formato):
+    # El nombre va en la clave: un reporte nunca se sirve con el nombre de otro cliente
+    return ('reporte', formato, cliente['id'], cliente['nombre'], fecha_desde, fecha_hasta)
+
+def reporte_cliente_cacheado(cliente, fecha_desde, fecha_hasta, formato='html'):
+    """Reporte completo de reporte_cliente(), desde la caché si los datos no cambiaron"""
+    return _reporte_cacheado(
+        _clave_reporte(cliente, fecha_desde, fecha_hasta, formato),
+        lambda: (cliente['id'], Html(''.join(reporte_cliente(cliente, fecha_desde, fecha_hasta, formato))))
+    )
+
+def partes_reporte_cacheado(cliente, fecha_desde, fecha_hasta, formato='html'):
+    """Como reporte_cliente_cacheado pero sin juntar el reporte si no está en la
+    caché. Devuelve (texto, None) si está, o (None, trozos): los trozos se generan
+    leyendo las visitas de a lote y, al terminar, el reporte queda en la caché si
+    entra en CACHE_REPORTES_MB (más grande no se junta nunca entero)"""
+    clave = _clave_reporte(cliente, fecha_desde, fecha_hasta, formato)
+    texto = _leer_reporte(clave)
+    if texto is not None:
+        return texto, None
+    return None, _partes_y_guardar(clave, cliente, fecha_desde, fecha_hasta, formato)
+
+def _partes_y_guardar(clave, cliente, fecha_desde, fecha_hasta, formato):
+    version_antes = version_datos()
+    tope = CACHE_REPORTES_MB * 1024 * 1024
+    guardadas, tamano = [], 0
+    for parte in reporte_cliente(cliente, fecha_desde, fecha_hasta, formato):
+        yield parte
+        if guardadas is not None:
+            tamano += len(parte)
+            if tamano > tope:
+                guardadas = None
+            else:
+                guardadas.append(parte)
+    if guardadas is not None:
+        _guardar_reporte(clave, cliente['id'], version_antes, Html(''.join(guardadas)))
+
+def boleta_cacheada(visita_id):
+    """HTML de la boleta de una visita (None si no existe), desde la caché si no cambió"""
+    def generar():
+        visita = obtener_visita(visita_id)
+        if not visita:
+            return None, None
+        return visita['cliente_id'], generar_html_boleta(visita)
+    return _reporte_cacheado(('boleta', visita_id), generar)
 
+def estadisticas_cache_reportes():
+    """Contadores de aciertos/fallos, entradas y tamaño (caracteres) actuales"""
+    with _reportes_lock:
+        return dict(_reportes_contadores, entradas=len(_reportes), tamano=_reportes_tamano)
@@ -2,7 +2,16 @@
 Base de datos PostgreSQL/SQLite para App Soporte
 Usa PostgreSQL en Railway, SQLite en desarrollo local
 """
+import atexit
 import os
+import queue
+import re
+import sys
+import threading
+import time
+from collections.abc import Mapping
+from contextlib import contextmanager
+from functools import lru_cache
 from datetime import datetime, date
 
 # Detectar si estamos en Railway (tiene DATABASE_URL)
@@ -12,191 +21,1083 @@ if DATABASE_URL:
     # PostgreSQL en Railway
     import psycopg2
     from psycopg2.extras import RealDictCursor
+    from psycopg2.pool import ThreadedConnectionPool
+    from psycopg2.extensions import connection as _connection
+    from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
     USE_POSTGRES = True
     print("📦 Usando PostgreSQL")
 else:
     # SQLite local
     import sqlite3
     USE_POSTGRES = False
-    DB_PATH = 'soporte.db'
+    from pathlib import Path
+    DB_PATH = os.environ.get('SQLITE_PATH', 'soporte.db')
     print("📦 Usando SQLite local")
 
-def get_connection():
-    """Obtiene conexión a la base de datos"""
+# ============== POOL DE CONEXIONES ==============
+
+# Tamaño del pool (PostgreSQL) y segundos de inactividad antes de verificar con SELECT 1
+POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+POOL_MAX = int(os.environ.get('DB_POOL_MAX', '10'))
+POOL_PING_SEGUNDOS = float(os.environ.get('DB_POOL_PING', '30'))
+POOL_ESPERA_SEGUNDOS = float(os.environ.get('DB_POOL_ESPERA', '30'))
+
+_pool = None
+_pool_lock = threading.Lock()
+_pool_semaforo = threading.BoundedSemaphore(POOL_MAX)
+_ultimo_uso = {}  # id(conn) -> time.monotonic() de la última devolución
+
+# SQLite: una sola conexión de escritura serializada con un lock y un pool de
+# conexiones de solo lectura. En WAL los lectores no se bloquean mientras se
+# escribe, así varias sesiones pueden consultar mientras otra guarda una visita.
+SQLITE_WAL = os.environ.get('SQLITE_WAL', '1') != '0'
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')  # NORMAL es seguro con WAL
+SQLITE_CACHE_MB = int(os.environ.get('SQLITE_CACHE_MB', '64'))  # por conexión
+SQLITE_MMAP_MB = int(os.environ.get('SQLITE_MMAP_MB', '256'))
+SQLITE_BUSY_MS = int(os.environ.get('SQLITE_BUSY_MS', '5000'))
+
+_escritor = None
+_escritor_lock = threading.RLock()
+_lectores = queue.LifoQueue()  # conexiones de lectura libres
+
+# Caché de sentencias compiladas de sqlite3 por conexión (por defecto 128)
+SQLITE_SENTENCIAS_CACHE = 256
+
+if USE_POSTGRES:
+    class _ConexionPostgres(_connection):
+        """Conexión del pool que recuerda si ya tiene preparadas las sentencias"""
+        preparadas = False  # True: preparadas; None: falló, no reintentar
+
+def _obtener_pool():
+    """Crea el pool de PostgreSQL la primera vez que se necesita"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(POOL_MIN, POOL_MAX, DATABASE_URL,
+                                               connection_factory=_ConexionPostgres)
+    return _pool
+
+def _conexion_sana(conn):
+    """Verifica que una conexión del pool siga utilizable"""
     if USE_POSTGRES:
-        conn = psycopg2.connect(DATABASE_URL)
-        return conn
+        if conn.closed:
+            return False
+        estado = conn.get_transaction_status()
+        if estado == TRANSACTION_STATUS_UNKNOWN:
+            return False
+        try:
+            if estado != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            # Solo hacer ping si estuvo inactiva un rato (evita un round trip por consulta)
+            if time.monotonic() - _ultimo_uso.get(id(conn), 0) > POOL_PING_SEGUNDOS:
+                cursor = conn.cursor()
+                cursor.execute('SELECT 1')
+                cursor.close()
+                conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
     else:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        return conn
+        try:
+            conn.execute('SELECT 1')
+            return True
+        except sqlite3.Error:
+            return False
 
-def execute_query(sql, params=None, fetch=True):
-    """Ejecuta una consulta y retorna resultados"""
-    conn = get_connection()
+def _aplicar_pragmas(conn):
+    """Perfil de rendimiento de SQLite (se aplica a cada conexión)"""
+    conn.execute(f'PRAGMA busy_timeout = {SQLITE_BUSY_MS}')
+    conn.execute(f'PRAGMA synchronous = {SQLITE_SYNCHRONOUS}')
+    conn.execute(f'PRAGMA cache_size = {-SQLITE_CACHE_MB * 1024}')
+    conn.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_MB * 1024 * 1024}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+
+def _abrir_escritor():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=SQLITE_SENTENCIAS_CACHE)
+    conn.row_factory = sqlite3.Row
+    # El modo WAL queda guardado en el archivo; los lectores lo heredan
+    conn.execute('PRAGMA journal_mode = ' + ('WAL' if SQLITE_WAL else 'DELETE'))
+    _aplicar_pragmas(conn)
+    return conn
+
+def _abrir_lector():
+    if DB_PATH == ':memory:':
+        # Una BD en memoria no se comparte entre conexiones
+        return None
+    uri = Path(DB_PATH).resolve().as_uri() + '?mode=ro'
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=SQLITE_SENTENCIAS_CACHE)
+    conn.row_factory = sqlite3.Row
+    _aplicar_pragmas(conn)
+    return conn
+
+def _conexion_escritura():
+    global _escritor
+    if not _escritor_lock.acquire(timeout=POOL_ESPERA_SEGUNDOS):
+        raise RuntimeError("Tiempo de espera agotado esperando la conexión de escritura")
+    try:
+        if _escritor is None or not _conexion_sana(_escritor):
+            _escritor = _abrir_escritor()
+        return _escritor
+    except Exception:
+        _escritor_lock.release()
+        raise
+
+def _conexion_lectura():
+    if not _pool_semaforo.acquire(timeout=POOL_ESPERA_SEGUNDOS):
+        raise RuntimeError("Tiempo de espera agotado esperando una conexión libre")
+    try:
+        while True:
+            try:
+                conn = _lectores.get_nowait()
+            except queue.Empty:
+                conn = _abrir_lector()
+                break
+            if _conexion_sana(conn):
+                break
+            conn.close()
+    except Exception:
+        _pool_semaforo.release()
+        raise
+    if conn is None:
+        _pool_semaforo.release()
+        return _conexion_escritura()
+    return conn
+
+def get_connection(solo_lectura=False):
+    """Obtiene conexión a la base de datos (del pool en PostgreSQL; en SQLite la de
+    escritura o una de solo lectura). Devolverla siempre con liberar_conexion()"""
+    if USE_POSTGRES:
+        if not _pool_semaforo.acquire(timeout=POOL_ESPERA_SEGUNDOS):
+            raise RuntimeError("Tiempo de espera agotado esperando una conexión libre")
+        try:
+            pool = _obtener_pool()
+            # Descartar conexiones rotas (reinicio del servidor, timeout de Railway, etc.)
+            for _ in range(POOL_MAX + 1):
+                conn = pool.getconn()
+                if _conexion_sana(conn):
+                    if PREPARAR_SENTENCIAS and _esquema_al_dia and conn.preparadas is False:
+                        _preparar_sentencias(conn)
+                    return conn
+                _ultimo_uso.pop(id(conn), None)
+                pool.putconn(conn, close=True)
+            raise RuntimeError("No se pudo obtener una conexión sana a PostgreSQL")
+        except Exception:
+            _pool_semaforo.release()
+            raise
+    elif solo_lectura:
+        return _conexion_lectura()
+    else:
+        return _conexion_escritura()
+
+def liberar_conexion(conn, descartar=False):
+    """Devuelve una conexión obtenida con get_connection()"""
+    global _escritor
+    if USE_POSTGRES:
+        try:
+            if not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            descartar = True
+        descartar = descartar or bool(conn.closed)
+        if descartar:
+            _ultimo_uso.pop(id(conn), None)
+        else:
+            _ultimo_uso[id(conn)] = time.monotonic()
+        try:
+            _obtener_pool().putconn(conn, close=descartar)
+        finally:
+            _pool_semaforo.release()
+    elif conn is _escritor:
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            if descartar:
+                conn.close()
+                _escritor = None
+        finally:
+            _escritor_lock.release()
+    else:
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            if descartar:
+                conn.close()
+            else:
+                _lectores.put(conn)
+        finally:
+            _pool_semaforo.release()
+
+@contextmanager
+def conexion(solo_lectura=False):
+    """Context manager: obtiene una conexión y la devuelve al terminar"""
+    conn = get_connection(solo_lectura)
+    try:
+        yield conn
+    finally:
+        liberar_conexion(conn)
+
+@contextmanager
+def transaccion():
+    """Context manager: varias sentencias en una sola transacción.
+    Entrega un cursor con filas accesibles por nombre; usar ejecutar() para los ?"""
+    with conexion() as conn:
+        if USE_POSTGRES:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+        else:
+            cursor = conn.cursor()
+            # Tomar el bloqueo de escritura desde el inicio (lecturas y escrituras consistentes)
+            cursor.execute('BEGIN IMMEDIATE')
+        try:
+            yield cursor
+            conn.commit()
+        finally:
+            # Si hubo error, liberar_conexion hace rollback
+            cursor.close()
+
+def ejecutar(cursor, sql, params=None):
+    """Ejecuta una sentencia (texto con ? o Sentencia) sobre un cursor de transaccion()"""
+    funcion = _funcion_llamadora()
+    sentencia = compilar(sql)
+    inicio = time.perf_counter()
+    error = True
+    try:
+        if params:
+            cursor.execute(sentencia.texto(cursor.connection), params)
+        else:
+            cursor.execute(sentencia.texto(cursor.connection))
+        error = False
+    finally:
+        _registrar_consulta(funcion, sentencia.sql, params, time.perf_counter() - inicio, cursor.rowcount, error)
+
+def cerrar_pool():
+    """Cierra todas las conexiones (al apagar el proceso)"""
+    global _pool, _escritor
+    if USE_POSTGRES:
+        with _pool_lock:
+            if _pool is not None:
+                _pool.closeall()
+                _pool = None
+                _ultimo_uso.clear()
+    else:
+        # Primero los lectores: son de solo lectura y la última conexión en
+        # cerrarse (la de escritura) es la que hace el checkpoint del WAL
+        while True:
+            try:
+                _lectores.get_nowait().close()
+            except queue.Empty:
+                break
+        # Si otro hilo la tiene tomada (p. ej. el envío de correos) no esperarlo
+        # indefinidamente: el proceso termina igual
+        if _escritor_lock.acquire(timeout=5):
+            try:
+                if _escritor is not None:
+                    _escritor.close()
+                    _escritor = None
+            finally:
+                _escritor_lock.release()
+
+# Al terminar el proceso (Flet, uvicorn, scripts): PostgreSQL libera las
+# conexiones enseguida y SQLite hace el checkpoint del WAL al cerrar
+atexit.register(cerrar_pool)
+
+# ============== SENTENCIAS ==============
+
+_ES_LECTURA = re.compile(r'\s*(SELECT|WITH)\b', re.IGNORECASE)
+
+# Las consultas fijas se registran con sentencia() y se compilan una sola vez, al
+# importar, para el motor en uso: placeholders, RETURNING id y FOR UPDATE. En
+# PostgreSQL además se preparan en el servidor (PREPARE) al tomar por primera vez
+# cada conexión del pool, así no se vuelven a planificar en cada llamada.
+# Las consultas armadas con filtros se compilan al primer uso y quedan en caché.
+# El ON CONFLICT ... DO UPDATE es igual en ambos motores (SQLite >= 3.24).
+PREPARAR_SENTENCIAS = os.environ.get('DB_PREPARAR', '1') != '0'  # 0 con PgBouncer en modo transacción
+
+SENTENCIAS = {}  # nombre -> Sentencia registrada
+_esquema_al_dia = False  # no preparar antes de que migrar() cree las tablas
+
+class Sentencia:
+    """SQL escrito con ? y compilado para el motor en uso"""
+    __slots__ = ('nombre', 'original', 'sql', 'devuelve_id', 'es_lectura', 'es_insert',
+                 'sql_preparar', 'sql_ejecutar')
+    
+    def __init__(self, sql, nombre=None, devuelve_id=False, bloquear=False):
+        # bloquear: True para FOR UPDATE, o un modificador como 'SKIP LOCKED'
+        self.nombre = nombre
+        self.original = sql
+        self.devuelve_id = devuelve_id or 'RETURNING' in sql.upper()
+        self.es_lectura = _ES_LECTURA.match(sql) is not None
+        self.es_insert = sql.lstrip().upper().startswith('INSERT')
+        self.sql_preparar = self.sql_ejecutar = None
+        if USE_POSTGRES:
+            if devuelve_id:
+                sql += ' RETURNING id'
+            if bloquear:
+                sql += ' FOR UPDATE' + ('' if bloquear is True else f' {bloquear}')
+            if nombre:
+                n = sql.count('?')
+                partes = sql.split('?')
+                self.sql_preparar = f'PREPARE {nombre} AS ' + partes[0] + ''.join(
+                    f'${i}{parte}' for i, parte in enumerate(partes[1:], 1))
+                self.sql_ejecutar = f'EXECUTE {nombre}' + (' (' + ', '.join(['%s'] * n) + ')' if n else '')
+            sql = sql.replace('?', '%s')
+        self.sql = sql
+    
+    def texto(self, conn):
+        """SQL a enviar por esta conexión (EXECUTE si la sentencia está preparada en ella)"""
+        if self.sql_ejecutar and getattr(conn, 'preparadas', False) is True:
+            return self.sql_ejecutar
+        return self.sql
+
+def sentencia(nombre, sql, devuelve_id=False, bloquear=False):
+    """Registra una consulta fija con nombre (se compila ahora, una sola vez).
+    devuelve_id: INSERT del que se quiere el id; bloquear: SELECT ... FOR UPDATE"""
+    s = SENTENCIAS[nombre] = Sentencia(sql, nombre, devuelve_id, bloquear)
+    return s
+
+@lru_cache(maxsize=512)
+def _compilar_texto(sql):
+    return Sentencia(sql)
+
+def compilar(sql):
+    """Sentencia para un texto con ? (las ya compiladas se devuelven tal cual)"""
+    return sql if isinstance(sql, Sentencia) else _compilar_texto(sql)
+
+def _preparar_sentencias(conn):
+    """PREPARE de todas las sentencias registradas en una conexión de PostgreSQL.
+    Se hace fuera de cualquier transacción y una sola vez por conexión"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute('DEALLOCATE ALL')
+        for s in SENTENCIAS.values():
+            cursor.execute(s.sql_preparar)
+        conn.commit()
+        conn.preparadas = True
+    except psycopg2.Error as e:
+        conn.rollback()
+        conn.preparadas = None
+        print(f"⚠️ No se pudieron preparar las sentencias, se usan sin preparar: {e}")
+    finally:
+        cursor.close()
+
+# ============== FILAS ==============
+
+# execute_query devuelve filas respaldadas por una tupla en vez de un dict por
+# fila: una clase por conjunto de columnas guarda los nombres una sola vez y cada
+# fila solo ocupa sus valores. Se leen igual que un dict (fila['campo'],
+# fila.get('campo'), dict(fila)) pero son inmutables; usar fila.con(campo=valor)
+# para obtener una copia con campos agregados o cambiados.
+
+class Fila(Mapping):
+    """Fila de resultado de solo lectura: se lee como un dict (columna -> valor).
+    Los valores van en una tupla y los nombres de columna una sola vez por clase"""
+    __slots__ = ('_valores',)
+    _columnas = ()
+    _indice = {}
+    
+    def __init__(self, valores):
+        self._valores = tuple(valores)
+    
+    def __getitem__(self, clave):
+        return self._valores[self._indice[clave]]
+    
+    def get(self, clave, default=None):
+        i = self._indice.get(clave)
+        return default if i is None else self._valores[i]
+    
+    def __contains__(self, clave):
+        return clave in self._indice
     
+    def __iter__(self):
+        return iter(self._columnas)
+    
+    def __len__(self):
+        return len(self._columnas)
+    
+    def con(self, **campos):
+        """Copia de la fila con campos agregados o reemplazados"""
+        valores = dict(zip(self._columnas, self._valores))
+        valores.update(campos)
+        return clase_fila(tuple(valores))(valores.values())
+    
+    def __eq__(self, otra):
+        if isinstance(otra, Fila) and otra._columnas == self._columnas:
+            return self._valores == otra._valores
+        if isinstance(otra, Mapping):
+            return dict(zip(self._columnas, self._valores)) == dict(otra.items())
+        return NotImplemented
+    
+    def __ne__(self, otra):
+        igual = self.__eq__(otra)
+        return igual if igual is NotImplemented else not igual
+    
+    # Como un dict: no se usa de clave ni en sets
+    __hash__ = None
+    
+    def __repr__(self):
+        return 'Fila(' + ', '.join(f'{c}={v!r}' for c, v in zip(self._columnas, self._valores)) + ')'
+
+_clases_fila = {}  # tupla de columnas -> subclase de Fila
+
+def clase_fila(columnas):
+    """Clase de fila para un conjunto de columnas (se crea una vez y se reutiliza)"""
+    clase = _clases_fila.get(columnas)
+    if clase is None:
+        clase = type('Fila', (Fila,), {
+            '__slots__': (),
+            '_columnas': columnas,
+            '_indice': {c: i for i, c in enumerate(columnas)},
+        })
+        clase = _clases_fila.setdefault(columnas, clase)
+    return clase
+
+def _filas(cursor, rows):
+    """Convierte las tuplas de un cursor en filas con nombre"""
+    clase = clase_fila(tuple(d[0] for d in cursor.description))
+    return list(map(clase, rows))
+
+def _una_fila(cursor):
+    """Siguiente fila de un cursor de transaccion() como Fila (None si no hay)"""
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    columnas = tuple(d[0] for d in cursor.description)
+    return clase_fila(columnas)(row[c] for c in columnas)
+
+# Consultas de "fila completa" para los guardar_*: {origen} es la tabla, o en
+# PostgreSQL el CTE con las filas que devolvió el INSERT/UPDATE ... RETURNING *
+SQL_FILA_SIMPLE = 'SELECT * FROM {origen} x'
+
+def _guardar_y_releer(cursor, tabla, sql, params, id, sql_fila):
+    """Ejecuta el INSERT/UPDATE de un guardar_* y devuelve la fila guardada sin
+    pedir otra conexión: en PostgreSQL en la misma sentencia (RETURNING *), en
+    SQLite releyendo con el mismo cursor dentro de la transacción"""
+    sql = compilar(sql)
     if USE_POSTGRES:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        # Convertir ? a %s para PostgreSQL
-        sql = sql.replace('?', '%s')
+        ejecutar(cursor, f'WITH guardada AS ({sql.original} RETURNING *) ' + sql_fila.format(origen='guardada'), params)
     else:
-        cursor = conn.cursor()
+        ejecutar(cursor, sql, params)
+        ejecutar(cursor, sql_fila.format(origen=f'(SELECT * FROM {tabla} WHERE id = ?)'),
+                 (id or cursor.lastrowid,))
+    return _una_fila(cursor)
+
+def _guardar(tabla, sql, params, id, sql_fila=None):
+    """INSERT (id None, sentencia con devuelve_id) o UPDATE de un guardar_*:
+    devuelve el id, o la fila guardada si se pasa sql_fila"""
+    if sql_fila:
+        with transaccion() as cursor:
+            return _guardar_y_releer(cursor, tabla, sql, params, id, sql_fila)
+    if id:
+        execute_query(sql, params, fetch=False)
+        return id
+    return execute_query(sql, params, fetch=False)
+
+# ============== MÉTRICAS DE CONSULTAS ==============
+
+# Cada sentencia registra su duración y filas bajo el nombre de la función que
+# la llamó. Las que superan DB_LENTA_MS se escriben en el log con la forma de
+# los parámetros (tipos y largos, nunca los valores).
+CONSULTA_LENTA_MS = float(os.environ.get('DB_LENTA_MS', '500'))
+
+# Límites superiores (ms) de los buckets del histograma; el último es infinito
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+_metricas = {}  # nombre de función -> contadores de sus sentencias
+_metricas_lock = threading.Lock()
+
+def _funcion_llamadora():
+    """Nombre de la función pública que originó la consulta (saltea los helpers
+    privados y lambdas, p. ej. _visitas_cliente cuenta como listar_visitas_cliente)"""
+    frame = sys._getframe(2)
+    while frame.f_back is not None and frame.f_code.co_name[0] in '_<':
+        frame = frame.f_back
+    return frame.f_code.co_name
+
+def _forma_parametros(params):
+    """Describe los parámetros sin exponer valores: (int, str[12], None)"""
+    if not params:
+        return '()'
+    partes = []
+    for p in params:
+        if p is None:
+            partes.append('None')
+        elif isinstance(p, (str, bytes)):
+            partes.append(f'{type(p).__name__}[{len(p)}]')
+        else:
+            partes.append(type(p).__name__)
+    return '(' + ', '.join(partes) + ')'
+
+def _registrar_consulta(funcion, sql, params, segundos, filas, error=False):
+    ms = segundos * 1000
+    with _metricas_lock:
+        m = _metricas.get(funcion)
+        if m is None:
+            m = _metricas[funcion] = {
+                'sentencias': 0, 'errores': 0, 'filas': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                'histograma': [0] * len(BUCKETS_MS),
+            }
+        m['sentencias'] += 1
+        m['errores'] += 1 if error else 0
+        m['filas'] += filas if filas and filas > 0 else 0
+        m['total_ms'] += ms
+        m['max_ms'] = max(m['max_ms'], ms)
+        for i, limite in enumerate(BUCKETS_MS):
+            if ms <= limite:
+                m['histograma'][i] += 1
+                break
+    if ms >= CONSULTA_LENTA_MS:
+        sql_log = ' '.join(sql.split())
+        print(f"🐢 Consulta lenta {ms:.0f} ms en {funcion}: {sql_log} | params {_forma_parametros(params)}")
+
+def _percentil(histograma, cantidad_total, p):
+    """Percentil aproximado: límite superior del bucket donde se alcanza p"""
+    objetivo = cantidad_total * p
+    acumulado = 0
+    for limite, cantidad in zip(BUCKETS_MS, histograma):
+        acumulado += cantidad
+        if acumulado >= objetivo:
+            return limite
+    return BUCKETS_MS[-1]
+
+def obtener_metricas():
+    """Resumen de las sentencias SQL agrupadas por la función pública que las
+    ejecutó. Todo es por sentencia, no por llamada a la función (guardar_visita
+    ejecuta varias): sentencias, errores, filas, promedio/p50/p95/máximo en ms
+    de cada sentencia e histograma {límite_ms: cantidad}"""
+    with _metricas_lock:
+        copia = {f: dict(m, histograma=list(m['histograma'])) for f, m in _metricas.items()}
+    resumen = {}
+    for funcion, m in copia.items():
+        resumen[funcion] = {
+            'sentencias': m['sentencias'],
+            'errores': m['errores'],
+            'filas': m['filas'],
+            'promedio_ms': round(m['total_ms'] / m['sentencias'], 2),
+            'p50_ms': _percentil(m['histograma'], m['sentencias'], 0.50),
+            'p95_ms': _percentil(m['histograma'], m['sentencias'], 0.95),
+            'max_ms': round(m['max_ms'], 2),
+            'histograma': dict(zip(BUCKETS_MS, m['histograma'])),
+        }
+    return resumen
+
+def reiniciar_metricas():
+    """Borra las métricas acumuladas"""
+    with _metricas_lock:
+        _metricas.clear()
+
+def execute_query(sql, params=None, fetch=True):
+    """Ejecuta una consulta (texto con ? o Sentencia) y retorna resultados"""
+    funcion = _funcion_llamadora()
+    sentencia = compilar(sql)
+    # En SQLite las lecturas van a una conexión de solo lectura
+    conn = get_connection(fetch and sentencia.es_lectura)
     
+    # Cursor de tuplas: las filas se arman con _filas() sin un dict por fila
+    cursor = conn.cursor()
+    if not USE_POSTGRES:
+        cursor.row_factory = None
+    
+    inicio = time.perf_counter()
+    filas = -1
+    error = True
     try:
         if params:
-            cursor.execute(sql, params)
+            cursor.execute(sentencia.texto(conn), params)
         else:
-            cursor.execute(sql)
+            cursor.execute(sentencia.texto(conn))
         
         if fetch:
             rows = cursor.fetchall()
-            if USE_POSTGRES:
-                return [dict(row) for row in rows]
-            else:
-                return [dict(row) for row in rows]
+            filas = len(rows)
+            error = False
+            return _filas(cursor, rows)
         else:
             conn.commit()
+            filas = cursor.rowcount
+            error = False
             if USE_POSTGRES:
                 # Para INSERT con RETURNING
-                if 'RETURNING' in sql.upper():
+                if sentencia.devuelve_id:
                     row = cursor.fetchone()
-                    return row['id'] if row else None
+                    return row[0] if row else None
                 return cursor.rowcount
             else:
-                return cursor.lastrowid
+                if sentencia.es_insert:
+                    return cursor.lastrowid
+                return cursor.rowcount
     finally:
+        _registrar_consulta(funcion, sentencia.sql, params, time.perf_counter() - inicio, filas, error)
         cursor.close()
-        conn.close()
+        liberar_conexion(conn)
 
-def init_db():
-    """Inicializa las tablas de la base de datos"""
-    conn = get_connection()
-    
+def iterar_consulta(sql, params=None, lote=500):
+    """Como execute_query pero devuelve un iterador de filas que se traen de a
+    lote (cursor del lado del servidor en PostgreSQL), para recorrer resultados
+    grandes sin tenerlos todos en memoria. La conexión queda tomada hasta
+    terminar de recorrerlo (o cerrarlo)"""
+    return _iterar_consulta(_funcion_llamadora(), compilar(sql), params, lote)
+
+def _iterar_consulta(funcion, sentencia, params, lote):
+    conn = get_connection(sentencia.es_lectura)
     if USE_POSTGRES:
+        # Cursor con nombre (DECLARE ... CURSOR): el servidor guarda el resultado
+        # y lo entrega de a lote. DECLARE no acepta EXECUTE: va el SQL compilado
+        cursor = conn.cursor(name='iterar_consulta')
+        cursor.itersize = lote
+    else:
         cursor = conn.cursor()
-        
-        # Tabla de Soportistas (crear primero por las FK)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS soportistas (
-                id SERIAL PRIMARY KEY,
-                nombre TEXT NOT NULL,
-                correo TEXT,
-                activo INTEGER DEFAULT 1,
-                fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Tabla de Clientes
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS clientes (
-                id SERIAL PRIMARY KEY,
-                nombre TEXT NOT NULL,
-                correo TEXT,
-                telefono TEXT,
-                soportista_id INTEGER REFERENCES soportistas(id),
-                activo INTEGER DEFAULT 1,
-                fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Tabla de Visitas
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS visitas (
-                id SERIAL PRIMARY KEY,
-                cliente_id INTEGER NOT NULL REFERENCES clientes(id),
-                soportista_id INTEGER NOT NULL REFERENCES soportistas(id),
-                persona_atendida TEXT,
-                fecha TEXT NOT NULL,
-                hora_inicio TEXT NOT NULL,
-                duracion_minutos INTEGER NOT NULL,
-                trabajo_realizado TEXT NOT NULL,
-                tiene_pendiente INTEGER DEFAULT 0,
-                descripcion_pendiente TEXT,
-                pendiente_resuelto INTEGER DEFAULT 0,
-                fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Tabla de Configuración
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS configuracion (
-                clave TEXT PRIMARY KEY,
-                valor TEXT
-            )
-        ''')
-        
-        conn.commit()
+        cursor.row_factory = None
+    
+    # Se mide solo el tiempo en la base (execute y cada lote), no lo que tarde
+    # quien consume el iterador (p. ej. un cliente HTTP lento)
+    segundos = 0.0
+    filas = 0
+    error = True
+    try:
+        inicio = time.perf_counter()
+        cursor.execute(sentencia.sql, params or ())
+        while True:
+            rows = cursor.fetchmany(lote)
+            segundos += time.perf_counter() - inicio
+            if not rows:
+                break
+            filas += len(rows)
+            yield from _filas(cursor, rows)
+            inicio = time.perf_counter()
+        error = False
+    except GeneratorExit:
+        # Cerrado antes de terminar (p. ej. el cliente HTTP cortó): no es error
+        error = False
+        raise
+    finally:
+        _registrar_consulta(funcion, sentencia.sql, params, segundos, filas, error)
+        cursor.close()
+        liberar_conexion(conn)
+
+# ============== ESQUEMA Y MIGRACIONES ==============
+
+# Índices secundarios. El DDL de cada migración queda escrito tal cual se
+# publicó: un índice nuevo o cambiado va en una migración nueva, nunca acá.
+# La misma sintaxis sirve para PostgreSQL y SQLite (ambos soportan índices parciales).
+INDICES_V3 = [
+    # obtener_clientes(soportista_id=...), estadísticas por soportista
+    'CREATE INDEX IF NOT EXISTS idx_clientes_soportista ON clientes (soportista_id, nombre) WHERE activo = 1',
+    # obtener_clientes() ordenado por nombre, estadísticas/sin boletas
+    'CREATE INDEX IF NOT EXISTS idx_clientes_activos_nombre ON clientes (nombre) WHERE activo = 1',
+    # obtener_visitas_cliente (reemplazado en la migración 6)
+    'CREATE INDEX IF NOT EXISTS idx_visitas_cliente_fecha ON visitas (cliente_id, fecha, hora_inicio)',
+    # obtener_clientes_sin_boletas: clientes con visitas en un rango de fechas
+    'CREATE INDEX IF NOT EXISTS idx_visitas_fecha_cliente ON visitas (fecha, cliente_id)',
+    # obtener_pendientes y contar_pendientes_total
+    'CREATE INDEX IF NOT EXISTS idx_visitas_pendientes ON visitas (pendiente_resuelto, fecha) WHERE tiene_pendiente = 1',
+    # obtener_tareas(solo_pendientes=True) ordenado por fecha/hora límite
+    'CREATE INDEX IF NOT EXISTS idx_tareas_pendientes ON tareas (fecha_limite, hora_limite, id) WHERE completada = 0',
+    # obtener_tareas(soportista_id=...)
+    'CREATE INDEX IF NOT EXISTS idx_tareas_soportista ON tareas (soportista_id, completada)',
+]
+
+INDICES_V4 = [
+    # estadísticas y clientes sin boletas por rango de fechas
+    'CREATE INDEX IF NOT EXISTS idx_visitas_diarias_fecha ON visitas_diarias (fecha, cliente_id)',
+]
+
+INDICES_V6 = [
+    # obtener_visitas_cliente paginado por (fecha, hora_inicio, id)
+    'DROP INDEX IF EXISTS idx_visitas_cliente_fecha',
+    'CREATE INDEX IF NOT EXISTS idx_visitas_cliente_fecha_id ON visitas (cliente_id, fecha, hora_inicio, id)',
+]
+
+INDICES_V7 = [
+    # tomar_correos_salientes: los que vencieron y siguen por enviar
+    "CREATE INDEX IF NOT EXISTS idx_correos_cola ON correos_salientes (proximo_intento) "
+    "WHERE estado IN ('pendiente', 'enviando')",
+]
+
+TABLAS_POSTGRES = [
+    # Tabla de Soportistas (crear primero por las FK)
+    '''
+        CREATE TABLE IF NOT EXISTS soportistas (
+            id SERIAL PRIMARY KEY,
+            nombre TEXT NOT NULL,
+            correo TEXT,
+            activo INTEGER DEFAULT 1,
+            fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''',
+    # Tabla de Clientes
+    '''
+        CREATE TABLE IF NOT EXISTS clientes (
+            id SERIAL PRIMARY KEY,
+            nombre TEXT NOT NULL,
+            correo TEXT,
+            telefono TEXT,
+            soportista_id INTEGER REFERENCES soportistas(id),
+            activo INTEGER DEFAULT 1,
+            fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''',
+    # Tabla de Visitas
+    '''
+        CREATE TABLE IF NOT EXISTS visitas (
+            id SERIAL PRIMARY KEY,
+            cliente_id INTEGER NOT NULL REFERENCES clientes(id),
+            soportista_id INTEGER NOT NULL REFERENCES soportistas(id),
+            persona_atendida TEXT,
+            fecha TEXT NOT NULL,
+            hora_inicio TEXT NOT NULL,
+            duracion_minutos INTEGER NOT NULL,
+            trabajo_realizado TEXT NOT NULL,
+            tiene_pendiente INTEGER DEFAULT 0,
+            descripcion_pendiente TEXT,
+            pendiente_resuelto INTEGER DEFAULT 0,
+            fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''',
+    # Tabla de Configuración
+    '''
+        CREATE TABLE IF NOT EXISTS configuracion (
+            clave TEXT PRIMARY KEY,
+            valor TEXT
+        )
+    ''',
+    # Tabla de Tareas/pendientes independientes
+    '''
+        CREATE TABLE IF NOT EXISTS tareas (
+            id SERIAL PRIMARY KEY,
+            soportista_id INTEGER NOT NULL REFERENCES soportistas(id),
+            cliente_id INTEGER REFERENCES clientes(id),
+            descripcion TEXT NOT NULL,
+            fecha_limite TEXT,
+            hora_limite TEXT,
+            completada INTEGER DEFAULT 0,
+            fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            fecha_completada TIMESTAMP
+        )
+    ''',
+]
+
+TABLAS_SQLITE = [
+    '''
+        CREATE TABLE IF NOT EXISTS soportistas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT NOT NULL,
+            correo TEXT,
+            activo INTEGER DEFAULT 1,
+            fecha_creacion TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''',
+    '''
+        CREATE TABLE IF NOT EXISTS clientes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT NOT NULL,
+            correo TEXT,
+            telefono TEXT,
+            soportista_id INTEGER,
+            activo INTEGER DEFAULT 1,
+            fecha_creacion TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (soportista_id) REFERENCES soportistas(id)
+        )
+    ''',
+    '''
+        CREATE TABLE IF NOT EXISTS visitas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            cliente_id INTEGER NOT NULL,
+            soportista_id INTEGER NOT NULL,
+            persona_atendida TEXT,
+            fecha TEXT NOT NULL,
+            hora_inicio TEXT NOT NULL,
+            duracion_minutos INTEGER NOT NULL,
+            trabajo_realizado TEXT NOT NULL,
+            tiene_pendiente INTEGER DEFAULT 0,
+            descripcion_pendiente TEXT,
+            pendiente_resuelto INTEGER DEFAULT 0,
+            fecha_creacion TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (cliente_id) REFERENCES clientes(id),
+            FOREIGN KEY (soportista_id) REFERENCES soportistas(id)
+        )
+    ''',
+    '''
+        CREATE TABLE IF NOT EXISTS configuracion (
+            clave TEXT PRIMARY KEY,
+            valor TEXT
+        )
+    ''',
+    '''
+        CREATE TABLE IF NOT EXISTS tareas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            soportista_id INTEGER NOT NULL,
+            cliente_id INTEGER,
+            descripcion TEXT NOT NULL,
+            fecha_limite TEXT,
+            hora_limite TEXT,
+            completada INTEGER DEFAULT 0,
+            fecha_creacion TEXT DEFAULT CURRENT_TIMESTAMP,
+            fecha_completada TEXT,
+            FOREIGN KEY (soportista_id) REFERENCES soportistas(id),
+            FOREIGN KEY (cliente_id) REFERENCES clientes(id)
+        )
+    ''',
+]
+
+def _columna_existe(cursor, tabla, columna):
+    """Indica si una tabla SQLite tiene una columna"""
+    cursor.execute(f'PRAGMA table_info({tabla})')
+    return any(fila[1] == columna for fila in cursor.fetchall())
+
+def _sqlite_soportista_en_clientes(cursor):
+    """BD SQLite antiguas: clientes se creó sin soportista_id"""
+    if not _columna_existe(cursor, 'clientes', 'soportista_id'):
+        cursor.execute('ALTER TABLE clientes ADD COLUMN soportista_id INTEGER')
+
+# Resumen diario de visitas por (cliente, fecha, soportista), mantenido por
+# guardar_visita. Las estadísticas leen de aquí en vez de agregar visitas.
+SQL_RESUMEN_DIARIO = '''
+    CREATE TABLE IF NOT EXISTS visitas_diarias (
+        cliente_id INTEGER NOT NULL,
+        fecha TEXT NOT NULL,
+        soportista_id INTEGER NOT NULL,
+        cantidad INTEGER NOT NULL DEFAULT 0,
+        minutos INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (cliente_id, fecha, soportista_id)
+    )
+'''
+
+SQL_RECALCULAR_RESUMEN_DIARIO = '''
+    INSERT INTO visitas_diarias (cliente_id, fecha, soportista_id, cantidad, minutos)
+    SELECT cliente_id, fecha, soportista_id, COUNT(*), SUM(duracion_minutos)
+    FROM visitas
+    GROUP BY cliente_id, fecha, soportista_id
+'''
+
+# Búsqueda de texto completo: FTS5 (tablas externas + triggers) en SQLite,
+# índices GIN sobre expresiones tsvector en PostgreSQL
+# ({p} = prefijo de tabla; las consultas deben repetir la misma expresión del índice)
+TSV_VISITAS = ("to_tsvector('spanish', coalesce({p}trabajo_realizado, '') || ' ' || "
+               "coalesce({p}descripcion_pendiente, '') || ' ' || coalesce({p}persona_atendida, ''))")
+TSV_TAREAS = "to_tsvector('spanish', {p}descripcion)"
+
+BUSQUEDA_POSTGRES = [
+    f"CREATE INDEX IF NOT EXISTS idx_visitas_busqueda ON visitas USING GIN ({TSV_VISITAS.format(p='')})",
+    f"CREATE INDEX IF NOT EXISTS idx_tareas_busqueda ON tareas USING GIN ({TSV_TAREAS.format(p='')})",
+]
+
+def _sql_fts_sqlite(tabla, columnas):
+    """Tabla FTS5 con contenido externo y triggers que la mantienen sincronizada"""
+    cols = ', '.join(columnas)
+    nuevos = ', '.join(f'new.{c}' for c in columnas)
+    viejos = ', '.join(f'old.{c}' for c in columnas)
+    fts = f'{tabla}_fts'
+    borrar = f"INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {viejos});"
+    insertar = f"INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {nuevos});"
+    return [
+        f'''CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({cols},
+            content='{tabla}', content_rowid='id', tokenize='unicode61 remove_diacritics 2')''',
+        f'CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {tabla} BEGIN {insertar} END',
+        f'CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {tabla} BEGIN {borrar} END',
+        f'CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {cols} ON {tabla} BEGIN {borrar} {insertar} END',
+        f"INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+    ]
+
+BUSQUEDA_SQLITE = (
+    _sql_fts_sqlite('visitas', ['trabajo_realizado', 'descripcion_pendiente', 'persona_atendida']) +
+    _sql_fts_sqlite('tareas', ['descripcion'])
+)
+
+# Migraciones en orden: (versión, descripción, PostgreSQL, SQLite).
+# Cada dialecto es una lista de sentencias o una función que recibe el cursor.
+# Nunca modificar una migración ya publicada: agregar una nueva al final.
+# Cola de correos (outbox). proximo_intento es un timestamp Unix: cuándo
+# reintentar, o mientras está 'enviando', hasta cuándo lo reserva el hilo de envío
+_SQL_CORREOS_SALIENTES = '''
+    CREATE TABLE IF NOT EXISTS correos_salientes (
+        id {id},
+        destinatario TEXT NOT NULL,
+        asunto TEXT NOT NULL,
+        cuerpo_html TEXT NOT NULL,
+        estado TEXT NOT NULL DEFAULT 'pendiente',
+        intentos INTEGER NOT NULL DEFAULT 0,
+        proximo_intento {real} NOT NULL,
+        ultimo_error TEXT,
+        fecha_creacion {fecha} DEFAULT CURRENT_TIMESTAMP,
+        fecha_enviado {fecha}
+    )
+'''
+
+MIGRACIONES = [
+    (1, 'Tablas base', TABLAS_POSTGRES, TABLAS_SQLITE),
+    (2, 'clientes.soportista_id en BD antiguas',
+     ['ALTER TABLE clientes ADD COLUMN IF NOT EXISTS soportista_id INTEGER REFERENCES soportistas(id)'],
+     _sqlite_soportista_en_clientes),
+    (3, 'Índices de consultas frecuentes',
+     INDICES_V3,
+     # SQLite no tiene autovacuum: sin ANALYZE el planificador no conoce la selectividad
+     INDICES_V3 + ['ANALYZE']),
+    (4, 'Resumen diario de visitas para estadísticas',
+     [SQL_RESUMEN_DIARIO, SQL_RECALCULAR_RESUMEN_DIARIO] + INDICES_V4,
+     [SQL_RESUMEN_DIARIO, SQL_RECALCULAR_RESUMEN_DIARIO] + INDICES_V4 + ['ANALYZE visitas_diarias']),
+    (5, 'Búsqueda de texto en visitas y tareas', BUSQUEDA_POSTGRES, BUSQUEDA_SQLITE),
+    (6, 'Índice de visitas por cliente con id para paginar', INDICES_V6, INDICES_V6),
+    (7, 'Cola de correos salientes',
+     [_SQL_CORREOS_SALIENTES.format(id='SERIAL PRIMARY KEY', real='DOUBLE PRECISION', fecha='TIMESTAMP')]
+     + INDICES_V7,
+     [_SQL_CORREOS_SALIENTES.format(id='INTEGER PRIMARY KEY AUTOINCREMENT', real='REAL', fecha='TEXT')]
+     + INDICES_V7),
+]
+
+VERSION_ESQUEMA = MIGRACIONES[-1][0]
+
+# Clave arbitraria para pg_advisory_xact_lock (evita migraciones simultáneas entre procesos)
+_LOCK_MIGRACIONES = 72410533
+
+def version_esquema():
+    """Versión actual del esquema (0 si la BD no tiene schema_version)"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('SELECT MAX(version) FROM schema_version')
+        fila = cursor.fetchone()
+        return (fila[0] if fila else None) or 0
+    except (psycopg2.Error if USE_POSTGRES else sqlite3.Error):
+        # La tabla todavía no existe
+        return 0
+    finally:
         cursor.close()
-        conn.close()
+        liberar_conexion(conn)
+
+def _aplicar_migracion(cursor, pasos):
+    if callable(pasos):
+        pasos(cursor)
     else:
-        cursor = conn.cursor()
-        
-        # SQLite - Tabla de Soportistas
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS soportistas (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                nombre TEXT NOT NULL,
-                correo TEXT,
-                activo INTEGER DEFAULT 1,
-                fecha_creacion TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Tabla de Clientes
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS clientes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                nombre TEXT NOT NULL,
-                correo TEXT,
-                telefono TEXT,
-                soportista_id INTEGER,
-                activo INTEGER DEFAULT 1,
-                fecha_creacion TEXT DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (soportista_id) REFERENCES soportistas(id)
-            )
-        ''')
-        
-        # Agregar columna soportista_id si no existe (para BD existentes)
-        try:
-            cursor.execute('ALTER TABLE clientes ADD COLUMN soportista_id INTEGER')
-        except:
-            pass
-        
-        # Tabla de Visitas
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS visitas (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                cliente_id INTEGER NOT NULL,
-                soportista_id INTEGER NOT NULL,
-                persona_atendida TEXT,
-                fecha TEXT NOT NULL,
-                hora_inicio TEXT NOT NULL,
-                duracion_minutos INTEGER NOT NULL,
-                trabajo_realizado TEXT NOT NULL,
-                tiene_pendiente INTEGER DEFAULT 0,
-                descripcion_pendiente TEXT,
-                pendiente_resuelto INTEGER DEFAULT 0,
-                fecha_creacion TEXT DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (cliente_id) REFERENCES clientes(id),
-                FOREIGN KEY (soportista_id) REFERENCES soportistas(id)
-            )
-        ''')
-        
-        # Tabla de Configuración
+        for sql in pasos:
+            cursor.execute(sql)
+
+def migrar():
+    """Aplica las migraciones pendientes. Si el esquema está al día solo hace una consulta."""
+    global _esquema_al_dia
+    if version_esquema() >= VERSION_ESQUEMA:
+        _esquema_al_dia = True
+        return
+    
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS configuracion (
-                clave TEXT PRIMARY KEY,
-                valor TEXT
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                descripcion TEXT,
+                fecha_aplicada TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
-        
         conn.commit()
-        conn.close()
+        
+        for version, descripcion, pasos_postgres, pasos_sqlite in MIGRACIONES:
+            # Cada migración en su propia transacción, releyendo la versión
+            # bajo bloqueo por si otro proceso migró mientras tanto
+            if USE_POSTGRES:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)', (_LOCK_MIGRACIONES,))
+            else:
+                cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('SELECT 1 FROM schema_version WHERE version = ' + ('%s' if USE_POSTGRES else '?'), (version,))
+            if cursor.fetchone():
+                conn.commit()
+                continue
+            
+            print(f"📦 Migración {version}: {descripcion}")
+            _aplicar_migracion(cursor, pasos_postgres if USE_POSTGRES else pasos_sqlite)
+            cursor.execute('INSERT INTO schema_version (version, descripcion) VALUES ' +
+                           ('(%s, %s)' if USE_POSTGRES else '(?, ?)'), (version, descripcion))
+            conn.commit()
+    finally:
+        cursor.close()
+        liberar_conexion(conn)
+    _esquema_al_dia = True
+
+def init_db():
+    """Inicializa las tablas de la base de datos"""
+    migrar()
+
+# ============== CACHÉ DE CATÁLOGOS ==============
+
+# Clientes y soportistas cambian pocas veces por semana pero se leen en casi
+# todas las pantallas. Se guardan en memoria (compartida entre sesiones) por
+# filtro y se invalidan al guardar/eliminar. Un alta hecha por otra instancia
+# de la app no invalida esta caché: aparece en los desplegables al vencer el TTL.
+CACHE_CATALOGOS_TTL = float(os.environ.get('CACHE_CATALOGOS_TTL', '300'))
+
+_cache_catalogos = {}  # clave de filtro -> (time.monotonic(), filas)
+_cache_lock = threading.Lock()
+_cache_generacion = 0
+_cache_contadores = {'aciertos': 0, 'fallos': 0, 'invalidaciones': 0}
+
+def _catalogo_cacheado(clave, cargar):
+    """Devuelve el catálogo de la caché o lo carga con cargar().
+    Las filas son inmutables, así que se pueden compartir entre sesiones."""
+    with _cache_lock:
+        entrada = _cache_catalogos.get(clave)
+        if entrada and time.monotonic() - entrada[0] < CACHE_CATALOGOS_TTL:
+            _cache_contadores['aciertos'] += 1
+            return list(entrada[1])
+        _cache_contadores['fallos'] += 1
+        generacion = _cache_generacion
+    
+    filas = cargar()
+    
+    with _cache_lock:
+        # Si hubo una invalidación mientras se consultaba, no guardar datos viejos
+        if generacion == _cache_generacion:
+            _cache_catalogos[clave] = (time.monotonic(), filas)
+    return list(filas)
+
+def invalidar_catalogos():
+    """Vacía la caché de clientes y soportistas"""
+    global _cache_generacion
+    with _cache_lock:
+        _cache_catalogos.clear()
+        _cache_generacion += 1
+        _cache_contadores['invalidaciones'] += 1
+
+def estadisticas_cache_catalogos():
+    """Contadores de aciertos/fallos/invalidaciones y entradas actuales"""
+    with _cache_lock:
+        return dict(_cache_contadores, entradas=len(_cache_catalogos))
+
+# ============== VERSIÓN DE DATOS POR CLIENTE ==============
+
+# Cada cambio en las visitas de un cliente sube su versión. La caché de
+# reportes (correo) guarda la versión con cada reporte y lo descarta si cambió.
+# Guardar clientes o soportistas (nombres en los reportes) cambia la versión de
+# todos a través de la generación de la caché de catálogos.
+_versiones_cliente = {}  # cliente_id -> cantidad de cambios
+_version_global = 0
+_versiones_lock = threading.Lock()
+
+def version_datos_cliente(cliente_id):
+    """Versión actual de los datos con los que se arman los reportes de un cliente"""
+    with _versiones_lock:
+        return (_cache_generacion, _versiones_cliente.get(cliente_id, 0))
+
+def version_datos():
+    """Versión de todos los datos de reportes (cambia con cualquier cliente)"""
+    with _versiones_lock:
+        return (_cache_generacion, _version_global)
+
+def _cambiaron_datos_cliente(*cliente_ids):
+    global _version_global
+    with _versiones_lock:
+        for cliente_id in cliente_ids:
+            _versiones_cliente[cliente_id] = _versiones_cliente.get(cliente_id, 0) + 1
+        _version_global += 1
 
 # ============== CLIENTES ==============
 
 def obtener_clientes(solo_activos=True, soportista_id=None):
     """Obtiene lista de clientes, opcionalmente filtrados por soportista"""
+    return _catalogo_cacheado(
+        ('clientes', bool(solo_activos), soportista_id or None),
+        lambda: _consultar_clientes(solo_activos, soportista_id)
+    )
+
+def _consultar_clientes(solo_activos, soportista_id):
     sql = '''
         SELECT c.*, s.nombre as soportista_nombre 
         FROM clientes c
@@ -215,120 +1116,286 @@ def obtener_clientes(solo_activos=True, soportista_id=None):
     
     return execute_query(sql, params if params else None)
 
+CLIENTE_POR_ID = sentencia('cliente_por_id', 'SELECT * FROM clientes WHERE id = ?')
+CLIENTE_INSERTAR = sentencia('cliente_insertar', '''
+    INSERT INTO clientes (nombre, correo, telefono, soportista_id) VALUES (?, ?, ?, ?)
+''', devuelve_id=True)
+CLIENTE_ACTUALIZAR = sentencia('cliente_actualizar', '''
+    UPDATE clientes SET nombre=?, correo=?, telefono=?, soportista_id=? WHERE id=?
+''')
+CLIENTE_DESACTIVAR = sentencia('cliente_desactivar', 'UPDATE clientes SET activo = 0 WHERE id = ?')
+
 def obtener_cliente(id):
     """Obtiene un cliente por ID"""
-    rows = execute_query('SELECT * FROM clientes WHERE id = ?', (id,))
+    rows = execute_query(CLIENTE_POR_ID, (id,))
     return rows[0] if rows else None
 
-def guardar_cliente(nombre, correo, telefono, soportista_id=None, id=None):
-    """Guarda o actualiza un cliente"""
+def guardar_cliente(nombre, correo, telefono, soportista_id=None, id=None, devolver_fila=False):
+    """Guarda o actualiza un cliente. Devuelve el id, o la fila guardada con devolver_fila=True"""
     if id:
-        execute_query('''
-            UPDATE clientes SET nombre=?, correo=?, telefono=?, soportista_id=? WHERE id=?
-        ''', (nombre, correo, telefono, soportista_id, id), fetch=False)
-        return id
+        sql = CLIENTE_ACTUALIZAR
+        params = (nombre, correo, telefono, soportista_id, id)
     else:
-        if USE_POSTGRES:
-            return execute_query('''
-                INSERT INTO clientes (nombre, correo, telefono, soportista_id) 
-                VALUES (?, ?, ?, ?) RETURNING id
-            ''', (nombre, correo, telefono, soportista_id), fetch=False)
-        else:
-            return execute_query('''
-                INSERT INTO clientes (nombre, correo, telefono, soportista_id) VALUES (?, ?, ?, ?)
-            ''', (nombre, correo, telefono, soportista_id), fetch=False)
+        sql = CLIENTE_INSERTAR
+        params = (nombre, correo, telefono, soportista_id)
+    resultado = _guardar('clientes', sql, params, id, SQL_FILA_SIMPLE if devolver_fila else None)
+    invalidar_catalogos()
+    return resultado
 
 def eliminar_cliente(id):
     """Desactiva un cliente (borrado lógico)"""
-    execute_query('UPDATE clientes SET activo = 0 WHERE id = ?', (id,), fetch=False)
+    execute_query(CLIENTE_DESACTIVAR, (id,), fetch=False)
+    invalidar_catalogos()
 
 # ============== SOPORTISTAS ==============
 
 def obtener_soportistas(solo_activos=True):
     """Obtiene lista de soportistas"""
+    return _catalogo_cacheado(
+        ('soportistas', bool(solo_activos)),
+        lambda: _consultar_soportistas(solo_activos)
+    )
+
+def _consultar_soportistas(solo_activos):
     if solo_activos:
         return execute_query('SELECT * FROM soportistas WHERE activo = 1 ORDER BY nombre')
     else:
         return execute_query('SELECT * FROM soportistas ORDER BY nombre')
 
+SOPORTISTA_POR_ID = sentencia('soportista_por_id', 'SELECT * FROM soportistas WHERE id = ?')
+SOPORTISTA_INSERTAR = sentencia('soportista_insertar',
+                                'INSERT INTO soportistas (nombre, correo) VALUES (?, ?)', devuelve_id=True)
+SOPORTISTA_ACTUALIZAR = sentencia('soportista_actualizar', 'UPDATE soportistas SET nombre=?, correo=? WHERE id=?')
+SOPORTISTA_DESACTIVAR = sentencia('soportista_desactivar', 'UPDATE soportistas SET activo = 0 WHERE id = ?')
+
 def obtener_soportista(id):
     """Obtiene un soportista por ID"""
-    rows = execute_query('SELECT * FROM soportistas WHERE id = ?', (id,))
+    rows = execute_query(SOPORTISTA_POR_ID, (id,))
     return rows[0] if rows else None
 
-def guardar_soportista(nombre, correo, id=None):
-    """Guarda o actualiza un soportista"""
+def guardar_soportista(nombre, correo, id=None, devolver_fila=False):
+    """Guarda o actualiza un soportista. Devuelve el id, o la fila guardada con devolver_fila=True"""
     if id:
-        execute_query('''
-            UPDATE soportistas SET nombre=?, correo=? WHERE id=?
-        ''', (nombre, correo, id), fetch=False)
-        return id
+        sql = SOPORTISTA_ACTUALIZAR
+        params = (nombre, correo, id)
     else:
-        if USE_POSTGRES:
-            return execute_query('''
-                INSERT INTO soportistas (nombre, correo) VALUES (?, ?) RETURNING id
-            ''', (nombre, correo), fetch=False)
-        else:
-            return execute_query('''
-                INSERT INTO soportistas (nombre, correo) VALUES (?, ?)
-            ''', (nombre, correo), fetch=False)
+        sql = SOPORTISTA_INSERTAR
+        params = (nombre, correo)
+    resultado = _guardar('soportistas', sql, params, id, SQL_FILA_SIMPLE if devolver_fila else None)
+    # obtener_clientes incluye soportista_nombre: se invalidan ambos catálogos
+    invalidar_catalogos()
+    return resultado
 
 def eliminar_soportista(id):
     """Desactiva un soportista (borrado lógico)"""
-    execute_query('UPDATE soportistas SET activo = 0 WHERE id = ?', (id,), fetch=False)
+    execute_query(SOPORTISTA_DESACTIVAR, (id,), fetch=False)
+    invalidar_catalogos()
 
 # ============== VISITAS ==============
 
+SQL_FILA_VISITA = '''
+    SELECT v.*, c.nombre as cliente_nombre, c.correo as cliente_correo,
+           s.nombre as soportista_nombre
+    FROM {origen} v
+    JOIN clientes c ON v.cliente_id = c.id
+    JOIN soportistas s ON v.soportista_id = s.id
+'''
+
+VISITA_POR_ID = sentencia('visita_por_id', SQL_FILA_VISITA.format(origen='visitas') + ' WHERE v.id = ?')
+VISITA_ANTERIOR = sentencia('visita_anterior', '''
+    SELECT cliente_id, soportista_id, fecha, duracion_minutos FROM visitas WHERE id = ?
+''', bloquear=True)
+VISITA_INSERTAR = sentencia('visita_insertar', '''
+    INSERT INTO visitas (cliente_id, soportista_id, persona_atendida, fecha,
+    hora_inicio, duracion_minutos, trabajo_realizado, tiene_pendiente, descripcion_pendiente)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+''', devuelve_id=True)
+VISITA_ACTUALIZAR = sentencia('visita_actualizar', '''
+    UPDATE visitas SET cliente_id=?, soportista_id=?, persona_atendida=?,
+    fecha=?, hora_inicio=?, duracion_minutos=?, trabajo_realizado=?,
+    tiene_pendiente=?, descripcion_pendiente=? WHERE id=?
+''')
+VISITA_CLIENTE = sentencia('visita_cliente', 'SELECT cliente_id FROM visitas WHERE id = ?')
+VISITA_RESOLVER_PENDIENTE = sentencia('visita_resolver_pendiente', '''
+    UPDATE visitas SET pendiente_resuelto = 1
+    WHERE id = ? AND tiene_pendiente = 1 AND pendiente_resuelto = 0
+''')
+RESUMEN_SUMAR = sentencia('resumen_sumar', '''
+    INSERT INTO visitas_diarias (cliente_id, fecha, soportista_id, cantidad, minutos)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (cliente_id, fecha, soportista_id) DO UPDATE SET
+        cantidad = visitas_diarias.cantidad + EXCLUDED.cantidad,
+        minutos = visitas_diarias.minutos + EXCLUDED.minutos
+''')
+RESUMEN_LIMPIAR = sentencia('resumen_limpiar', '''
+    DELETE FROM visitas_diarias
+    WHERE cliente_id = ? AND fecha = ? AND soportista_id = ? AND cantidad <= 0
+''')
+
 def guardar_visita(cliente_id, soportista_id, persona_atendida, fecha, hora_inicio, 
                    duracion_minutos, trabajo_realizado, tiene_pendiente=False, 
-                   descripcion_pendiente=None, id=None):
-    """Guarda o actualiza una visita"""
+                   descripcion_pendiente=None, id=None, devolver_fila=False):
+    """Guarda o actualiza una visita (y su resumen diario, en la misma transacción).
+    Devuelve el id, o con devolver_fila=True la visita guardada igual que obtener_visita()"""
     tiene_pend = 1 if tiene_pendiente else 0
+    es_nueva = not id
+    fila = None
+    clientes_afectados = {cliente_id}
     
-    if id:
-        execute_query('''
-            UPDATE visitas SET cliente_id=?, soportista_id=?, persona_atendida=?,
-            fecha=?, hora_inicio=?, duracion_minutos=?, trabajo_realizado=?,
-            tiene_pendiente=?, descripcion_pendiente=? WHERE id=?
-        ''', (cliente_id, soportista_id, persona_atendida, fecha, hora_inicio,
-              duracion_minutos, trabajo_realizado, tiene_pend,
-              descripcion_pendiente, id), fetch=False)
-        return id
-    else:
-        if USE_POSTGRES:
-            return execute_query('''
-                INSERT INTO visitas (cliente_id, soportista_id, persona_atendida, fecha,
-                hora_inicio, duracion_minutos, trabajo_realizado, tiene_pendiente, descripcion_pendiente)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) RETURNING id
-            ''', (cliente_id, soportista_id, persona_atendida, fecha, hora_inicio,
-                  duracion_minutos, trabajo_realizado, tiene_pend,
-                  descripcion_pendiente), fetch=False)
+    with transaccion() as cursor:
+        if id:
+            ejecutar(cursor, VISITA_ANTERIOR, (id,))
+            anterior = cursor.fetchone()
+            sql = VISITA_ACTUALIZAR
+            params = (cliente_id, soportista_id, persona_atendida, fecha, hora_inicio,
+                      duracion_minutos, trabajo_realizado, tiene_pend,
+                      descripcion_pendiente, id)
+            if devolver_fila:
+                fila = _guardar_y_releer(cursor, 'visitas', sql, params, id, SQL_FILA_VISITA)
+            else:
+                ejecutar(cursor, sql, params)
+            if anterior:
+                clientes_afectados.add(anterior['cliente_id'])
+                # La edición puede mover la visita a otro día/cliente/técnico
+                _sumar_resumen_diario(cursor, anterior['cliente_id'], anterior['fecha'],
+                                      anterior['soportista_id'], -1, -anterior['duracion_minutos'])
+                _sumar_resumen_diario(cursor, cliente_id, fecha, soportista_id, 1, duracion_minutos)
         else:
-            return execute_query('''
-                INSERT INTO visitas (cliente_id, soportista_id, persona_atendida, fecha,
-                hora_inicio, duracion_minutos, trabajo_realizado, tiene_pendiente, descripcion_pendiente)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (cliente_id, soportista_id, persona_atendida, fecha, hora_inicio,
-                  duracion_minutos, trabajo_realizado, tiene_pend,
-                  descripcion_pendiente), fetch=False)
+            sql = VISITA_INSERTAR
+            params = (cliente_id, soportista_id, persona_atendida, fecha, hora_inicio,
+                      duracion_minutos, trabajo_realizado, tiene_pend, descripcion_pendiente)
+            if devolver_fila:
+                fila = _guardar_y_releer(cursor, 'visitas', sql, params, None, SQL_FILA_VISITA)
+                id = fila['id']
+            else:
+                ejecutar(cursor, sql, params)
+                id = cursor.fetchone()['id'] if USE_POSTGRES else cursor.lastrowid
+            _sumar_resumen_diario(cursor, cliente_id, fecha, soportista_id, 1, duracion_minutos)
+    
+    _cambiaron_datos_cliente(*clientes_afectados)
+    if es_nueva:
+        _ajustar_contador_pendientes(visitas=tiene_pend)
+    else:
+        # No se sabe si antes tenía pendiente: recontar en la próxima lectura
+        _invalidar_contador_pendientes()
+    return fila if devolver_fila else id
+
+def _sumar_resumen_diario(cursor, cliente_id, fecha, soportista_id, cantidad, minutos):
+    """Suma (o resta, con valores negativos) una visita al resumen diario"""
+    ejecutar(cursor, RESUMEN_SUMAR, (cliente_id, fecha, soportista_id, cantidad, minutos))
+    if cantidad < 0:
+        ejecutar(cursor, RESUMEN_LIMPIAR, (cliente_id, fecha, soportista_id))
+
+def recalcular_resumen_diario():
+    """Reconstruye visitas_diarias desde visitas (reparación manual)"""
+    with transaccion() as cursor:
+        ejecutar(cursor, 'DELETE FROM visitas_diarias')
+        ejecutar(cursor, SQL_RECALCULAR_RESUMEN_DIARIO)
 
 def obtener_visita(id):
     """Obtiene una visita por ID con datos de cliente y soportista"""
-    rows = execute_query('''
-        SELECT v.*, c.nombre as cliente_nombre, c.correo as cliente_correo,
-               s.nombre as soportista_nombre
+    rows = execute_query(VISITA_POR_ID, (id,))
+    return rows[0] if rows else None
+
+# Visita completa con los nombres de cliente y técnico (boletas y reportes)
+COLUMNAS_VISITA = '''
+    v.*, c.nombre as cliente_nombre, c.correo as cliente_correo,
+    s.nombre as soportista_nombre
+'''
+
+# Las pantallas de lista solo muestran datos cortos: estas columnas más un
+# recorte de los textos largos. El texto completo se pide con obtener_visita()
+# al abrir una boleta, o con obtener_visitas_cliente() al armar un reporte.
+LARGO_RESUMEN = 120
+
+COLUMNAS_RESUMEN_VISITA = f'''
+    v.id, v.cliente_id, v.soportista_id, v.fecha, v.hora_inicio, v.duracion_minutos,
+    v.tiene_pendiente, v.pendiente_resuelto,
+    substr(v.trabajo_realizado, 1, {LARGO_RESUMEN + 1}) as trabajo_resumen,
+    substr(v.descripcion_pendiente, 1, {LARGO_RESUMEN + 1}) as pendiente_resumen,
+    c.nombre as cliente_nombre, s.nombre as soportista_nombre
+'''
+
+def recortar_resumen(texto):
+    """Texto de un *_resumen listo para mostrar (con … si fue recortado)"""
+    if not texto:
+        return ''
+    return texto[:LARGO_RESUMEN] + '…' if len(texto) > LARGO_RESUMEN else texto
+
+def obtener_visitas_cliente(cliente_id, fecha_desde=None, fecha_hasta=None, limite=None, despues_de=None):
+    """Obtiene visitas de un cliente en un rango de fechas (con textos completos),
+    de la más reciente a la más antigua. Con limite devuelve una página; la
+    siguiente se pide con despues_de=clave_visita(última fila de la anterior)"""
+    return _visitas_cliente(COLUMNAS_VISITA, cliente_id, fecha_desde, fecha_hasta, limite, despues_de)
+
+def iterar_visitas_cliente(cliente_id, fecha_desde=None, fecha_hasta=None, lote=500):
+    """Como obtener_visitas_cliente pero como iterador que trae las visitas de a
+    lote (para reportes de períodos largos sin cargar todo en memoria)"""
+    sql, params = _sql_visitas_cliente(COLUMNAS_VISITA, cliente_id, fecha_desde, fecha_hasta, None, None)
+    return iterar_consulta(sql, params, lote)
+
+def iterar_visitas(cliente_id=None, soportista_id=None, fecha_desde=None, fecha_hasta=None, lote=1000):
+    """Visitas completas de la más antigua a la más reciente, filtradas por
+    cliente, técnico que la hizo y/o rango de fechas, como iterador que trae
+    de a lote (exportaciones de un año entero)"""
+    sql = f'''
+        SELECT {COLUMNAS_VISITA}
         FROM visitas v
         JOIN clientes c ON v.cliente_id = c.id
         JOIN soportistas s ON v.soportista_id = s.id
-        WHERE v.id = ?
-    ''', (id,))
-    return rows[0] if rows else None
+        WHERE 1 = 1
+    '''
+    params = []
+    
+    if cliente_id:
+        sql += ' AND v.cliente_id = ?'
+        params.append(cliente_id)
+    if soportista_id:
+        sql += ' AND v.soportista_id = ?'
+        params.append(soportista_id)
+    if fecha_desde:
+        sql += ' AND v.fecha >= ?'
+        params.append(fecha_desde)
+    if fecha_hasta:
+        sql += ' AND v.fecha <= ?'
+        params.append(fecha_hasta)
+    
+    sql += ' ORDER BY v.fecha, v.hora_inicio, v.id'
+    return iterar_consulta(sql, params, lote)
+
+def listar_visitas_cliente(cliente_id, fecha_desde=None, fecha_hasta=None, limite=None, despues_de=None):
+    """Como obtener_visitas_cliente pero solo con las columnas de la lista
+    (trabajo_resumen en vez de trabajo_realizado)"""
+    return _visitas_cliente(COLUMNAS_RESUMEN_VISITA, cliente_id, fecha_desde, fecha_hasta, limite, despues_de)
+
+def clave_visita(visita):
+    """Clave de paginación de una visita: (fecha, hora_inicio, id)"""
+    return (visita['fecha'], visita['hora_inicio'], visita['id'])
 
-def obtener_visitas_cliente(cliente_id, fecha_desde=None, fecha_hasta=None):
-    """Obtiene visitas de un cliente en un rango de fechas"""
+def obtener_totales_visitas_cliente(cliente_id, fecha_desde=None, fecha_hasta=None):
+    """Cantidad de visitas y minutos de un cliente en el rango, sin traer las visitas"""
     sql = '''
-        SELECT v.*, c.nombre as cliente_nombre, c.correo as cliente_correo,
-               s.nombre as soportista_nombre
+        SELECT COALESCE(SUM(cantidad), 0) as visitas, COALESCE(SUM(minutos), 0) as minutos
+        FROM visitas_diarias
+        WHERE cliente_id = ?
+    '''
+    params = [cliente_id]
+    
+    if fecha_desde:
+        sql += ' AND fecha >= ?'
+        params.append(fecha_desde)
+    if fecha_hasta:
+        sql += ' AND fecha <= ?'
+        params.append(fecha_hasta)
+    
+    return execute_query(sql, params)[0]
+
+def _visitas_cliente(columnas, cliente_id, fecha_desde, fecha_hasta, limite, despues_de):
+    return execute_query(*_sql_visitas_cliente(columnas, cliente_id, fecha_desde, fecha_hasta, limite, despues_de))
+
+def _sql_visitas_cliente(columnas, cliente_id, fecha_desde, fecha_hasta, limite, despues_de):
+    sql = f'''
+        SELECT {columnas}
         FROM visitas v
         JOIN clientes c ON v.cliente_id = c.id
         JOIN soportistas s ON v.soportista_id = s.id
@@ -342,16 +1409,30 @@ def obtener_visitas_cliente(cliente_id, fecha_desde=None, fecha_hasta=None):
     if fecha_hasta:
         sql += ' AND v.fecha <= ?'
         params.append(fecha_hasta)
+    if despues_de:
+        # Keyset: sigue donde terminó la página anterior, sin OFFSET
+        sql += ' AND (v.fecha, v.hora_inicio, v.id) < (?, ?, ?)'
+        params.extend(despues_de)
     
-    sql += ' ORDER BY v.fecha DESC, v.hora_inicio DESC'
+    sql += ' ORDER BY v.fecha DESC, v.hora_inicio DESC, v.id DESC'
+    if limite:
+        sql += ' LIMIT ?'
+        params.append(limite)
     
-    return execute_query(sql, params)
+    return sql, params
 
 def obtener_pendientes(solo_no_resueltos=True):
     """Obtiene visitas con pendientes"""
-    sql = '''
-        SELECT v.*, c.nombre as cliente_nombre, c.correo as cliente_correo,
-               s.nombre as soportista_nombre
+    return _pendientes(COLUMNAS_VISITA, solo_no_resueltos)
+
+def listar_pendientes(solo_no_resueltos=True):
+    """Como obtener_pendientes pero solo con las columnas de la lista
+    (pendiente_resumen en vez de descripcion_pendiente)"""
+    return _pendientes(COLUMNAS_RESUMEN_VISITA, solo_no_resueltos)
+
+def _pendientes(columnas, solo_no_resueltos):
+    sql = f'''
+        SELECT {columnas}
         FROM visitas v
         JOIN clientes c ON v.cliente_id = c.id
         JOIN soportistas s ON v.soportista_id = s.id
@@ -365,7 +1446,12 @@ def obtener_pendientes(solo_no_resueltos=True):
 
 def resolver_pendiente(visita_id):
     """Marca un pendiente como resuelto"""
-    execute_query('UPDATE visitas SET pendiente_resuelto = 1 WHERE id = ?', (visita_id,), fetch=False)
+    resueltos = execute_query(VISITA_RESOLVER_PENDIENTE, (visita_id,), fetch=False)
+    _ajustar_contador_pendientes(visitas=-resueltos)
+    if resueltos:
+        rows = execute_query(VISITA_CLIENTE, (visita_id,))
+        if rows:
+            _cambiaron_datos_cliente(rows[0]['cliente_id'])
 
 def calcular_tiempo_total(visitas):
     """Calcula el tiempo total en minutos de una lista de visitas"""
@@ -383,58 +1469,111 @@ def formatear_duracion(minutos):
 
 def obtener_estadisticas_clientes(soportista_id=None, fecha_desde=None, fecha_hasta=None):
     """Obtiene resumen de boletas por cliente: cantidad y tiempo total"""
-    sql = '''
-        SELECT c.id, c.nombre as cliente_nombre, 
-               COUNT(v.id) as cantidad_boletas,
-               COALESCE(SUM(v.duracion_minutos), 0) as tiempo_total
-        FROM clientes c
-        LEFT JOIN visitas v ON c.id = v.cliente_id
-    '''
+    return execute_query(*_sql_estadisticas_clientes(soportista_id, fecha_desde, fecha_hasta))
+
+def iterar_estadisticas_clientes(soportista_id=None, fecha_desde=None, fecha_hasta=None, lote=1000):
+    """Como obtener_estadisticas_clientes pero como iterador que trae de a lote"""
+    sql, params = _sql_estadisticas_clientes(soportista_id, fecha_desde, fecha_hasta)
+    return iterar_consulta(sql, params, lote)
+
+def _sql_estadisticas_clientes(soportista_id, fecha_desde, fecha_hasta):
+    # Se lee del resumen diario (una fila por cliente/día/técnico) en vez de
+    # agregar todas las visitas; filtros de fecha en el ON para que los
+    # clientes sin visitas en el período aparezcan con 0
+    join_resumen = 'LEFT JOIN visitas_diarias r ON c.id = r.cliente_id'
     params = []
-    where_clauses = ['c.activo = 1']
     
-    # Filtros de fecha solo aplican a las visitas
     if fecha_desde:
-        where_clauses.append('(v.fecha >= ? OR v.id IS NULL)')
+        join_resumen += ' AND r.fecha >= ?'
         params.append(fecha_desde)
     if fecha_hasta:
-        where_clauses.append('(v.fecha <= ? OR v.id IS NULL)')
+        join_resumen += ' AND r.fecha <= ?'
         params.append(fecha_hasta)
+    
+    sql = f'''
+        SELECT c.id, c.nombre as cliente_nombre, 
+               COALESCE(SUM(r.cantidad), 0) as cantidad_boletas,
+               COALESCE(SUM(r.minutos), 0) as tiempo_total
+        FROM clientes c
+        {join_resumen}
+        WHERE c.activo = 1
+    '''
+    
     if soportista_id:
-        where_clauses.append('c.soportista_id = ?')
+        sql += ' AND c.soportista_id = ?'
         params.append(soportista_id)
     
-    if where_clauses:
-        sql += ' WHERE ' + ' AND '.join(where_clauses)
-    
     sql += ' GROUP BY c.id, c.nombre ORDER BY c.nombre'
     
-    return execute_query(sql, params if params else None)
+    return sql, params
 
 def obtener_clientes_sin_boletas(soportista_id=None, fecha_desde=None, fecha_hasta=None):
-    """Obtiene clientes que NO tuvieron boletas en el período"""
-    # Primero obtenemos los IDs de clientes que SÍ tienen boletas en el período
-    sql_con_boletas = '''
-        SELECT DISTINCT cliente_id FROM visitas WHERE 1=1
-    '''
-    params_boletas = []
+    """Obtiene clientes que NO tuvieron boletas en el período, con su última visita
+    (ultima_visita) y los días transcurridos desde ella (dias_sin_visita, None si nunca)"""
+    # Anti-join con NOT EXISTS sobre el resumen diario: una búsqueda por índice
+    # (cliente_id, fecha) por cliente, sin depender del volumen de visitas
+    condiciones_periodo = ''
+    params = []
     
     if fecha_desde:
-        sql_con_boletas += ' AND fecha >= ?'
-        params_boletas.append(fecha_desde)
+        condiciones_periodo += ' AND r.fecha >= ?'
+        params.append(fecha_desde)
     if fecha_hasta:
-        sql_con_boletas += ' AND fecha <= ?'
-        params_boletas.append(fecha_hasta)
+        condiciones_periodo += ' AND r.fecha <= ?'
+        params.append(fecha_hasta)
     
-    # Ahora buscamos clientes que NO están en esa lista
     sql = f'''
-        SELECT c.id, c.nombre as cliente_nombre, s.nombre as soportista_nombre
+        SELECT c.id, c.nombre as cliente_nombre, s.nombre as soportista_nombre,
+               (SELECT MAX(u.fecha) FROM visitas_diarias u WHERE u.cliente_id = c.id) as ultima_visita
         FROM clientes c
         LEFT JOIN soportistas s ON c.soportista_id = s.id
         WHERE c.activo = 1 
-        AND c.id NOT IN ({sql_con_boletas})
+        AND NOT EXISTS (
+            SELECT 1 FROM visitas_diarias r
+            WHERE r.cliente_id = c.id{condiciones_periodo}
+        )
+    '''
+    
+    if soportista_id:
+        sql += ' AND c.soportista_id = ?'
+        params.append(soportista_id)
+    
+    sql += ' ORDER BY c.nombre'
+    
+    resultados = execute_query(sql, params if params else None)
+    hoy = date.today()
+    for i, r in enumerate(resultados):
+        try:
+            ultima = datetime.strptime(r['ultima_visita'], '%Y-%m-%d').date()
+            dias = (hoy - ultima).days
+        except (TypeError, ValueError):
+            dias = None
+        resultados[i] = r.con(dias_sin_visita=dias)
+    return resultados
+
+def obtener_clientes_con_visitas(soportista_id=None, fecha_desde=None, fecha_hasta=None):
+    """Clientes activos con al menos una visita en el período (id, nombre, correo),
+    los destinatarios del envío masivo de reportes"""
+    # Semi-join con EXISTS sobre el resumen diario, igual que clientes sin boletas
+    condiciones_periodo = ''
+    params = []
+    
+    if fecha_desde:
+        condiciones_periodo += ' AND r.fecha >= ?'
+        params.append(fecha_desde)
+    if fecha_hasta:
+        condiciones_periodo += ' AND r.fecha <= ?'
+        params.append(fecha_hasta)
+    
+    sql = f'''
+        SELECT c.id, c.nombre, c.correo
+        FROM clientes c
+        WHERE c.activo = 1
+        AND EXISTS (
+            SELECT 1 FROM visitas_diarias r
+            WHERE r.cliente_id = c.id{condiciones_periodo}
+        )
     '''
-    params = params_boletas.copy()
     
     if soportista_id:
         sql += ' AND c.soportista_id = ?'
@@ -444,63 +1583,117 @@ def obtener_clientes_sin_boletas(soportista_id=None, fecha_desde=None, fecha_has
     
     return execute_query(sql, params if params else None)
 
-# ============== TAREAS/PENDIENTES INDEPENDIENTES ==============
+# ============== BÚSQUEDA DE TEXTO ==============
 
-def crear_tabla_tareas():
-    """Crea la tabla de tareas si no existe"""
-    conn = get_connection()
-    cursor = conn.cursor()
+def _consulta_fts5(texto):
+    """Convierte el texto del usuario en una consulta FTS5 segura (palabras con prefijo)"""
+    palabras = re.findall(r'\w+', texto or '')
+    return ' '.join(f'"{p}"*' for p in palabras)
+
+def _consulta_tsquery(texto):
+    """Lo mismo para to_tsquery de PostgreSQL: todas las palabras, cada una como
+    prefijo (palabra:*). Solo letras y dígitos: nada de la sintaxis de tsquery"""
+    palabras = re.findall(r'[^\W_]+', texto or '')
+    return ' & '.join(f'{p}:*' for p in palabras)
+
+def buscar_texto(texto, cliente_id=None, fecha_desde=None, fecha_hasta=None, incluir_tareas=True, limite=50):
+    """Busca texto en trabajo realizado, pendientes, persona atendida y tareas.
+    Devuelve filas con tipo ('visita'/'tarea'), id, fecha, cliente_nombre,
+    soportista_nombre y fragmento, ordenados por relevancia"""
+    if not re.search(r'\w', texto or ''):
+        return []
+    
+    filtros_visitas = ''
+    params_visitas = []
+    if cliente_id:
+        filtros_visitas += ' AND v.cliente_id = ?'
+        params_visitas.append(cliente_id)
+    if fecha_desde:
+        filtros_visitas += ' AND v.fecha >= ?'
+        params_visitas.append(fecha_desde)
+    if fecha_hasta:
+        filtros_visitas += ' AND v.fecha <= ?'
+        params_visitas.append(fecha_hasta)
+    filtros_tareas = ' AND t.cliente_id = ?' if cliente_id else ''
+    params_tareas = [cliente_id] if cliente_id else []
     
     if USE_POSTGRES:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS tareas (
-                id SERIAL PRIMARY KEY,
-                soportista_id INTEGER NOT NULL REFERENCES soportistas(id),
-                cliente_id INTEGER REFERENCES clientes(id),
-                descripcion TEXT NOT NULL,
-                fecha_limite TEXT,
-                hora_limite TEXT,
-                completada INTEGER DEFAULT 0,
-                fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                fecha_completada TIMESTAMP
-            )
-        ''')
+        # rango negativo: menor es más relevante, igual que bm25 en SQLite
+        sql_visitas = f'''
+            SELECT 'visita' as tipo, v.id, v.fecha, v.hora_inicio,
+                   c.nombre as cliente_nombre, s.nombre as soportista_nombre,
+                   ts_headline('spanish', coalesce(v.trabajo_realizado, '') || ' ' || coalesce(v.descripcion_pendiente, '')
+                                          || ' ' || coalesce(v.persona_atendida, ''),
+                               q, 'StartSel=[, StopSel=], MaxWords=20, MinWords=8') as fragmento,
+                   -ts_rank({TSV_VISITAS.format(p='v.')}, q) as rango
+            FROM visitas v
+            JOIN clientes c ON v.cliente_id = c.id
+            JOIN soportistas s ON v.soportista_id = s.id,
+            to_tsquery('spanish', ?) q
+            WHERE {TSV_VISITAS.format(p='v.')} @@ q{filtros_visitas}
+            ORDER BY rango LIMIT ?
+        '''
+        sql_tareas = f'''
+            SELECT 'tarea' as tipo, t.id, t.fecha_limite as fecha, t.hora_limite as hora_inicio,
+                   c.nombre as cliente_nombre, s.nombre as soportista_nombre,
+                   ts_headline('spanish', t.descripcion, q, 'StartSel=[, StopSel=], MaxWords=20, MinWords=8') as fragmento,
+                   -ts_rank({TSV_TAREAS.format(p='t.')}, q) as rango
+            FROM tareas t
+            JOIN soportistas s ON t.soportista_id = s.id
+            LEFT JOIN clientes c ON t.cliente_id = c.id,
+            to_tsquery('spanish', ?) q
+            WHERE {TSV_TAREAS.format(p='t.')} @@ q{filtros_tareas}
+            ORDER BY rango LIMIT ?
+        '''
+        # Prefijos como en SQLite: "impre" encuentra "impresora" en los dos motores
+        consulta = _consulta_tsquery(texto)
     else:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS tareas (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                soportista_id INTEGER NOT NULL,
-                cliente_id INTEGER,
-                descripcion TEXT NOT NULL,
-                fecha_limite TEXT,
-                hora_limite TEXT,
-                completada INTEGER DEFAULT 0,
-                fecha_creacion TEXT DEFAULT CURRENT_TIMESTAMP,
-                fecha_completada TEXT,
-                FOREIGN KEY (soportista_id) REFERENCES soportistas(id),
-                FOREIGN KEY (cliente_id) REFERENCES clientes(id)
-            )
-        ''')
+        sql_visitas = f'''
+            SELECT 'visita' as tipo, v.id, v.fecha, v.hora_inicio,
+                   c.nombre as cliente_nombre, s.nombre as soportista_nombre,
+                   snippet(visitas_fts, -1, '[', ']', '…', 12) as fragmento,
+                   bm25(visitas_fts) as rango
+            FROM visitas_fts
+            JOIN visitas v ON v.id = visitas_fts.rowid
+            JOIN clientes c ON v.cliente_id = c.id
+            JOIN soportistas s ON v.soportista_id = s.id
+            WHERE visitas_fts MATCH ?{filtros_visitas}
+            ORDER BY rango LIMIT ?
+        '''
+        sql_tareas = f'''
+            SELECT 'tarea' as tipo, t.id, t.fecha_limite as fecha, t.hora_limite as hora_inicio,
+                   c.nombre as cliente_nombre, s.nombre as soportista_nombre,
+                   snippet(tareas_fts, -1, '[', ']', '…', 12) as fragmento,
+                   bm25(tareas_fts) as rango
+            FROM tareas_fts
+            JOIN tareas t ON t.id = tareas_fts.rowid
+            JOIN soportistas s ON t.soportista_id = s.id
+            LEFT JOIN clientes c ON t.cliente_id = c.id
+            WHERE tareas_fts MATCH ?{filtros_tareas}
+            ORDER BY rango LIMIT ?
+        '''
+        consulta = _consulta_fts5(texto)
+    if not consulta:
+        return []
     
-    conn.commit()
-    cursor.close()
-    conn.close()
+    resultados = execute_query(sql_visitas, [consulta] + params_visitas + [limite])
+    if incluir_tareas:
+        resultados += execute_query(sql_tareas, [consulta] + params_tareas + [limite])
+        resultados.sort(key=lambda r: r['rango'])
+    return resultados[:limite]
+
+# ============== TAREAS/PENDIENTES INDEPENDIENTES ==============
 
-# Crear tabla al importar
-try:
-    crear_tabla_tareas()
-except:
-    pass
+SQL_FILA_TAREA = '''
+    SELECT t.*, s.nombre as soportista_nombre, c.nombre as cliente_nombre
+    FROM {origen} t
+    JOIN soportistas s ON t.soportista_id = s.id
+    LEFT JOIN clientes c ON t.cliente_id = c.id
+'''
 
 def obtener_tareas(soportista_id=None, solo_pendientes=True):
     """Obtiene lista de tareas"""
-    sql = '''
-        SELECT t.*, s.nombre as soportista_nombre, c.nombre as cliente_nombre
-        FROM tareas t
-        JOIN soportistas s ON t.soportista_id = s.id
-        LEFT JOIN clientes c ON t.cliente_id = c.id
-        WHERE 1=1
-    '''
+    sql = SQL_FILA_TAREA.format(origen='tareas') + ' WHERE 1=1'
     params = []
     
     if soportista_id:
@@ -514,66 +1707,255 @@ def obtener_tareas(soportista_id=None, solo_pendientes=True):
     
     return execute_query(sql, params if params else None)
 
-def guardar_tarea(soportista_id, descripcion, cliente_id=None, fecha_limite=None, hora_limite=None, id=None):
-    """Guarda o actualiza una tarea"""
+TAREA_INSERTAR = sentencia('tarea_insertar', '''
+    INSERT INTO tareas (soportista_id, descripcion, cliente_id, fecha_limite, hora_limite) 
+    VALUES (?, ?, ?, ?, ?)
+''', devuelve_id=True)
+TAREA_ACTUALIZAR = sentencia('tarea_actualizar', '''
+    UPDATE tareas SET descripcion=?, cliente_id=?, fecha_limite=?, hora_limite=? WHERE id=?
+''')
+TAREA_COMPLETAR = sentencia('tarea_completar', '''
+    UPDATE tareas SET completada = 1, fecha_completada = CURRENT_TIMESTAMP WHERE id = ? AND completada = 0
+''')
+TAREA_ELIMINAR_PENDIENTE = sentencia('tarea_eliminar_pendiente', 'DELETE FROM tareas WHERE id = ? AND completada = 0')
+TAREA_ELIMINAR = sentencia('tarea_eliminar', 'DELETE FROM tareas WHERE id = ?')
+
+def guardar_tarea(soportista_id, descripcion, cliente_id=None, fecha_limite=None, hora_limite=None, id=None,
+                  devolver_fila=False):
+    """Guarda o actualiza una tarea. Devuelve el id, o la fila guardada (con
+    soportista_nombre y cliente_nombre) con devolver_fila=True"""
+    sql_fila = SQL_FILA_TAREA if devolver_fila else None
     if id:
-        execute_query('''
-            UPDATE tareas SET descripcion=?, cliente_id=?, fecha_limite=?, hora_limite=? WHERE id=?
-        ''', (descripcion, cliente_id, fecha_limite, hora_limite, id), fetch=False)
-        return id
+        return _guardar('tareas', TAREA_ACTUALIZAR, (descripcion, cliente_id, fecha_limite, hora_limite, id), id, sql_fila)
     else:
-        if USE_POSTGRES:
-            return execute_query('''
-                INSERT INTO tareas (soportista_id, descripcion, cliente_id, fecha_limite, hora_limite) 
-                VALUES (?, ?, ?, ?, ?) RETURNING id
-            ''', (soportista_id, descripcion, cliente_id, fecha_limite, hora_limite), fetch=False)
-        else:
-            return execute_query('''
-                INSERT INTO tareas (soportista_id, descripcion, cliente_id, fecha_limite, hora_limite) 
-                VALUES (?, ?, ?, ?, ?)
-            ''', (soportista_id, descripcion, cliente_id, fecha_limite, hora_limite), fetch=False)
+        resultado = _guardar('tareas', TAREA_INSERTAR, (soportista_id, descripcion, cliente_id, fecha_limite, hora_limite), None, sql_fila)
+        _ajustar_contador_pendientes(tareas=1)
+        return resultado
 
 def completar_tarea(tarea_id):
     """Marca una tarea como completada"""
-    if USE_POSTGRES:
-        execute_query('UPDATE tareas SET completada = 1, fecha_completada = CURRENT_TIMESTAMP WHERE id = ?', (tarea_id,), fetch=False)
-    else:
-        execute_query('UPDATE tareas SET completada = 1, fecha_completada = CURRENT_TIMESTAMP WHERE id = ?', (tarea_id,), fetch=False)
+    completadas = execute_query(TAREA_COMPLETAR, (tarea_id,), fetch=False)
+    _ajustar_contador_pendientes(tareas=-completadas)
 
 def eliminar_tarea(tarea_id):
     """Elimina una tarea"""
-    execute_query('DELETE FROM tareas WHERE id = ?', (tarea_id,), fetch=False)
+    # Casi siempre se eliminan tareas pendientes: así se sabe cuánto descontar
+    pendientes = execute_query(TAREA_ELIMINAR_PENDIENTE, (tarea_id,), fetch=False)
+    if pendientes:
+        _ajustar_contador_pendientes(tareas=-pendientes)
+    else:
+        execute_query(TAREA_ELIMINAR, (tarea_id,), fetch=False)
 
-def contar_pendientes_total():
-    """Cuenta todos los pendientes (tareas + pendientes de visitas)"""
-    # Tareas pendientes
-    tareas = execute_query('SELECT COUNT(*) as cnt FROM tareas WHERE completada = 0')
-    cnt_tareas = tareas[0]['cnt'] if tareas else 0
+# ============== COLA DE CORREOS ==============
+
+# correo.encolar_correo guarda aquí el mensaje y un hilo de correo.py lo envía.
+# Estados: 'pendiente' (en cola o esperando reintento), 'enviando' (reservado
+# por el hilo hasta proximo_intento; si el proceso muere se vuelve a tomar),
+# 'enviado' y 'error' (agotó los reintentos).
+CORREO_ENCOLAR = sentencia('correo_encolar', '''
+    INSERT INTO correos_salientes (destinatario, asunto, cuerpo_html, proximo_intento) VALUES (?, ?, ?, ?)
+''', devuelve_id=True)
+CORREOS_VENCIDOS = sentencia('correos_vencidos', '''
+    SELECT id FROM correos_salientes
+    WHERE estado IN ('pendiente', 'enviando') AND proximo_intento <= ?
+    ORDER BY proximo_intento LIMIT ?
+''', bloquear='SKIP LOCKED')
+CORREO_ENVIADO = sentencia('correo_enviado', '''
+    UPDATE correos_salientes SET estado = 'enviado', ultimo_error = NULL, fecha_enviado = CURRENT_TIMESTAMP
+    WHERE id = ?
+''')
+CORREO_REPROGRAMAR = sentencia('correo_reprogramar', '''
+    UPDATE correos_salientes SET estado = ?, proximo_intento = ?, ultimo_error = ? WHERE id = ?
+''')
+
+def encolar_correo_saliente(destinatario, asunto, cuerpo_html):
+    """Agrega un correo a la cola para enviarlo cuanto antes. Devuelve su id"""
+    return execute_query(CORREO_ENCOLAR, (destinatario, asunto, cuerpo_html, time.time()), fetch=False)
+
+def tomar_correos_salientes(limite=10, reserva_segundos=300):
+    """Reserva los correos vencidos para enviarlos (suma un intento a cada uno).
+    Devuelve dicts con id, destinatario, asunto, cuerpo_html e intentos"""
+    ahora = time.time()
+    with transaccion() as cursor:
+        ejecutar(cursor, CORREOS_VENCIDOS, (ahora, limite))
+        ids = [r['id'] for r in cursor.fetchall()]
+        if not ids:
+            return []
+        marcas = ', '.join('?' * len(ids))
+        ejecutar(cursor, f'''
+            UPDATE correos_salientes SET estado = 'enviando', intentos = intentos + 1, proximo_intento = ?
+            WHERE id IN ({marcas})
+        ''', [ahora + reserva_segundos] + ids)
+        ejecutar(cursor, f'''
+            SELECT id, destinatario, asunto, cuerpo_html, intentos FROM correos_salientes
+            WHERE id IN ({marcas}) ORDER BY id
+        ''', ids)
+        return [dict(r) for r in cursor.fetchall()]
+
+def marcar_correo_enviado(id):
+    """Marca un correo de la cola como enviado"""
+    execute_query(CORREO_ENVIADO, (id,), fetch=False)
+
+def reprogramar_correo(id, error, proximo_intento=None):
+    """Deja el correo para reintentar en proximo_intento (timestamp), o en
+    estado 'error' si es None (no se reintenta más)"""
+    if proximo_intento is None:
+        execute_query(CORREO_REPROGRAMAR, ('error', time.time(), error, id), fetch=False)
+    else:
+        execute_query(CORREO_REPROGRAMAR, ('pendiente', proximo_intento, error, id), fetch=False)
+
+def reintentar_correos_con_error():
+    """Vuelve a encolar los correos que agotaron los reintentos (p. ej. tras
+    corregir la configuración SMTP). Devuelve cuántos"""
+    return execute_query('''
+        UPDATE correos_salientes SET estado = 'pendiente', intentos = 0, proximo_intento = ?
+        WHERE estado = 'error'
+    ''', (time.time(),), fetch=False)
+
+def obtener_correos_salientes(estado=None, limite=50):
+    """Últimos correos de la cola (sin el cuerpo) para ver su estado"""
+    sql = '''
+        SELECT id, destinatario, asunto, estado, intentos, ultimo_error, fecha_creacion, fecha_enviado
+        FROM correos_salientes
+    '''
+    params = []
+    if estado:
+        sql += ' WHERE estado = ?'
+        params.append(estado)
+    sql += ' ORDER BY id DESC LIMIT ?'
+    params.append(limite)
+    return execute_query(sql, params)
+
+def resumen_cola_correos():
+    """Cantidad de correos por estado: {'pendiente': n, 'enviado': n, ...}"""
+    rows = execute_query('SELECT estado, COUNT(*) as cantidad FROM correos_salientes GROUP BY estado')
+    return {r['estado']: r['cantidad'] for r in rows}
+
+# ============== CONTADOR DE PENDIENTES ==============
+
+# El badge de la pantalla de inicio se sirve desde un contador en memoria que
+# las funciones de escritura ajustan. Se recuenta (una sola consulta) al vencer
+# el TTL, tras una edición ambigua o si CONTADOR_PENDIENTES_TTL = 0 (desactivado).
+CONTADOR_PENDIENTES_TTL = float(os.environ.get('CONTADOR_PENDIENTES_TTL', '60'))
+
+_contador_pendientes = None  # {'tareas': n, 'visitas': n}
+_contador_cargado = 0.0
+_contador_generacion = 0
+_contador_lock = threading.Lock()
+
+CONTAR_PENDIENTES = sentencia('contar_pendientes', '''
+    SELECT (SELECT COUNT(*) FROM tareas WHERE completada = 0) as tareas,
+           (SELECT COUNT(*) FROM visitas WHERE tiene_pendiente = 1 AND pendiente_resuelto = 0) as visitas
+''')
+
+def _ajustar_contador_pendientes(tareas=0, visitas=0):
+    global _contador_generacion
+    with _contador_lock:
+        _contador_generacion += 1
+        if _contador_pendientes is not None:
+            _contador_pendientes['tareas'] += tareas
+            _contador_pendientes['visitas'] += visitas
+
+def _invalidar_contador_pendientes():
+    global _contador_pendientes, _contador_generacion
+    with _contador_lock:
+        _contador_generacion += 1
+        _contador_pendientes = None
+
+def contar_pendientes():
+    """Cuenta tareas pendientes y pendientes de visitas: {'tareas': n, 'visitas': n}"""
+    global _contador_pendientes, _contador_cargado
+    with _contador_lock:
+        if (_contador_pendientes is not None
+                and time.monotonic() - _contador_cargado < CONTADOR_PENDIENTES_TTL):
+            return dict(_contador_pendientes)
+        generacion = _contador_generacion
     
-    # Pendientes de visitas
-    visitas = execute_query('SELECT COUNT(*) as cnt FROM visitas WHERE tiene_pendiente = 1 AND pendiente_resuelto = 0')
-    cnt_visitas = visitas[0]['cnt'] if visitas else 0
+    rows = execute_query(CONTAR_PENDIENTES)
+    conteo = {'tareas': rows[0]['tareas'], 'visitas': rows[0]['visitas']}
     
-    return cnt_tareas + cnt_visitas
+    with _contador_lock:
+        # Si hubo escrituras durante la consulta el conteo puede estar desfasado
+        if generacion == _contador_generacion and CONTADOR_PENDIENTES_TTL > 0:
+            _contador_pendientes = dict(conteo)
+            _contador_cargado = time.monotonic()
+    return conteo
+
+def contar_pendientes_total():
+    """Cuenta todos los pendientes (tareas + pendientes de visitas)"""
+    conteo = contar_pendientes()
+    return conteo['tareas'] + conteo['visitas']
 
 # ============== CONFIGURACIÓN ==============
 
+# La tabla configuracion es pequeña: se carga completa en una consulta y se
+# sirve desde memoria. guardar_config/guardar_config_many la actualizan.
+CACHE_CONFIG_TTL = float(os.environ.get('CACHE_CONFIG_TTL', '300'))
+
+_config = None  # dict clave -> valor
+_config_cargada = 0.0
+_config_lock = threading.Lock()
+_config_generacion = 0  # sube con cada guardado
+
+CONFIG_TODAS = sentencia('config_todas', 'SELECT clave, valor FROM configuracion')
+CONFIG_GUARDAR = sentencia('config_guardar', '''
+    INSERT INTO configuracion (clave, valor) VALUES (?, ?)
+    ON CONFLICT (clave) DO UPDATE SET valor = EXCLUDED.valor
+''')
+
+def _configuracion():
+    """Devuelve el dict de configuración cacheado (cargándolo si hace falta)"""
+    global _config, _config_cargada
+    with _config_lock:
+        if _config is not None and time.monotonic() - _config_cargada < CACHE_CONFIG_TTL:
+            return _config
+        generacion = _config_generacion
+    filas = execute_query(CONFIG_TODAS)
+    config = {f['clave']: f['valor'] for f in filas}
+    with _config_lock:
+        # Si se guardó algo mientras se consultaba, lo leído puede ser anterior:
+        # no dejarlo en la caché (se vuelve a cargar en la próxima lectura)
+        if generacion == _config_generacion:
+            _config = config
+            _config_cargada = time.monotonic()
+        return config
+
+def obtener_configuracion():
+    """Obtiene toda la configuración como dict (una sola consulta como máximo)"""
+    return dict(_configuracion())
+
 def obtener_config(clave, default=None):
     """Obtiene un valor de configuración"""
-    rows = execute_query('SELECT valor FROM configuracion WHERE clave = ?', (clave,))
-    return rows[0]['valor'] if rows else default
+    config = _configuracion()
+    return config[clave] if clave in config else default
 
 def guardar_config(clave, valor):
     """Guarda un valor de configuración"""
-    if USE_POSTGRES:
-        execute_query('''
-            INSERT INTO configuracion (clave, valor) VALUES (?, ?)
-            ON CONFLICT (clave) DO UPDATE SET valor = EXCLUDED.valor
-        ''', (clave, valor), fetch=False)
-    else:
-        execute_query('''
-            INSERT OR REPLACE INTO configuracion (clave, valor) VALUES (?, ?)
-        ''', (clave, valor), fetch=False)
+    guardar_config_many({clave: valor})
+
+def guardar_config_many(valores):
+    """Guarda varios valores de configuración en una sola transacción"""
+    global _config, _config_generacion
+    # Como texto, igual que vuelven de la base al recargar (None queda NULL)
+    valores = {k: None if v is None else str(v) for k, v in valores.items()}
+    with conexion() as conn:
+        cursor = conn.cursor()
+        inicio = time.perf_counter()
+        error = True
+        try:
+            cursor.executemany(CONFIG_GUARDAR.texto(conn), list(valores.items()))
+            conn.commit()
+            error = False
+        finally:
+            _registrar_consulta('guardar_config_many', CONFIG_GUARDAR.sql, None,
+                                time.perf_counter() - inicio, len(valores), error)
+            cursor.close()
+    
+    with _config_lock:
+        _config_generacion += 1
+        if _config is not None:
+            # Dict nuevo en vez de update(): otros hilos leen el actual sin lock
+            _config = {**_config, **valores}
 
-# Inicializar BD al importar
-init_db()
+# Inicializar BD al importar (solo una consulta si el esquema está al día)
+migrar()
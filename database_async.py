@@ -0,0 +1,72 @@
+"""
+Acceso asíncrono a la base de datos para los handlers de Flet
+Ejecuta las funciones de database en un pool de hilos para no bloquear la sesión
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import database
+
+# Mismo tamaño que el pool de conexiones: más hilos solo esperarían conexión
+_executor = ThreadPoolExecutor(max_workers=database.POOL_MAX, thread_name_prefix='db')
+
+# Tareas de minutos (envío masivo de reportes): hilo aparte para no tener
+# ocupado un lugar del pool de arriba, que comparten todas las sesiones
+_executor_largas = ThreadPoolExecutor(max_workers=1, thread_name_prefix='larga')
+
+async def en_hilo(funcion, *args, **kwargs):
+    """Ejecuta cualquier función bloqueante (BD, SMTP) en el pool y espera el resultado"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(funcion, *args, **kwargs))
+
+async def en_hilo_largo(funcion, *args, **kwargs):
+    """Como en_hilo, para tareas largas (una a la vez, fuera del pool de la BD)"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor_largas, functools.partial(funcion, *args, **kwargs))
+
+def _asincrona(funcion):
+    """Versión awaitable de una función de database"""
+    @functools.wraps(funcion)
+    async def envoltura(*args, **kwargs):
+        return await en_hilo(funcion, *args, **kwargs)
+    return envoltura
+
+# ============== CLIENTES / SOPORTISTAS ==============
+obtener_clientes = _asincrona(database.obtener_clientes)
+obtener_cliente = _asincrona(database.obtener_cliente)
+guardar_cliente = _asincrona(database.guardar_cliente)
+eliminar_cliente = _asincrona(database.eliminar_cliente)
+obtener_soportistas = _asincrona(database.obtener_soportistas)
+obtener_soportista = _asincrona(database.obtener_soportista)
+guardar_soportista = _asincrona(database.guardar_soportista)
+eliminar_soportista = _asincrona(database.eliminar_soportista)
+
+# ============== VISITAS ==============
+guardar_visita = _asincrona(database.guardar_visita)
+obtener_visita = _asincrona(database.obtener_visita)
+obtener_visitas_cliente = _asincrona(database.obtener_visitas_cliente)
+listar_visitas_cliente = _asincrona(database.listar_visitas_cliente)
+obtener_totales_visitas_cliente = _asincrona(database.obtener_totales_visitas_cliente)
+obtener_pendientes = _asincrona(database.obtener_pendientes)
+listar_pendientes = _asincrona(database.listar_pendientes)
+resolver_pendiente = _asincrona(database.resolver_pendiente)
+
+# ============== ESTADÍSTICAS / BÚSQUEDA ==============
+obtener_estadisticas_clientes = _asincrona(database.obtener_estadisticas_clientes)
+obtener_clientes_sin_boletas = _asincrona(database.obtener_clientes_sin_boletas)
+obtener_clientes_con_visitas = _asincrona(database.obtener_clientes_con_visitas)
+buscar_texto = _asincrona(database.buscar_texto)
+
+# ============== TAREAS ==============
+obtener_tareas = _asincrona(database.obtener_tareas)
+guardar_tarea = _asincrona(database.guardar_tarea)
+completar_tarea = _asincrona(database.completar_tarea)
+eliminar_tarea = _asincrona(database.eliminar_tarea)
+contar_pendientes = _asincrona(database.contar_pendientes)
+contar_pendientes_total = _asincrona(database.contar_pendientes_total)
+
+# ============== CONFIGURACIÓN ==============
+obtener_configuracion = _asincrona(database.obtener_configuracion)
+obtener_config = _asincrona(database.obtener_config)
+guardar_config = _asincrona(database.guardar_config)
+guardar_config_many = _asincrona(database.guardar_config_many)
@@ -0,0 +1,132 @@
+"""
+Exportación de visitas y estadísticas a CSV y NDJSON
+
+Las filas se leen de a lote (cursor del lado del servidor en PostgreSQL) y se
+escriben en trozos: la memoria no crece con la cantidad de filas. Se usa desde
+la ruta HTTP /exportar/{tipo} (web.py) o desde la línea de comandos.
+
+Uso:
+    python exportar.py visitas csv --desde 2025-01-01 --hasta 2025-12-31 --salida visitas_2025.csv
+    python exportar.py visitas ndjson --cliente 12 --salida cliente_12.ndjson
+    python exportar.py estadisticas csv --soportista 3 --desde 2025-01-01 --hasta 2025-12-31
+"""
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import sys
+
+# database avisa por stdout al conectar y migrar: a stderr, para que
+# "python exportar.py ... > visitas.csv" deje solo los datos en el archivo
+with contextlib.redirect_stdout(sys.stderr):
+    import database as db
+
+# Excel en español espera ';' como separador: CSV_SEPARADOR=';'
+CSV_SEPARADOR = os.environ.get('CSV_SEPARADOR', ',')
+LOTE = 1000  # filas por lectura y por trozo escrito
+
+# tipo -> (función que itera las filas, filtros que acepta, columnas del archivo)
+EXPORTACIONES = {
+    # soportista_id: técnico que hizo la visita
+    'visitas': (
+        db.iterar_visitas,
+        ('cliente_id', 'soportista_id', 'fecha_desde', 'fecha_hasta'),
+        ('id', 'fecha', 'hora_inicio', 'duracion_minutos', 'cliente_id', 'cliente_nombre',
+         'soportista_id', 'soportista_nombre', 'persona_atendida', 'trabajo_realizado',
+         'tiene_pendiente', 'descripcion_pendiente', 'pendiente_resuelto'),
+    ),
+    # soportista_id: soportista asignado al cliente (como en Estadísticas)
+    'estadisticas': (
+        db.iterar_estadisticas_clientes,
+        ('soportista_id', 'fecha_desde', 'fecha_hasta'),
+        ('id', 'cliente_nombre', 'cantidad_boletas', 'tiempo_total'),
+    ),
+}
+
+FORMATOS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+
+def exportar(tipo, formato, **filtros):
+    """Iterador de trozos de texto con la exportación pedida. Los filtros vacíos
+    se ignoran; un tipo, formato o filtro desconocido da ValueError (antes de
+    tocar la base)"""
+    if tipo not in EXPORTACIONES:
+        raise ValueError(f"Tipo de exportación desconocido: {tipo}")
+    if formato not in FORMATOS:
+        raise ValueError(f"Formato desconocido: {formato}")
+    iterar, permitidos, columnas = EXPORTACIONES[tipo]
+    filtros = {k: v for k, v in filtros.items() if v not in (None, '')}
+    sobrantes = set(filtros) - set(permitidos)
+    if sobrantes:
+        raise ValueError(f"Filtros no válidos para {tipo}: {', '.join(sorted(sobrantes))}")
+
+    filas = iterar(**filtros, lote=LOTE)
+    if formato == 'csv':
+        return _partes_csv(filas, columnas)
+    return _partes_ndjson(filas, columnas)
+
+def _partes_csv(filas, columnas):
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer, delimiter=CSV_SEPARADOR)
+    # BOM: Excel abre el archivo como UTF-8 (acentos y ñ)
+    buffer.write('\ufeff')
+    escritor.writerow(columnas)
+    for i, fila in enumerate(filas, 1):
+        escritor.writerow([fila[c] for c in columnas])
+        if i % LOTE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def _partes_ndjson(filas, columnas):
+    lineas = []
+    for fila in filas:
+        # default=str: fechas/horas de PostgreSQL
+        lineas.append(json.dumps({c: fila[c] for c in columnas}, ensure_ascii=False, default=str))
+        if len(lineas) == LOTE:
+            yield '\n'.join(lineas) + '\n'
+            lineas.clear()
+    if lineas:
+        yield '\n'.join(lineas) + '\n'
+
+def exportar_a_archivo(ruta, tipo, formato, **filtros):
+    """Escribe la exportación en un archivo. Devuelve la ruta"""
+    partes = exportar(tipo, formato, **filtros)
+    with open(ruta, 'w', encoding='utf-8', newline='') as archivo:
+        archivo.writelines(partes)
+    return ruta
+
+def main():
+    parser = argparse.ArgumentParser(description="Exporta visitas o estadísticas a CSV/NDJSON")
+    parser.add_argument('tipo', choices=sorted(EXPORTACIONES))
+    parser.add_argument('formato', choices=sorted(FORMATOS))
+    parser.add_argument('--cliente', type=int, help="Solo visitas de este cliente")
+    parser.add_argument('--soportista', type=int)
+    parser.add_argument('--desde', help="Fecha inicial (AAAA-MM-DD)")
+    parser.add_argument('--hasta', help="Fecha final (AAAA-MM-DD)")
+    parser.add_argument('--salida', help="Archivo de salida (por defecto stdout)")
+    args = parser.parse_args()
+
+    filtros = {'soportista_id': args.soportista, 'fecha_desde': args.desde, 'fecha_hasta': args.hasta}
+    if args.cliente:
+        filtros['cliente_id'] = args.cliente
+    try:
+        if args.salida:
+            exportar_a_archivo(args.salida, args.tipo, args.formato, **filtros)
+            print(f"✅ Exportado a {args.salida}", file=sys.stderr)
+        else:
+            # Los datos van a stdout; cualquier print de la BD mientras se
+            # recorre (p. ej. consulta lenta) va a stderr
+            salida = sys.stdout
+            with contextlib.redirect_stdout(sys.stderr):
+                salida.writelines(exportar(args.tipo, args.formato, **filtros))
+    except ValueError as e:
+        parser.error(str(e))
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,25 @@
 App Soporte - Gestión de Visitas Técnicas
 """
 import flet as ft
+import asyncio
 import os
 from datetime import datetime, date, timedelta
 import database as db
+import database_async as dba
 import correo
 
+# Rutas HTTP de reportes/boletas: necesitan FastAPI y uvicorn (vienen con flet-web);
+# sin ellos la app funciona igual pero sin los enlaces imprimibles
+try:
+    import web
+except ImportError as e:
+    print(f"⚠️ Sin rutas HTTP de reportes: {e}")
+    web = None
+
+# Envío masivo de reportes en curso: uno a la vez para todas las sesiones
+# (un segundo envío mandaría cada reporte dos veces)
+envio_reportes = {"en_curso": False}
+
 def main(page: ft.Page):
     """Aplicación principal"""
     
@@ -66,6 +80,20 @@ def main(page: ft.Page):
         except Exception as ex:
             print(f"Error mostrando mensaje: {ex}")
     
+    def crear_progreso():
+        """Barra de progreso (oculta) para operaciones de base de datos"""
+        return ft.ProgressBar(visible=False, color="#2196f3", bgcolor="#e3f2fd")
+    
+    async def con_progreso(progreso, corrutina):
+        """Muestra el indicador mientras se espera una operación lenta sin bloquear la sesión"""
+        progreso.visible = True
+        page.update()
+        try:
+            return await corrutina
+        finally:
+            progreso.visible = False
+            page.update()
+    
     def confirmar_accion(titulo, mensaje, on_confirmar):
         """Muestra diálogo de confirmación"""
         def cerrar(e):
@@ -505,7 +533,9 @@ def main(page: ft.Page):
         
         chk_pendiente.on_change = toggle_pendiente
         
-        def guardar(e):
+        progreso = crear_progreso()
+        
+        async def guardar(e):
             # Validaciones
             if not dd_cliente.value:
                 mostrar_mensaje("Seleccione un cliente", True)
@@ -526,32 +556,49 @@ def main(page: ft.Page):
             # Guardar soportista en sesión para próximas visitas
             soportista_sesion["id"] = int(dd_soportista.value)
             
-            visita_id = db.guardar_visita(
-                cliente_id=int(dd_cliente.value),
-                soportista_id=int(dd_soportista.value),
-                persona_atendida=txt_persona.value.strip(),
-                fecha=txt_fecha.value,
-                hora_inicio=txt_hora.value,
-                duracion_minutos=duracion,
-                trabajo_realizado=txt_trabajo.value.strip(),
-                tiene_pendiente=chk_pendiente.value,
-                descripcion_pendiente=txt_pendiente.value.strip() if chk_pendiente.value else None,
-                id=id
-            )
+            # Evitar doble guardado mientras se espera la BD
+            e.control.disabled = True
+            page.update()
+            
+            # Si hay que enviar la boleta, guardar_visita devuelve la visita completa
+            # (con nombre y correo del cliente) en la misma transacción
+            try:
+                visita_guardada = await con_progreso(progreso, dba.guardar_visita(
+                    cliente_id=int(dd_cliente.value),
+                    soportista_id=int(dd_soportista.value),
+                    persona_atendida=txt_persona.value.strip(),
+                    fecha=txt_fecha.value,
+                    hora_inicio=txt_hora.value,
+                    duracion_minutos=duracion,
+                    trabajo_realizado=txt_trabajo.value.strip(),
+                    tiene_pendiente=chk_pendiente.value,
+                    descripcion_pendiente=txt_pendiente.value.strip() if chk_pendiente.value else None,
+                    id=id,
+                    devolver_fila=bool(chk_enviar_correo.value)
+                ))
+            except Exception as ex:
+                print(f"Error guardando visita: {ex}")
+                mostrar_mensaje(f"Error al guardar: {str(ex)}", True)
+                return
+            finally:
+                # Si falló se puede volver a intentar; si no, igual se sale de la pantalla
+                e.control.disabled = False
+                page.update()
             
             mostrar_mensaje("Visita guardada")
             
             # Enviar correo solo si está marcado el checkbox
             if chk_enviar_correo.value:
-                visita_guardada = db.obtener_visita(visita_id)
-                if visita_guardada.get('cliente_correo'):
+                if visita_guardada and visita_guardada.get('cliente_correo'):
+                    # Se envía en segundo plano: no esperar al servidor SMTP
                     html = correo.generar_html_boleta(visita_guardada)
-                    ok, msg = correo.enviar_correo(
+                    await dba.en_hilo(
+                        correo.encolar_correo,
                         visita_guardada['cliente_correo'],
                         f"Boleta de Visita - {visita_guardada['fecha']}",
                         html
                     )
-                    mostrar_mensaje(msg, not ok)
+                    mostrar_mensaje("Visita guardada. 📤 Boleta en cola de envío")
                 else:
                     mostrar_mensaje("El cliente no tiene correo configurado", True)
             
@@ -574,6 +621,7 @@ def main(page: ft.Page):
                     # Fila 3: Pendiente y Enviar correo juntos
                     ft.Row([chk_pendiente, chk_enviar_correo], spacing=10),
                     txt_pendiente,
+                    progreso,
                     ft.ElevatedButton("Guardar Visita", icon=ft.Icons.SAVE, bgcolor="#4caf50", color="white", width=float("inf"), on_click=guardar)
                 ], spacing=12, scroll=ft.ScrollMode.AUTO),
                 padding=20,
@@ -590,15 +638,16 @@ def main(page: ft.Page):
         
         lista = ft.ListView(spacing=10, padding=15, expand=True)
         lbl_contador = ft.Text("", size=14, weight=ft.FontWeight.BOLD, color="#f44336")
-        
-        def cargar():
+        progreso = crear_progreso()
+        
+        async def cargar():
+            # 1. Tareas independientes y 2. pendientes de visitas, en paralelo
+            tareas, pendientes_visitas = await con_progreso(progreso, asyncio.gather(
+                dba.obtener_tareas(solo_pendientes=True),
+                dba.listar_pendientes()
+            ))
             lista.controls.clear()
             
-            # 1. Tareas independientes
-            tareas = db.obtener_tareas(solo_pendientes=True)
-            # 2. Pendientes de visitas
-            pendientes_visitas = db.obtener_pendientes()
-            
             total = len(tareas) + len(pendientes_visitas)
             lbl_contador.value = f"🔴 {total} pendientes" if total > 0 else "✅ Sin pendientes"
             lbl_contador.color = "#f44336" if total > 0 else "#4caf50"
@@ -656,7 +705,7 @@ def main(page: ft.Page):
                                 ft.Text(p['cliente_nombre'], weight=ft.FontWeight.BOLD, expand=True),
                                 ft.Text(p['fecha'], size=12, color="#666")
                             ]),
-                            ft.Text(p['descripcion_pendiente'] or "Sin descripción", size=13),
+                            ft.Text(db.recortar_resumen(p['pendiente_resumen']) or "Sin descripción", size=13),
                             ft.Text(f"Técnico: {p['soportista_nombre']}", size=11, color="#999"),
                             ft.Row([
                                 ft.TextButton("✅ Resolver", on_click=lambda e, id=p['id']: resolver_visita(id)),
@@ -687,17 +736,17 @@ def main(page: ft.Page):
         def completar_tarea(id):
             db.completar_tarea(id)
             mostrar_mensaje("✅ Tarea completada")
-            cargar()
+            page.run_task(cargar)
         
         def eliminar_tarea(id):
             db.eliminar_tarea(id)
             mostrar_mensaje("🗑️ Tarea eliminada")
-            cargar()
+            page.run_task(cargar)
         
         def resolver_visita(id):
             db.resolver_pendiente(id)
             mostrar_mensaje("✅ Pendiente resuelto")
-            cargar()
+            page.run_task(cargar)
         
         def ver_boleta(id):
             visita = db.obtener_visita(id)
@@ -746,7 +795,7 @@ def main(page: ft.Page):
                 dlg.open = False
                 page.update()
                 mostrar_mensaje("✅ Tarea creada")
-                cargar()
+                page.run_task(cargar)
             
             dlg = ft.AlertDialog(
                 modal=True,
@@ -775,23 +824,29 @@ def main(page: ft.Page):
                         ft.Container(expand=True),
                         ft.ElevatedButton("➕ Nueva Tarea", bgcolor="#9c27b0", color="white", on_click=nueva_tarea)
                     ], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
+                    progreso,
                     ft.Container(content=lista, expand=True)
                 ], spacing=10),
                 padding=15,
                 expand=True
             )
         )
-        cargar()
+        page.run_task(cargar)
     
     def mostrar_detalle_visita(visita):
         """Muestra detalle de una visita"""
         page.clean()
+        progreso = crear_progreso()
         
-        def enviar(e):
+        async def enviar(e):
             if visita.get('cliente_correo'):
-                html = correo.generar_html_boleta(visita)
-                ok, msg = correo.enviar_correo(visita['cliente_correo'], f"Boleta de Visita - {visita['fecha']}", html)
-                mostrar_mensaje(msg, not ok)
+                html = await con_progreso(progreso, dba.en_hilo(correo.boleta_cacheada, visita['id']))
+                if html is None:
+                    # Se borró la visita desde que se abrió el detalle
+                    mostrar_mensaje("Boleta no encontrada", True)
+                    return
+                await dba.en_hilo(correo.encolar_correo, visita['cliente_correo'], f"Boleta de Visita - {visita['fecha']}", html)
+                mostrar_mensaje("📤 Boleta en cola de envío")
             else:
                 mostrar_mensaje("El cliente no tiene correo", True)
         
@@ -824,7 +879,10 @@ def main(page: ft.Page):
                             padding=20
                         )
                     ),
-                    ft.ElevatedButton("📧 Enviar por Correo", bgcolor="#2196f3", color="white", width=float("inf"), on_click=enviar)
+                    ft.ElevatedButton("📧 Enviar por Correo", bgcolor="#2196f3", color="white", width=float("inf"), on_click=enviar),
+                    progreso,
+                    ft.ElevatedButton("🖨️ Abrir boleta", bgcolor="#757575", color="white", width=float("inf"),
+                                      url=web.url_boleta(visita['id']) if web else None, visible=bool(web))
                 ], spacing=15),
                 padding=20
             )
@@ -923,36 +981,124 @@ def main(page: ft.Page):
         
         lista = ft.ListView(spacing=10, expand=True)
         lbl_resumen = ft.Text("", size=14, weight=ft.FontWeight.BOLD)
+        progreso = crear_progreso()
+        
+        POR_PAGINA = 50
+        visitas_resultado = []  # solo las páginas ya cargadas
+        filtro_resultado = {}  # cliente y fechas de la última búsqueda (para el reporte)
+        cliente_resultado = {}  # id y nombre del cliente de esa búsqueda (el selector puede haber cambiado)
+        pagina = {"total": 0, "cargando": False, "busqueda": 0}
+        btn_cargar_mas = ft.TextButton("⬇️ Cargar más boletas")
+        # Enlace al reporte imprimible (ruta HTTP de web.py); se arma con cada búsqueda
+        btn_imprimible = ft.ElevatedButton("🖨️ Reporte imprimible", bgcolor="#757575", color="white",
+                                           expand=True, visible=False)
+        btn_csv = ft.ElevatedButton("⬇️ CSV", bgcolor="#757575", color="white", visible=False)
+        
+        async def abrir_boleta(id):
+            """Carga la boleta completa (texto sin recortar) y abre su detalle"""
+            visita = await con_progreso(progreso, dba.obtener_visita(id))
+            if not visita:
+                mostrar_mensaje("Boleta no encontrada", True)
+                return
+            mostrar_detalle_visita(visita)
+        
+        def tarjeta_visita(v):
+            """Card de una boleta (con resumen del trabajo; al tocarla se abre completa)"""
+            boleta_id = v.get('id', '?')
+            fecha = v.get('fecha', 'Sin fecha')
+            hora = v.get('hora_inicio', '??:??')
+            duracion = v.get('duracion_minutos', 0)
+            soportista = v.get('soportista_nombre', 'SIN TÉCNICO')
+            trabajo = db.recortar_resumen(v.get('trabajo_resumen')) or '(sin detalle)'
+            
+            # Crear Card con cada campo en línea separada
+            return ft.Card(
+                content=ft.Container(
+                    content=ft.Column([
+                        ft.Text(f"📋 Boleta #{boleta_id} - {fecha}", size=14, weight=ft.FontWeight.BOLD, color="#1976d2"),
+                        ft.Text(f"Hora: {hora}", size=12),
+                        ft.Text(f"Duración: {db.formatear_duracion(duracion)}", size=12),
+                        ft.Text(f"Técnico: {soportista}", size=12),
+                        ft.Divider(height=1),
+                        ft.Text(f"Trabajo: {trabajo}", size=13),
+                    ], spacing=3),
+                    padding=12,
+                    on_click=lambda ev, id=boleta_id: page.run_task(abrir_boleta, id)
+                )
+            )
+        
+        async def cargar_pagina():
+            """Agrega la siguiente página de boletas al final de la lista"""
+            if pagina["cargando"] or len(visitas_resultado) >= pagina["total"]:
+                return
+            pagina["cargando"] = True
+            busqueda = pagina["busqueda"]
+            try:
+                despues_de = db.clave_visita(visitas_resultado[-1]) if visitas_resultado else None
+                nuevas = await con_progreso(progreso, dba.listar_visitas_cliente(
+                    **filtro_resultado, limite=POR_PAGINA, despues_de=despues_de
+                ))
+                if busqueda != pagina["busqueda"]:
+                    return  # Se hizo otra búsqueda mientras se cargaba esta página
+                visitas_resultado.extend(nuevas)
+                if btn_cargar_mas in lista.controls:
+                    lista.controls.remove(btn_cargar_mas)
+                lista.controls.extend(tarjeta_visita(v) for v in nuevas)
+                # Si la BD cambió y la página vino incompleta, no quedan más
+                if len(nuevas) < POR_PAGINA:
+                    pagina["total"] = len(visitas_resultado)
+                if len(visitas_resultado) < pagina["total"]:
+                    lista.controls.append(btn_cargar_mas)
+                page.update()
+            finally:
+                if busqueda == pagina["busqueda"]:
+                    pagina["cargando"] = False
+        
+        async def cargar_mas(e):
+            await cargar_pagina()
+        
+        async def al_desplazar(e):
+            # Cerca del final de la lista: traer la siguiente página
+            if e.max_scroll_extent and e.pixels >= e.max_scroll_extent - 300:
+                await cargar_pagina()
         
-        visitas_resultado = []
+        btn_cargar_mas.on_click = cargar_mas
+        lista.on_scroll = al_desplazar
         
-        def buscar(e):
-            nonlocal visitas_resultado
+        async def buscar(e):
+            nonlocal visitas_resultado, filtro_resultado, cliente_resultado
             if not cliente_seleccionado["id"]:
                 mostrar_mensaje("Seleccione un cliente de la lista", True)
                 return
             
-            visitas_resultado = db.obtener_visitas_cliente(
-                int(cliente_seleccionado["id"]),
-                txt_desde.value,
-                txt_hasta.value
-            )
-            
-            # DEBUG: imprimir datos de la primera visita
-            if visitas_resultado:
-                print(f"DEBUG v1.0.8 - Primera visita: {visitas_resultado[0]}")
+            cliente_resultado = {"id": int(cliente_seleccionado["id"]), "nombre": cliente_seleccionado["nombre"]}
+            # La lista solo trae un resumen; el texto completo se carga al abrir una boleta
+            filtro_resultado = {
+                "cliente_id": cliente_resultado["id"],
+                "fecha_desde": txt_desde.value,
+                "fecha_hasta": txt_hasta.value,
+            }
+            # Los totales salen de una consulta de agregado, sin traer todas las boletas
+            totales = await con_progreso(progreso, dba.obtener_totales_visitas_cliente(**filtro_resultado))
+            visitas_resultado = []
+            if web and totales['visitas']:
+                btn_imprimible.url = web.url_reporte(**filtro_resultado)
+                btn_csv.url = web.url_exportacion('visitas', 'csv', **filtro_resultado)
+                btn_imprimible.visible = btn_csv.visible = True
+            else:
+                btn_imprimible.visible = btn_csv.visible = False
+            pagina.update(total=totales['visitas'], cargando=False, busqueda=pagina["busqueda"] + 1)
             
             lista.controls.clear()
             
             # Resumen al inicio
-            if visitas_resultado:
-                tiempo_total = db.calcular_tiempo_total(visitas_resultado)
+            if totales['visitas']:
                 lista.controls.append(
                     ft.Container(
                         content=ft.Row([
                             ft.Container(
                                 content=ft.Column([
-                                    ft.Text(str(len(visitas_resultado)), size=28, weight=ft.FontWeight.BOLD, color="#2196f3"),
+                                    ft.Text(str(totales['visitas']), size=28, weight=ft.FontWeight.BOLD, color="#2196f3"),
                                     ft.Text("Visitas", size=12, color="#666")
                                 ], horizontal_alignment=ft.CrossAxisAlignment.CENTER, spacing=0),
                                 expand=True
@@ -960,7 +1106,7 @@ def main(page: ft.Page):
                             ft.Container(width=1, height=50, bgcolor="#ccc"),
                             ft.Container(
                                 content=ft.Column([
-                                    ft.Text(db.formatear_duracion(tiempo_total), size=28, weight=ft.FontWeight.BOLD, color="#4caf50"),
+                                    ft.Text(db.formatear_duracion(totales['minutos']), size=28, weight=ft.FontWeight.BOLD, color="#4caf50"),
                                     ft.Text("Tiempo Total", size=12, color="#666")
                                 ], horizontal_alignment=ft.CrossAxisAlignment.CENTER, spacing=0),
                                 expand=True
@@ -971,81 +1117,89 @@ def main(page: ft.Page):
                         padding=15
                     )
                 )
-            
-            # Lista de visitas - CON LABELS EXPLÍCITOS
-            for v in visitas_resultado:
-                boleta_id = v.get('id', '?')
-                fecha = v.get('fecha', 'Sin fecha')
-                hora = v.get('hora_inicio', '??:??')
-                duracion = v.get('duracion_minutos', 0)
-                soportista = v.get('soportista_nombre', 'SIN TÉCNICO')
-                trabajo = v.get('trabajo_realizado', '(sin detalle)')
-                
-                # Crear Card con cada campo en línea separada
-                card = ft.Card(
-                    content=ft.Container(
-                        content=ft.Column([
-                            ft.Text(f"📋 Boleta #{boleta_id} - {fecha}", size=14, weight=ft.FontWeight.BOLD, color="#1976d2"),
-                            ft.Text(f"Hora: {hora}", size=12),
-                            ft.Text(f"Duración: {db.formatear_duracion(duracion)}", size=12),
-                            ft.Text(f"Técnico: {soportista}", size=12),
-                            ft.Divider(height=1),
-                            ft.Text(f"Trabajo: {trabajo}", size=13),
-                        ], spacing=3),
-                        padding=12
-                    )
+            else:
+                lista.controls.append(
+                    ft.Text("No se encontraron visitas en el período seleccionado", 
+                           text_align=ft.TextAlign.CENTER, color="#666")
                 )
-                lista.controls.append(card)
             
+            lbl_resumen.value = ""
+            page.update()
+            
+            # Primera página de boletas; el resto al desplazarse o con "Cargar más"
+            await cargar_pagina()
+        
+        # Búsqueda de texto en boletas (trabajo, pendientes, persona atendida, tareas)
+        txt_buscar_texto = ft.TextField(
+            label="🔎 Buscar en boletas",
+            hint_text="Ej: impresora contabilidad",
+            border_radius=10,
+            expand=True,
+            text_size=13
+        )
+        
+        async def buscar_texto(e):
+            texto = (txt_buscar_texto.value or "").strip()
+            if not texto:
+                mostrar_mensaje("Escriba qué desea buscar", True)
+                return
             
+            # Si hay cliente seleccionado se busca solo en sus boletas
+            resultados = await con_progreso(progreso, dba.buscar_texto(texto, cliente_id=cliente_seleccionado["id"]))
             
-            if not visitas_resultado:
+            lista.controls.clear()
+            # La lista ya no muestra las boletas paginadas: no seguir cargando páginas
+            pagina.update(total=len(visitas_resultado), cargando=False, busqueda=pagina["busqueda"] + 1)
+            lbl_resumen.value = f"🔎 {len(resultados)} resultados para \"{texto}\""
+            
+            for r in resultados:
+                es_visita = r['tipo'] == 'visita'
+                titulo = f"📋 Boleta #{r['id']} - {r['fecha']}" if es_visita else f"📝 Tarea #{r['id']}"
                 lista.controls.append(
-                    ft.Text("No se encontraron visitas en el período seleccionado", 
-                           text_align=ft.TextAlign.CENTER, color="#666")
+                    ft.Card(
+                        content=ft.Container(
+                            content=ft.Column([
+                                ft.Text(titulo, size=14, weight=ft.FontWeight.BOLD, color="#1976d2" if es_visita else "#9c27b0"),
+                                ft.Text(f"Cliente: {r.get('cliente_nombre') or '-'} | Técnico: {r.get('soportista_nombre') or '-'}", size=12),
+                                ft.Text(r.get('fragmento') or "", size=13, italic=True),
+                            ], spacing=3),
+                            padding=12,
+                            on_click=(lambda ev, id=r['id']: page.run_task(abrir_boleta, id)) if es_visita else None
+                        )
+                    )
                 )
             
-            lbl_resumen.value = ""
+            if not resultados:
+                lista.controls.append(
+                    ft.Text("No se encontraron boletas con ese texto", text_align=ft.TextAlign.CENTER, color="#666")
+                )
             page.update()
         
-        def ver_reporte(e):
+        txt_buscar_texto.on_submit = buscar_texto
+        
+        async def ver_reporte(e):
             """Navega a pantalla de reporte para copiar"""
             if not visitas_resultado:
                 mostrar_mensaje("Primero busque boletas", True)
                 return
             
-            # Generar texto
-            tiempo_total = db.calcular_tiempo_total(visitas_resultado)
-            lineas = [
-                f"REPORTE DE VISITAS",
-                f"Cliente: {cliente_seleccionado['nombre']}",
-                f"Período: {txt_desde.value} al {txt_hasta.value}",
-                f"Total: {len(visitas_resultado)} visitas | {db.formatear_duracion(tiempo_total)}",
-                ""
-            ]
-            for v in visitas_resultado:
-                lineas.append(f"---")
-                lineas.append(f"Boleta #{v.get('id')} | {v.get('fecha')} {v.get('hora_inicio')}")
-                lineas.append(f"Duración: {db.formatear_duracion(v.get('duracion_minutos', 0))}")
-                lineas.append(f"Técnico: {v.get('soportista_nombre', '')}")
-                lineas.append(f"Trabajo: {v.get('trabajo_realizado', '')}")
-            
-            ir_ver_reporte("\n".join(lineas))
-        
-        def enviar_reporte(e):
+            # Texto con el trabajo completo de cada boleta, leyendo las visitas de a lote.
+            # Acá se junta entero: el TextField necesita todo el texto para seleccionarlo
+            # y copiarlo (para imprimir sin juntarlo está el reporte imprimible).
+            # Cliente y fechas de la última búsqueda, aunque después se haya elegido otro cliente
+            texto = await con_progreso(progreso, dba.en_hilo(
+                correo.reporte_cliente_cacheado,
+                cliente_resultado, filtro_resultado['fecha_desde'], filtro_resultado['fecha_hasta'], formato='texto'))
+            ir_ver_reporte(texto)
+        
+        async def enviar_reporte(e):
             try:
-                print("DEBUG: Iniciando enviar_reporte()")
                 if not visitas_resultado:
                     mostrar_mensaje("Primero busque boletas", True)
                     return
                 
-                if not cliente_seleccionado:
-                    mostrar_mensaje("Seleccione un cliente", True)
-                    return
-                
-                print(f"DEBUG: Cliente seleccionado = {cliente_seleccionado}")
-                cliente = db.obtener_cliente(int(cliente_seleccionado["id"]))
-                print(f"DEBUG: Cliente obtenido = {cliente}")
+                # Cliente, fechas y asunto salen todos de la última búsqueda
+                cliente = await dba.obtener_cliente(cliente_resultado["id"])
                 if not cliente:
                     mostrar_mensaje("Cliente no encontrado", True)
                     return
@@ -1054,16 +1208,15 @@ def main(page: ft.Page):
                     mostrar_mensaje(f"El cliente {cliente.get('nombre', '')} no tiene correo configurado", True)
                     return
                 
-                mostrar_mensaje("📤 Enviando correo...")
-                
-                tiempo_total = db.calcular_tiempo_total(visitas_resultado)
-                html = correo.generar_html_reporte(cliente, visitas_resultado, txt_desde.value, txt_hasta.value, tiempo_total)
-                ok, msg = correo.enviar_correo(
+                desde, hasta = filtro_resultado['fecha_desde'], filtro_resultado['fecha_hasta']
+                html = await con_progreso(progreso, dba.en_hilo(correo.reporte_cliente_cacheado, cliente, desde, hasta))
+                await dba.en_hilo(
+                    correo.encolar_correo,
                     cliente['correo'],
-                    f"Reporte de Visitas {txt_desde.value} al {txt_hasta.value}",
+                    f"Reporte de Visitas {correo.texto_periodo(desde, hasta)}",
                     html
                 )
-                mostrar_mensaje(msg, not ok)
+                mostrar_mensaje("📤 Reporte en cola de envío")
             except Exception as ex:
                 mostrar_mensaje(f"Error: {str(ex)}", True)
         
@@ -1075,6 +1228,9 @@ def main(page: ft.Page):
                     ft.Row([txt_desde, btn_cal_desde, txt_hasta, btn_cal_hasta], spacing=2, vertical_alignment=ft.CrossAxisAlignment.CENTER),
                     ft.ElevatedButton("Buscar", icon=ft.Icons.SEARCH, bgcolor="#2196f3", color="white", width=float("inf"), on_click=buscar),
                     ft.ElevatedButton("📋 Ver Reporte", bgcolor="#ff9800", color="white", width=float("inf"), on_click=ver_reporte),
+                    ft.Row([btn_imprimible, btn_csv], spacing=10),
+                    ft.Row([txt_buscar_texto, ft.IconButton(icon=ft.Icons.MANAGE_SEARCH, tooltip="Buscar texto", on_click=buscar_texto)], spacing=2),
+                    progreso,
                     lbl_resumen,
                     lista
                 ], spacing=12),
@@ -1120,14 +1276,37 @@ def main(page: ft.Page):
         
         lista = ft.ListView(expand=True, spacing=5)
         lbl_resumen = ft.Text("", size=14, weight=ft.FontWeight.BOLD)
+        progreso = crear_progreso()
         
-        def buscar(e):
-            lista.controls.clear()
+        # Descargas completas (rutas HTTP de web.py); los enlaces se arman con cada búsqueda
+        btn_csv_visitas = ft.TextButton("⬇️ Visitas CSV")
+        btn_ndjson_visitas = ft.TextButton("⬇️ Visitas NDJSON")
+        btn_csv_resumen = ft.TextButton("⬇️ Resumen CSV")
+        fila_descargas = ft.Row([btn_csv_visitas, btn_ndjson_visitas, btn_csv_resumen],
+                                alignment=ft.MainAxisAlignment.CENTER, wrap=True, visible=False)
+        
+        def actualizar_descargas(sop_id):
+            if not web:
+                return
+            filtros = {'soportista_id': sop_id, 'fecha_desde': txt_desde.value, 'fecha_hasta': txt_hasta.value}
+            btn_csv_visitas.url = web.url_exportacion('visitas', 'csv', **filtros)
+            btn_ndjson_visitas.url = web.url_exportacion('visitas', 'ndjson', **filtros)
+            btn_csv_resumen.url = web.url_exportacion('estadisticas', 'csv', **filtros)
+            fila_descargas.visible = True
+        
+        def texto_ultima_visita(r):
+            if r.get('dias_sin_visita') is None:
+                return "Sin visitas registradas"
+            return f"Última visita: {r['ultima_visita']} (hace {r['dias_sin_visita']} días)"
+        
+        async def buscar(e):
             sop_id = int(dd_soportista.value) if dd_soportista.value else None
+            actualizar_descargas(sop_id)
             
             if chk_sin_boletas.value:
                 # Clientes SIN boletas en el período
-                resultados = db.obtener_clientes_sin_boletas(sop_id, txt_desde.value, txt_hasta.value)
+                resultados = await con_progreso(progreso, dba.obtener_clientes_sin_boletas(sop_id, txt_desde.value, txt_hasta.value))
+                lista.controls.clear()
                 lbl_resumen.value = f"🚫 {len(resultados)} clientes SIN atender en el período"
                 lbl_resumen.color = "#f44336"
                 
@@ -1137,7 +1316,8 @@ def main(page: ft.Page):
                             content=ft.Container(
                                 content=ft.Column([
                                     ft.Text(r['cliente_nombre'], weight=ft.FontWeight.BOLD, size=14),
-                                    ft.Text(f"Soportista: {r.get('soportista_nombre', 'Sin asignar')}", size=12, color="#666666")
+                                    ft.Text(f"Soportista: {r.get('soportista_nombre', 'Sin asignar')}", size=12, color="#666666"),
+                                    ft.Text(texto_ultima_visita(r), size=11, color="#f44336")
                                 ], spacing=2),
                                 padding=10
                             )
@@ -1145,7 +1325,8 @@ def main(page: ft.Page):
                     )
             else:
                 # Resumen por cliente
-                resultados = db.obtener_estadisticas_clientes(sop_id, txt_desde.value, txt_hasta.value)
+                resultados = await con_progreso(progreso, dba.obtener_estadisticas_clientes(sop_id, txt_desde.value, txt_hasta.value))
+                lista.controls.clear()
                 total_boletas = sum(r['cantidad_boletas'] for r in resultados)
                 total_tiempo = sum(r['tiempo_total'] for r in resultados)
                 lbl_resumen.value = f"📊 {len(resultados)} clientes | {total_boletas} boletas | {db.formatear_duracion(total_tiempo)}"
@@ -1175,11 +1356,11 @@ def main(page: ft.Page):
             
             page.update()
         
-        def exportar(e):
+        async def exportar(e):
             sop_id = int(dd_soportista.value) if dd_soportista.value else None
             
             if chk_sin_boletas.value:
-                resultados = db.obtener_clientes_sin_boletas(sop_id, txt_desde.value, txt_hasta.value)
+                resultados = await con_progreso(progreso, dba.obtener_clientes_sin_boletas(sop_id, txt_desde.value, txt_hasta.value))
                 lineas = [
                     "═══ CLIENTES SIN ATENDER ═══",
                     f"Período: {txt_desde.value} al {txt_hasta.value}",
@@ -1187,9 +1368,9 @@ def main(page: ft.Page):
                     ""
                 ]
                 for r in resultados:
-                    lineas.append(f"• {r['cliente_nombre']}")
+                    lineas.append(f"• {r['cliente_nombre']} - {texto_ultima_visita(r)}")
             else:
-                resultados = db.obtener_estadisticas_clientes(sop_id, txt_desde.value, txt_hasta.value)
+                resultados = await con_progreso(progreso, dba.obtener_estadisticas_clientes(sop_id, txt_desde.value, txt_hasta.value))
                 total_boletas = sum(r['cantidad_boletas'] for r in resultados)
                 total_tiempo = sum(r['tiempo_total'] for r in resultados)
                 lineas = [
@@ -1220,6 +1401,50 @@ def main(page: ft.Page):
             dlg.open = True
             page.update()
         
+        async def enviar_reportes():
+            # Sin await entre la verificación y la marca: ninguna otra sesión se cuela
+            if envio_reportes["en_curso"]:
+                mostrar_mensaje("Ya hay un envío de reportes en curso", True)
+                return
+            envio_reportes["en_curso"] = True
+            btn_enviar_reportes.disabled = True
+            sop_id = int(dd_soportista.value) if dd_soportista.value else None
+            lbl_resumen.value = "📨 Preparando envío..."
+            lbl_resumen.color = "#2196f3"
+            
+            def al_avanzar(hechos, total):
+                # Llamado desde el hilo del envío
+                lbl_resumen.value = f"📨 Enviando reportes: {hechos} de {total}"
+                page.update()
+            
+            try:
+                ok, msg = await con_progreso(progreso, dba.en_hilo_largo(
+                    correo.enviar_reportes_periodo, txt_desde.value, txt_hasta.value, sop_id, al_avanzar=al_avanzar))
+            except Exception as ex:
+                ok, msg = False, f"Error al enviar reportes: {str(ex)}"
+            finally:
+                envio_reportes["en_curso"] = False
+                btn_enviar_reportes.disabled = False
+            lbl_resumen.value = f"📨 {msg}" if ok else f"❌ {msg}"
+            lbl_resumen.color = "#4caf50" if ok else "#f44336"
+            mostrar_mensaje(msg, es_error=not ok)
+        
+        def enviar_reportes_confirmar(e):
+            if envio_reportes["en_curso"]:
+                mostrar_mensaje("Ya hay un envío de reportes en curso", True)
+                return
+            sop = next((s['nombre'] for s in soportistas if str(s['id']) == dd_soportista.value), None)
+            confirmar_accion(
+                "Enviar reportes",
+                f"¿Enviar el reporte del {txt_desde.value} al {txt_hasta.value} a todos los clientes con visitas"
+                f"{' de ' + sop if sop else ''}?",
+                lambda: page.run_task(enviar_reportes)
+            )
+        
+        btn_enviar_reportes = ft.ElevatedButton("📨 Enviar reportes del período", bgcolor="#4caf50", color="white",
+                                                on_click=enviar_reportes_confirmar,
+                                                disabled=envio_reportes["en_curso"])
+        
         page.add(
             crear_appbar("Estadísticas"),
             ft.Container(
@@ -1231,6 +1456,9 @@ def main(page: ft.Page):
                         ft.ElevatedButton("🔍 Buscar", bgcolor="#2196f3", color="white", on_click=buscar),
                         ft.ElevatedButton("📄 Exportar", bgcolor="#ff9800", color="white", on_click=exportar),
                     ], alignment=ft.MainAxisAlignment.CENTER, spacing=10),
+                    ft.Row([btn_enviar_reportes], alignment=ft.MainAxisAlignment.CENTER),
+                    fila_descargas,
+                    progreso,
                     lbl_resumen,
                     ft.Container(content=lista, expand=True, border=ft.border.all(1, "#e0e0e0"), border_radius=10)
                 ], spacing=10),
@@ -1317,24 +1545,46 @@ def main(page: ft.Page):
         """Pantalla de configuración"""
         page.clean()
         
-        txt_host = ft.TextField(label="Servidor SMTP", value=db.obtener_config('smtp_host', ''), border_radius=10, hint_text="smtp.gmail.com")
-        txt_port = ft.TextField(label="Puerto", value=db.obtener_config('smtp_port', '587'), border_radius=10)
-        txt_user = ft.TextField(label="Usuario", value=db.obtener_config('smtp_user', ''), border_radius=10)
-        txt_pass = ft.TextField(label="Contraseña", value=db.obtener_config('smtp_pass', ''), password=True, can_reveal_password=True, border_radius=10)
-        txt_from = ft.TextField(label="Correo remitente", value=db.obtener_config('smtp_from', ''), border_radius=10)
+        config = db.obtener_configuracion()
+        txt_host = ft.TextField(label="Servidor SMTP", value=config.get('smtp_host', ''), border_radius=10, hint_text="smtp.gmail.com")
+        txt_port = ft.TextField(label="Puerto", value=config.get('smtp_port', '587'), border_radius=10)
+        txt_user = ft.TextField(label="Usuario", value=config.get('smtp_user', ''), border_radius=10)
+        txt_pass = ft.TextField(label="Contraseña", value=config.get('smtp_pass', ''), password=True, can_reveal_password=True, border_radius=10)
+        txt_from = ft.TextField(label="Correo remitente", value=config.get('smtp_from', ''), border_radius=10)
         
         lbl_status = ft.Text("", size=12)
+        lbl_cola = ft.Text("", size=12, color="#666")
+        btn_reintentar = ft.TextButton("🔁 Reintentar fallidos", visible=False)
+        
+        def actualizar_cola():
+            """Estado de la cola de correos salientes"""
+            resumen = db.resumen_cola_correos()
+            en_cola = resumen.get('pendiente', 0) + resumen.get('enviando', 0)
+            fallidos = resumen.get('error', 0)
+            lbl_cola.value = f"📬 Cola: {en_cola} por enviar | {resumen.get('enviado', 0)} enviados | {fallidos} con error"
+            btn_reintentar.visible = fallidos > 0
+        
+        def reintentar(e):
+            cantidad = correo.reintentar_correos_fallidos()
+            mostrar_mensaje(f"🔁 {cantidad} correos vuelven a la cola")
+            actualizar_cola()
+            page.update()
+        
+        btn_reintentar.on_click = reintentar
+        actualizar_cola()
         
         def guardar(e):
             try:
                 # Quitar espacios de la contraseña (contraseñas de app vienen con espacios)
                 password = txt_pass.value.replace(" ", "") if txt_pass.value else ""
                 
-                db.guardar_config('smtp_host', txt_host.value.strip())
-                db.guardar_config('smtp_port', txt_port.value.strip())
-                db.guardar_config('smtp_user', txt_user.value.strip())
-                db.guardar_config('smtp_pass', password)
-                db.guardar_config('smtp_from', txt_from.value.strip() or txt_user.value.strip())
+                db.guardar_config_many({
+                    'smtp_host': txt_host.value.strip(),
+                    'smtp_port': txt_port.value.strip(),
+                    'smtp_user': txt_user.value.strip(),
+                    'smtp_pass': password,
+                    'smtp_from': txt_from.value.strip() or txt_user.value.strip(),
+                })
                 
                 lbl_status.value = "✅ Configuración guardada"
                 lbl_status.color = "#4caf50"
@@ -1387,7 +1637,9 @@ def main(page: ft.Page):
                         ft.ElevatedButton("💾 Guardar", bgcolor="#4caf50", color="white", expand=True, on_click=guardar),
                         ft.ElevatedButton("📤 Probar", bgcolor="#2196f3", color="white", expand=True, on_click=probar),
                     ], spacing=10),
-                    lbl_status
+                    lbl_status,
+                    ft.Divider(),
+                    ft.Row([lbl_cola, btn_reintentar], wrap=True, vertical_alignment=ft.CrossAxisAlignment.CENTER),
                 ], spacing=12, scroll=ft.ScrollMode.AUTO),
                 padding=20
             )
@@ -1397,9 +1649,15 @@ def main(page: ft.Page):
     # Iniciar en pantalla principal
     ir_inicio()
 
+# Enviar los correos que hayan quedado en cola de una ejecución anterior
+correo.iniciar_cola_correos()
+
 # Ejecutar app (flet 0.70+)
-ft.app(
-    main,
-    port=int(os.environ.get("PORT", 8080)),
-    view=ft.AppView.WEB_BROWSER
-)
+if web:
+    web.iniciar(main, int(os.environ.get("PORT", 8080)))
+else:
+    ft.app(
+        main,
+        port=int(os.environ.get("PORT", 8080)),
+        view=ft.AppView.WEB_BROWSER
+    )
@@ -0,0 +1,134 @@
+"""
+Pruebas de la capa de base de datos (SQLite temporal)
+Correr con: python -m pytest -q
+"""
+import json
+import os
+import tempfile
+
+os.environ.pop('DATABASE_URL', None)
+os.environ['SQLITE_PATH'] = os.path.join(tempfile.mkdtemp(), 'prueba.db')
+
+import pytest
+import database as db
+
+def _fila(**campos):
+    return db.clase_fila(tuple(campos))(campos.values())
+
+def test_fila_se_lee_como_dict():
+    fila = _fila(id=1, nombre='Ana')
+    assert fila['nombre'] == 'Ana'
+    assert fila.get('falta', 0) == 0
+    assert 'id' in fila and 'Ana' not in fila
+    assert list(fila) == ['id', 'nombre']
+    assert dict(fila) == {'id': 1, 'nombre': 'Ana'}
+    assert {**fila} == {'id': 1, 'nombre': 'Ana'}
+    with pytest.raises(KeyError):
+        fila['falta']
+
+def test_fila_desempaquetar_como_dict():
+    fila = _fila(id=1, nombre='Ana')
+    # Como un dict: recorrerla da las columnas; los valores con values()
+    assert tuple(fila) == ('id', 'nombre')
+    id, nombre = fila.values()
+    assert (id, nombre) == (1, 'Ana')
+
+def test_fila_json_no_pierde_valores():
+    fila = _fila(id=1, nombre='Ana')
+    assert json.loads(json.dumps(dict(fila))) == {'id': 1, 'nombre': 'Ana'}
+    # Sin convertir no se serializa a medias (antes salía la lista de columnas)
+    with pytest.raises(TypeError):
+        json.dumps(fila)
+
+def test_fila_igualdad_consistente():
+    fila = _fila(id=1, nombre='Ana')
+    igual = {'id': 1, 'nombre': 'Ana'}
+    distinto = {'id': 1, 'nombre': 'Beto'}
+    assert fila == igual and not (fila != igual)
+    assert fila != distinto and not (fila == distinto)
+    assert fila == _fila(id=1, nombre='Ana')
+    assert fila != _fila(id=2, nombre='Ana')
+    assert fila != (1, 'Ana')
+
+def test_fila_con():
+    fila = _fila(id=1, nombre='Ana')
+    otra = fila.con(nombre='Beto', activo=1)
+    assert dict(otra) == {'id': 1, 'nombre': 'Beto', 'activo': 1}
+    assert fila['nombre'] == 'Ana'
+
+def test_execute_query_devuelve_filas():
+    filas = db.execute_query('SELECT 1 AS uno, ? AS dos', ('x',))
+    assert filas == [{'uno': 1, 'dos': 'x'}]
+    assert isinstance(filas[0], db.Fila)
+
+def test_config_recarga_no_pisa_un_guardado_concurrente(monkeypatch):
+    db.guardar_config('smtp_host', 'viejo')
+    db._config = None  # forzar recarga
+    consulta = db.execute_query
+    
+    def consulta_con_guardado_en_medio(sql, *args, **kwargs):
+        filas = consulta(sql, *args, **kwargs)
+        if sql is db.CONFIG_TODAS:
+            db.guardar_config('smtp_host', 'nuevo')  # otro hilo guarda durante la carga
+        return filas
+    
+    monkeypatch.setattr(db, 'execute_query', consulta_con_guardado_en_medio)
+    db.obtener_configuracion()
+    monkeypatch.setattr(db, 'execute_query', consulta)
+    assert db.obtener_config('smtp_host') == 'nuevo'
+
+def test_guardar_config_many_registra_metricas():
+    db.reiniciar_metricas()
+    db.guardar_config_many({'smtp_port': '587', 'smtp_from': 'a@b.c'})
+    assert db.obtener_metricas()['guardar_config_many']['filas'] == 2
+
+def test_metricas_son_por_sentencia():
+    soportista = db.guardar_soportista('Técnico', 't@x.com')
+    cliente = db.guardar_cliente('Cliente', 'c@x.com', '', soportista)
+    db.reiniciar_metricas()
+    db.guardar_visita(cliente, soportista, 'Ana', '2025-01-10', '10:00', 30, 'Trabajo')
+    m = db.obtener_metricas()['guardar_visita']
+    # Una llamada ejecuta varias sentencias (visita, resumen diario...)
+    assert m['sentencias'] > 1
+    assert sum(m['histograma'].values()) == m['sentencias']
+
+def test_cache_reportes_se_invalida_al_guardar_y_resolver():
+    import correo
+    soportista = db.guardar_soportista('Técnico caché', 't@x.com')
+    cliente = db.guardar_cliente('Cliente caché', 'c@x.com', '', soportista)
+    fila_cliente = {'id': cliente, 'nombre': 'Cliente caché'}
+    visita = db.guardar_visita(cliente, soportista, 'Ana', '2025-02-10', '10:00', 30, 'Primera visita',
+                               tiene_pendiente=True, descripcion_pendiente='Traer tóner')
+    
+    reporte = correo.reporte_cliente_cacheado(fila_cliente, '2025-02-01', '2025-02-28', formato='texto')
+    boleta = correo.boleta_cacheada(visita)
+    assert 'Primera visita' in reporte and 'Traer tóner' in boleta
+    aciertos = correo.estadisticas_cache_reportes()['aciertos']
+    assert correo.reporte_cliente_cacheado(fila_cliente, '2025-02-01', '2025-02-28', formato='texto') == reporte
+    assert correo.estadisticas_cache_reportes()['aciertos'] == aciertos + 1
+    
+    # Una visita nueva del cliente regenera el reporte
+    db.guardar_visita(cliente, soportista, 'Ana', '2025-02-11', '10:00', 30, 'Segunda visita')
+    assert 'Segunda visita' in correo.reporte_cliente_cacheado(fila_cliente, '2025-02-01', '2025-02-28', formato='texto')
+    
+    # Resolver el pendiente invalida la boleta: la próxima lectura la regenera
+    correo.boleta_cacheada(visita)
+    fallos = correo.estadisticas_cache_reportes()['fallos']
+    db.resolver_pendiente(visita)
+    correo.boleta_cacheada(visita)
+    assert correo.estadisticas_cache_reportes()['fallos'] == fallos + 1
+
+def test_boleta_cacheada_de_visita_inexistente():
+    import correo
+    assert correo.boleta_cacheada(999999) is None
+
+def test_guardar_config_cachea_texto_en_un_dict_nuevo():
+    db.guardar_config('smtp_port', '465')
+    anterior = db._configuracion()
+    db.guardar_config('smtp_port', 587)
+    # Mismo tipo que después de recargar desde la base
+    assert db.obtener_config('smtp_port') == '587'
+    db._config = None
+    assert db.obtener_config('smtp_port') == '587'
+    # El dict que ya tenía otro hilo no se modifica
+    assert anterior['smtp_port'] == '465'
@@ -0,0 +1,167 @@
+"""
+Rutas HTTP que se sirven junto a la app Flet (mismo puerto)
+Reporte imprimible y boletas como HTML comprimido con gzip y con ETag, para que
+los documentos grandes no viajen por el websocket y el navegador los guarde (un
+reporte que no está en la caché se envía en trozos); exportaciones CSV/NDJSON
+enviadas en trozos
+"""
+import gzip
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import webbrowser
+from collections import OrderedDict
+from datetime import date
+from urllib.parse import urlencode
+
+import uvicorn
+import flet.fastapi as flet_fastapi
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+
+import database as db
+import correo
+import exportar
+
+# Los enlaces llevan una firma para que no se puedan recorrer /boletas/1, /boletas/2...
+# Con WEB_SECRETO fijo siguen valiendo después de reiniciar (si no, se generan
+# de nuevo en cada arranque)
+SECRETO = os.environ.get('WEB_SECRETO', '').encode() or secrets.token_bytes(32)
+
+# HTML ya comprimido por ETag: volver a pedir el mismo documento no lo recomprime
+COMPRIMIDOS_MAX = 32
+
+_comprimidos = OrderedDict()  # etag -> bytes gzip
+_comprimidos_lock = threading.Lock()
+
+def _firma(ruta):
+    return hmac.new(SECRETO, ruta.encode(), hashlib.sha256).hexdigest()[:32]
+
+def _enlace(ruta, **params):
+    """Ruta con sus parámetros y la firma al final"""
+    query = urlencode(params)
+    if query:
+        ruta = f"{ruta}?{query}"
+    return f"{ruta}{'&' if query else '?'}firma={_firma(ruta)}"
+
+def _verificar(request):
+    # Se firma la ruta con los parámetros en el mismo orden en que los armó _enlace
+    query = urlencode([(k, v) for k, v in request.query_params.multi_items() if k != 'firma'])
+    ruta = f"{request.url.path}?{query}" if query else request.url.path
+    if not hmac.compare_digest(_firma(ruta), request.query_params.get('firma', '')):
+        raise HTTPException(status_code=403, detail="Enlace inválido")
+
+def url_reporte(cliente_id, fecha_desde, fecha_hasta):
+    """Enlace (relativo a la app) al reporte imprimible de un cliente"""
+    return _enlace(f"/reportes/{cliente_id}", desde=fecha_desde or '', hasta=fecha_hasta or '')
+
+def url_boleta(visita_id):
+    """Enlace (relativo a la app) a la boleta de una visita"""
+    return _enlace(f"/boletas/{visita_id}")
+
+def url_exportacion(tipo, formato, **filtros):
+    """Enlace (relativo a la app) a una exportación de exportar.py (descarga)"""
+    return _enlace(f"/exportar/{tipo}", formato=formato,
+                   **{k: v for k, v in filtros.items() if v not in (None, '')})
+
+def _comprimir(etag, datos):
+    with _comprimidos_lock:
+        comprimido = _comprimidos.get(etag)
+        if comprimido is not None:
+            _comprimidos.move_to_end(etag)
+            return comprimido
+    comprimido = gzip.compress(datos, compresslevel=6)
+    with _comprimidos_lock:
+        _comprimidos[etag] = comprimido
+        while len(_comprimidos) > COMPRIMIDOS_MAX:
+            _comprimidos.popitem(last=False)
+    return comprimido
+
+def _respuesta_html(request, texto):
+    """HTML con ETag: 304 si el navegador ya lo tiene, gzip si lo acepta"""
+    datos = texto.encode('utf-8')
+    etag = f'"{hashlib.sha1(datos).hexdigest()}"'
+    # no-cache: el navegador lo guarda pero pregunta cada vez (If-None-Match)
+    encabezados = {'ETag': etag, 'Cache-Control': 'private, no-cache', 'Vary': 'Accept-Encoding'}
+
+    pedidos = request.headers.get('if-none-match', '')
+    if any(e.strip().removeprefix('W/') in (etag, '*') for e in pedidos.split(',') if e.strip()):
+        return Response(status_code=304, headers=encabezados)
+
+    if 'gzip' in request.headers.get('accept-encoding', ''):
+        datos = _comprimir(etag, datos)
+        encabezados['Content-Encoding'] = 'gzip'
+    return Response(datos, media_type='text/html; charset=utf-8', headers=encabezados)
+
+def _fecha(texto):
+    """Fecha AAAA-MM-DD de un parámetro ('' = sin límite); 400 si no es válida"""
+    if not texto:
+        return None
+    try:
+        return date.fromisoformat(texto).isoformat()
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Fecha inválida: {texto}")
+
+# Rutas sincrónicas: FastAPI las corre en su pool de hilos (la BD es bloqueante)
+
+def reporte(request: Request, cliente_id: int, desde: str = '', hasta: str = ''):
+    """Reporte imprimible de un cliente en un período"""
+    _verificar(request)
+    desde, hasta = _fecha(desde), _fecha(hasta)
+    cliente = db.obtener_cliente(cliente_id)
+    if not cliente:
+        raise HTTPException(status_code=404, detail="Cliente no encontrado")
+    # Sin fechas: todo el historial (el encabezado lo dice con correo.texto_periodo)
+    texto, partes = correo.partes_reporte_cacheado(cliente, desde, hasta, formato='imprimible')
+    if texto is not None:
+        return _respuesta_html(request, texto)
+    # No está en la caché: se manda a medida que se lee (sin juntar el reporte
+    # ni una copia gzip en memoria); al terminar queda en la caché si entra, y
+    # las siguientes veces sale con ETag y gzip
+    return StreamingResponse(partes, media_type='text/html; charset=utf-8',
+                             headers={'Cache-Control': 'private, no-cache'})
+
+def boleta(request: Request, visita_id: int):
+    """Boleta de una visita"""
+    _verificar(request)
+    texto = correo.boleta_cacheada(visita_id)
+    if texto is None:
+        raise HTTPException(status_code=404, detail="Boleta no encontrada")
+    return _respuesta_html(request, texto)
+
+def exportacion(request: Request, tipo: str, formato: str = 'csv', cliente_id: int = None,
+                soportista_id: int = None, fecha_desde: str = None, fecha_hasta: str = None):
+    """Visitas o estadísticas en CSV/NDJSON, enviadas a medida que se leen"""
+    _verificar(request)
+    filtros = {'cliente_id': cliente_id, 'soportista_id': soportista_id,
+               'fecha_desde': fecha_desde, 'fecha_hasta': fecha_hasta}
+    try:
+        partes = exportar.exportar(tipo, formato, **filtros)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    nombre = '_'.join([tipo] + [str(v) for v in filtros.values() if v]) + f'.{formato}'
+    # Sin gzip ni ETag: se manda en trozos mientras se recorre el cursor
+    return StreamingResponse(partes, media_type=exportar.FORMATOS[formato],
+                             headers={'Content-Disposition': f'attachment; filename="{nombre}"'})
+
+def crear_app(main):
+    """App FastAPI con las rutas de documentos y la app Flet montada en /"""
+    # Mismo armado que usa ft.app en modo web (FastAPI de flet + mount), con
+    # nuestras rutas antes del mount para que no las tape la app Flet
+    app = flet_fastapi.FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+    app.add_api_route('/reportes/{cliente_id}', reporte, methods=['GET'])
+    app.add_api_route('/boletas/{visita_id}', boleta, methods=['GET'])
+    app.add_api_route('/exportar/{tipo}', exportacion, methods=['GET'])
+    app.mount('/', flet_fastapi.app(main))
+    return app
+
+def iniciar(main, port):
+    """Sirve la app Flet y las rutas HTTP en el puerto dado (bloquea)"""
+    url = f"http://127.0.0.1:{port}"
+    print(f"🌐 App en {url}")
+    if os.name == 'nt':
+        # Desarrollo local en Windows: abrir el navegador como hacía view=WEB_BROWSER
+        threading.Timer(1.5, webbrowser.open, (url,)).start()
+    uvicorn.run(crear_app(main), host='0.0.0.0', port=port)